@@ -0,0 +1,209 @@
+"""
+Micro-benchmarks of the local hot paths of a sync: rendering, converting, slugifying, hashing, comparing and
+parsing, on fixtures the size of real help centers.
+
+Every case reports the best time per call over a few repeats. Save a run as the baseline before a change and
+compare against it after:
+
+    python benchmark/micro.py --save baseline.json
+    python benchmark/micro.py --compare baseline.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+import html2text  # noqa: E402
+
+import filesystem  # noqa: E402
+import model  # noqa: E402
+import utils  # noqa: E402
+import zendesk  # noqa: E402
+
+import synthetic  # noqa: E402
+
+DEFAULT_REPEAT = 5
+# changes within this share of the baseline are reported as noise
+NOISE = 0.1
+UNICODE_TITLES = [
+    'Über die Größe von Anhängen',
+    'Configuración de la autenticación única (SSO)',
+    'Как настроить уведомления',
+    '添付ファイルのサイズ制限について',
+    'Résoudre les problèmes de connexion — étape par étape',
+    'Ελέγξτε τις ρυθμίσεις απορρήτου',
+    'Pagamentos & faturação: perguntas frequentes',
+    'إعداد حسابك لأول مرة',
+]
+
+
+def long_markdown(attachments, sections=40):
+    """
+    An article body of about 40kB mixing the markdown the help centers use: headings, paragraphs, nested
+    lists, tables, fenced code and links to `attachments` attachments.
+    """
+    parts = []
+    for i in range(sections):
+        parts.append('## Step %s: configure the *%s* setting\n' % (i, UNICODE_TITLES[i % len(UNICODE_TITLES)]))
+        parts.append(synthetic.SENTENCE * 6 + '\n')
+        parts.append('1. Open **Settings**\n    - then `Advanced`\n    - then [docs](https://example.com/%s)\n'
+                     '2. Save\n' % i)
+        parts.append('| Option | Default | Description |\n|---|---|---|\n' +
+                     '| `option_%s` | on | %s |\n' % (i, synthetic.SENTENCE) * 5)
+        parts.append('```python\nclient = Client(uri="https://example.com")\nclient.sync(%s)\n```\n' % i)
+    for j in range(attachments):
+        parts.append('![image %s](attachments/image-%s.png)\n' % (j, j))
+    return '\n'.join(parts)
+
+
+def article(body, attachments):
+    category = model.Category({'name': 'Category', 'description': ''}, 'category')
+    section = model.Section(category, {'name': 'Section', 'description': ''}, 'section')
+    attributes = {'name': UNICODE_TITLES[0], 'synced': True, 'draft': False, 'author': 'author@example.com',
+                  'visibility': 'all', 'comments_disabled': False}
+    item = model.Article(section, attributes, body, 'article')
+    for j in range(attachments):
+        attachment = model.Attachment(item, 'image-%s.png' % j)
+        attachment.meta = {'relative_path': '/hc/article_attachments/%s/image-%s.png' % (j, j)}
+        item.attachments[attachment.filename] = attachment
+    return item
+
+
+class OfflineRequest(object):
+
+    """
+    Answers the requests a `Pusher` makes when it is created, so its comparisons can be timed without a server.
+    """
+
+    def get_user_segments(self):
+        return []
+
+    def get_permission_groups(self):
+        return [{'id': 1, 'name': 'Agents and admins'}]
+
+
+class Fixtures(object):
+
+    """
+    Files and objects the cases run on, written to a temporary folder.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.root = tempfile.mkdtemp()
+        self.fs = filesystem.FilesystemClient(self.root)
+        self.body = long_markdown(attachments=10)
+        self.article = article(self.body, 10)
+        self.many_attachments = article(long_markdown(attachments=200), 200)
+        self.html = self.article.generate_body()
+        self.category = model.Category({'name': UNICODE_TITLES[3], 'description': synthetic.SENTENCE * 20},
+                                       'category')
+        self.category.meta = dict(self.category.to_attributes(), id=1)
+        self.pusher = zendesk.Pusher(OfflineRequest(), self.fs)
+        self._write_file('small.png', 20 * 1024)
+        self._write_file('large.png', 5 * 1024 * 1024)
+        self.fs.save_yaml('__article__.yaml', self.article.to_attributes())
+        meta = {'id': 1, 'title': UNICODE_TITLES[0], 'html_url': 'https://example.com/hc/articles/1',
+                'section_id': 2, 'author_id': 3, 'draft': False, 'labels': ['a', 'b'], 'position': 0,
+                'generated_body_hash': utils.md5_text(self.html), 'created_at': '2020-01-01T00:00:00Z'}
+        self.fs.save_json('.article.meta', meta)
+        self.tree = os.path.join(self.root, 'tree')
+        synthetic.write_tree(self.tree, 200, attachments=2, attachment_size=1024)
+
+    def _write_file(self, path, size):
+        with open(self.fs.path_for(path), 'wb') as fp:
+            fp.write(os.urandom(size))
+
+    def close(self):
+        shutil.rmtree(self.root)
+
+
+def cases(fixtures):
+    """
+    Maps the name of every case to the function it times.
+    """
+    fs = fixtures.fs
+    return {
+        'generate_body long article': fixtures.article.generate_body,
+        'generate_body 200 attachments': fixtures.many_attachments.generate_body,
+        'html2text long article': lambda: html2text.html2text(fixtures.html),
+        'slugify unicode titles': lambda: [utils.slugify(title) for title in UNICODE_TITLES],
+        'md5_hash 20kB attachment': lambda: utils.md5_hash(fs.path_for('small.png')),
+        'md5_hash 5MB attachment': lambda: utils.md5_hash(fs.path_for('large.png')),
+        'md5_text long article': lambda: utils.md5_text(fixtures.html),
+        '_have_attributes_changed': lambda: fixtures.pusher._have_attributes_changed(
+            fixtures.category.to_attributes(), fixtures.category),
+        'read_yaml article attributes': lambda: fs.read_yaml('__article__.yaml'),
+        'read_json article meta': lambda: fs.read_json('.article.meta'),
+        'save_json article meta': lambda: fs.save_json('.article.meta', {'draft': False}),
+        'load tree of 200 articles': lambda: filesystem.Loader(
+            filesystem.FilesystemClient(fixtures.tree), False).load(),
+    }
+
+
+def measure(function, repeat):
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def format_time(seconds):
+    for unit, scale in [('s', 1), ('ms', 1e-3), ('us', 1e-6)]:
+        if seconds >= scale:
+            return '%.2f %s' % (seconds / scale, unit)
+    return '%.0f ns' % (seconds / 1e-9)
+
+
+def compare(seconds, baseline):
+    if baseline is None:
+        return ''
+    change = seconds / baseline - 1
+    verdict = 'faster' if change < -NOISE else 'slower' if change > NOISE else 'same'
+    return '%12s %+7.1f%% %s' % (format_time(baseline), change * 100, verdict)
+
+
+def run(args):
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    fixtures = Fixtures()
+    results = {}
+    try:
+        for name, function in cases(fixtures).items():
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(function, args.repeat)
+            line = '%-32s %12s %s' % (name, format_time(results[name]), compare(results[name], baseline.get(name)))
+            print(line.rstrip())
+            sys.stdout.flush()
+    finally:
+        fixtures.close()
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time the local hot paths of a sync.')
+    parser.add_argument('-k', '--filter', help='Only run the cases whose name contains this text')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='Repeats of every case, the best is kept, default: %s' % DEFAULT_REPEAT)
+    parser.add_argument('--save', help='Write the results as json to this file, to compare later runs with')
+    parser.add_argument('--compare', help='Compare with the results saved in this file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
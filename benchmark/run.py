@@ -0,0 +1,131 @@
+"""
+End-to-end benchmark of the import and export tasks against the local stub server.
+
+Every scenario runs the command line tool in its own process so its wall time and peak memory are measured
+alone, while the stub server counts the requests and bytes it handled:
+
+    python benchmark/run.py --articles 1000 10000 50000 --jobs 8 --latency 0.02 --rate-limit 0.01
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import stub_server
+import synthetic
+
+CMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src', 'cms.py')
+DEFAULT_ARTICLES = [1000, 10000, 50000]
+MB = 1024 * 1024
+
+
+def write_config(folder, url):
+    # the tool reads its configuration from the working directory
+    with open(os.path.join(folder, 'zendesk-help-cms.config'), 'w') as fp:
+        fp.write('[DEFAULT]\ncompany_uri = %s\npublic_uri = %s\nuser = benchmark\npassword = benchmark\n'
+                 'disable_article_comments = 0\nrender_cache_size = 0\n' % (url, url))
+
+
+def run_task(folder, root, task, options, loglevel):
+    """
+    Runs `task` of the command line tool and returns its wall time and peak resident memory.
+    """
+    command = [sys.executable, CMS, '-l', loglevel, '-r', root, task] + options
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=folder, stdout=subprocess.DEVNULL)
+    # wait4 reports the resources of this child alone, not the largest of every child so far
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError('%s exited with %s' % (' '.join(command), process.returncode))
+    # ru_maxrss is in kilobytes on linux
+    return wall, usage.ru_maxrss * 1024
+
+
+def scenarios(args, articles):
+    """
+    Yields the name, stub server, local tree and task of every scenario for `articles` articles: importing a
+    help center, exporting a new tree of the same size and exporting it again unchanged.
+    """
+    center = stub_server.HelpCenter()
+    synthetic.populate(center, articles, args.attachments, args.body_size, args.attachment_size)
+    yield 'import', center, tempfile.mkdtemp(), 'import'
+    root = tempfile.mkdtemp()
+    synthetic.write_tree(root, articles, args.attachments, args.body_size, args.attachment_size)
+    center = stub_server.HelpCenter()
+    yield 'export', center, root, 'export'
+    yield 'export unchanged', center, root, 'export'
+
+
+def run(args):
+    results = []
+    folder = tempfile.mkdtemp()
+    roots = set()
+    try:
+        for articles in args.articles:
+            for name, center, root, task in scenarios(args, articles):
+                roots.add(root)
+                server = stub_server.StubServer(center, args.latency, args.page_size, args.rate_limit).start()
+                try:
+                    write_config(folder, server.url)
+                    options = ['-j', str(args.jobs)] + (['-p', str(args.processes)] if args.processes else [])
+                    wall, peak_memory = run_task(folder, root, task, options, args.loglevel)
+                finally:
+                    server.stop()
+                result = dict(server.stats, scenario=name, articles=articles, wall=wall, peak_memory=peak_memory)
+                results.append(result)
+                print_result(result)
+    finally:
+        shutil.rmtree(folder)
+        for root in roots:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def print_result(result):
+    print('%-17s %7d articles %8.1fs %8d requests %6d throttled %9.1f MB up %9.1f MB down %8.1f MB peak' % (
+        result['scenario'], result['articles'], result['wall'], result['requests'],
+        result['statuses'].get(429, 0), result['bytes_received'] / MB, result['bytes_sent'] / MB,
+        result['peak_memory'] / MB))
+    sys.stdout.flush()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark import and export against a local stub server.')
+    parser.add_argument('-a', '--articles', type=int, nargs='+', default=DEFAULT_ARTICLES,
+                        help='Help center sizes to run, default: %s' % ' '.join(map(str, DEFAULT_ARTICLES)))
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='Parallel requests, default: 8')
+    parser.add_argument('-p', '--processes', type=int, default=0,
+                        help='Processes converting and rendering bodies, default: 0')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the server waits before every answer, default: 0')
+    parser.add_argument('--page-size', type=int, default=None,
+                        help='Items per page, default: the page size the client asks for')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='Share of requests answered with 429, default: 0')
+    parser.add_argument('--attachments', type=int, default=1, help='Attachments per article, default: 1')
+    parser.add_argument('--body-size', type=int, default=synthetic.BODY_SIZE,
+                        help='Article body size in bytes, default: %s' % synthetic.BODY_SIZE)
+    parser.add_argument('--attachment-size', type=int, default=synthetic.ATTACHMENT_SIZE,
+                        help='Attachment size in bytes, default: %s' % synthetic.ATTACHMENT_SIZE)
+    parser.add_argument('-l', '--loglevel', default='ERROR',
+                        help='Log level of the benchmarked tool, default: ERROR')
+    parser.add_argument('-o', '--output', help='Also write the results as json to this file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
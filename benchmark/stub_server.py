@@ -0,0 +1,268 @@
+"""
+A stand-in for the parts of the Zendesk Help Center API the sync uses, serving an in-memory help center over
+plain http on localhost. Latency, page size and the share of requests answered with 429 are configurable.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+HELP_CENTER = r'/api/v2/help_center/'
+LOCALE = r'[\w-]+/'
+PARENT_KEYS = {'sections': 'category_id', 'articles': 'section_id', 'article_attachments': 'article_id'}
+ITEM_NAMES = {'categories': 'category', 'sections': 'section', 'articles': 'article'}
+USER = {'id': 1, 'name': 'Author', 'email': 'author@example.com'}
+
+
+class HelpCenter(object):
+
+    """
+    Categories, sections, articles and attachments by id, with the ids of the children of every parent.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.items = {group: {} for group in ['categories', 'sections', 'articles', 'article_attachments']}
+        self.children = {}
+        self.files = {}
+        # uploads of the same content share one copy so large runs don't hold every attachment
+        self.blobs = {}
+
+    def add(self, group, record, parent_id=None):
+        with self.lock:
+            self.last_id += 1
+            record = dict(record, id=self.last_id, updated_at=int(time.time()))
+            if group in PARENT_KEYS:
+                record[PARENT_KEYS[group]] = parent_id
+            self.items[group][record['id']] = record
+            self.children.setdefault((group, parent_id), []).append(record['id'])
+            return record
+
+    def add_attachment(self, article_id, file_name, content):
+        record = self.add('article_attachments', {'file_name': file_name, 'content_type': 'image/png',
+                                                  'size': len(content), 'inline': True}, article_id)
+        record['relative_path'] = '/hc/article_attachments/%s/%s' % (record['id'], file_name)
+        self.files[record['id']] = self.blobs.setdefault(hashlib.md5(content).hexdigest(), content)
+        return record
+
+    def list(self, group, parent_id=None):
+        with self.lock:
+            return [self.items[group][i] for i in self.children.get((group, parent_id), [])
+                    if i in self.items[group]]
+
+    def update(self, group, item_id, data):
+        with self.lock:
+            record = self.items[group][item_id]
+            record.update(data)
+            record['updated_at'] = int(time.time())
+            return record
+
+    def delete(self, group, item_id):
+        with self.lock:
+            self.files.pop(item_id, None)
+            return self.items[group].pop(item_id, None) is not None
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, with Nagle on every answer would wait for a delayed ack
+    disable_nagle_algorithm = True
+
+    routes = [
+        ('GET', HELP_CENTER + LOCALE + r'categories\.json', 'list_categories'),
+        ('POST', HELP_CENTER + LOCALE + r'categories\.json', 'create_category'),
+        ('GET', HELP_CENTER + LOCALE + r'(categories|sections|articles)/(\d+)/(sections|articles|attachments)\.json',
+         'list_children'),
+        ('POST', HELP_CENTER + LOCALE + r'(categories|sections|articles)/(\d+)/(sections|articles|attachments)\.json',
+         'create_child'),
+        ('DELETE', HELP_CENTER + LOCALE + r'articles/attachments/(\d+)\.json', 'delete_attachment'),
+        ('GET', HELP_CENTER + LOCALE + r'(categories|sections|articles)/(\d+)\.json', 'get_item'),
+        ('PUT', HELP_CENTER + LOCALE + r'(categories|sections|articles)/(\d+)\.json', 'put_item'),
+        ('DELETE', HELP_CENTER + LOCALE + r'(categories|sections|articles)/(\d+)\.json', 'delete_item'),
+        ('PUT', HELP_CENTER + r'(categories|sections|articles)/(\d+)/translations/[\w-]+\.json', 'put_translation'),
+        ('GET', HELP_CENTER + r'incremental/articles\.json', 'incremental_articles'),
+        ('GET', HELP_CENTER + r'user_segments/applicable\.json', 'user_segments'),
+        ('GET', r'/api/v2/guide/permission_groups\.json', 'permission_groups'),
+        ('GET', r'/api/v2/users/(\d+)\.json', 'get_user'),
+        ('GET', r'/api/v2/search\.json', 'search'),
+        ('GET', r'/hc/article_attachments/(\d+)/.+', 'download'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.rate_limit and random.random() < self.server.rate_limit:
+            status, payload, headers = 429, b'{}', {'Retry-After': str(self.server.retry_after)}
+        else:
+            status, payload, headers = self._route(method, url.path, body)
+        self.server.record(method, status, len(body), len(payload))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _route(self, method, path, body):
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                try:
+                    result = getattr(self, handler)(body, *match.groups())
+                except KeyError:
+                    return 404, b'{"error": "RecordNotFound"}', {'Content-Type': 'application/json'}
+                if isinstance(result, bytes):
+                    return 200, result, {'Content-Type': 'application/octet-stream'}
+                status, data = result if isinstance(result, tuple) else (200, result)
+                return status, json.dumps(data).encode('utf-8'), {'Content-Type': 'application/json'}
+        return 404, b'{"error": "InvalidEndpoint"}', {'Content-Type': 'application/json'}
+
+    def _page(self, group, records):
+        page_size = self.server.page_size or int(self.query.get('per_page', ['100'])[0])
+        page = int(self.query.get('page', ['1'])[0])
+        start = (page - 1) * page_size
+        next_page = None
+        if start + page_size < len(records):
+            base = 'http://%s:%s%s' % (self.server.server_address[0], self.server.server_address[1],
+                                       urlsplit(self.path).path)
+            next_page = '%s?per_page=%s&page=%s' % (base, page_size, page + 1)
+        return {group: records[start:start + page_size], 'next_page': next_page, 'count': len(records)}
+
+    def _json(self, body):
+        return json.loads(body.decode('utf-8')) if body else {}
+
+    def list_categories(self, body):
+        return self._page('categories', self.server.center.list('categories'))
+
+    def create_category(self, body):
+        return 201, {'category': self.server.center.add('categories', self._json(body)['category'])}
+
+    def list_children(self, body, parent_group, parent_id, group):
+        group = 'article_attachments' if group == 'attachments' else group
+        return self._page(group, self.server.center.list(group, int(parent_id)))
+
+    def create_child(self, body, parent_group, parent_id, group):
+        center = self.server.center
+        if group == 'attachments':
+            file_name, content = self._multipart_file(body)
+            return 201, {'article_attachment': center.add_attachment(int(parent_id), file_name, content)}
+        name = ITEM_NAMES[group]
+        return 201, {name: center.add(group, self._json(body)[name], int(parent_id))}
+
+    def _multipart_file(self, body):
+        boundary = self.headers['Content-Type'].split('boundary=')[1].encode('ascii')
+        for part in body.split(b'--' + boundary):
+            headers, _, content = part.partition(b'\r\n\r\n')
+            match = re.search(rb'filename="([^"]*)"', headers)
+            if match:
+                return match.group(1).decode('utf-8'), content[:-2]
+        raise KeyError('file')
+
+    def get_item(self, body, group, item_id):
+        return {ITEM_NAMES[group]: self.server.center.items[group][int(item_id)]}
+
+    def put_item(self, body, group, item_id):
+        name = ITEM_NAMES[group]
+        return {name: self.server.center.update(group, int(item_id), self._json(body)[name])}
+
+    def delete_item(self, body, group, item_id):
+        return {} if self.server.center.delete(group, int(item_id)) else (404, {})
+
+    def delete_attachment(self, body, item_id):
+        return {} if self.server.center.delete('article_attachments', int(item_id)) else (404, {})
+
+    def put_translation(self, body, group, item_id):
+        translation = self._json(body)['translation']
+        self.server.center.update(group, int(item_id), translation)
+        return {'translation': translation}
+
+    def incremental_articles(self, body):
+        start_time = int(self.query.get('start_time', ['0'])[0])
+        with self.server.center.lock:
+            articles = [a for a in self.server.center.items['articles'].values() if a['updated_at'] >= start_time]
+        return {'articles': articles, 'end_of_stream': True}
+
+    def user_segments(self, body):
+        return {'user_segments': [{'id': 10, 'name': 'Signed-in users'}]}
+
+    def permission_groups(self, body):
+        return {'permission_groups': [{'id': 1, 'name': 'Agents and admins'}]}
+
+    def get_user(self, body, user_id):
+        return {'user': dict(USER, id=int(user_id))}
+
+    def search(self, body):
+        return {'results': [USER]}
+
+    def download(self, body, item_id):
+        return self.server.center.files[int(item_id)]
+
+
+class StubServer(ThreadingHTTPServer):
+
+    """
+    Serves `center` on localhost, waiting `latency` seconds before every answer and answering a `rate_limit`
+    share of the requests with 429. `page_size` overrides the page size the client asks for.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, center, latency=0.0, page_size=None, rate_limit=0.0, retry_after=0, port=0):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.center = center
+        self.latency = latency
+        self.page_size = page_size
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0, 'statuses': {}, 'methods': {}}
+
+    def record(self, method, status, received, sent):
+        with self.stats_lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_received'] += received
+            self.stats['bytes_sent'] += sent
+            self.stats['statuses'][status] = self.stats['statuses'].get(status, 0) + 1
+            self.stats['methods'][method] = self.stats['methods'].get(method, 0) + 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,88 @@
+"""
+Synthetic help centers of a given number of articles, either served by the stub server for an import or written
+to a local tree for an export.
+"""
+import os
+import random
+
+import yaml
+
+ARTICLES_PER_SECTION = 50
+SECTIONS_PER_CATEGORY = 10
+BODY_SIZE = 4000
+ATTACHMENT_SIZE = 20000
+SENTENCE = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt. '
+
+
+def _attachment_content(size):
+    # random bytes so the attachment can't be deduplicated or compressed along the way
+    return bytes(random.getrandbits(8) for _ in range(size))
+
+
+def _layout(articles):
+    """
+    Yields the category, section and article number of every article, starting a new section every
+    `ARTICLES_PER_SECTION` articles and a new category every `SECTIONS_PER_CATEGORY` sections.
+    """
+    for i in range(articles):
+        section = i // ARTICLES_PER_SECTION
+        yield section // SECTIONS_PER_CATEGORY, section, i
+
+
+def populate(center, articles, attachments=1, body_size=BODY_SIZE, attachment_size=ATTACHMENT_SIZE):
+    """
+    Fills the stub server's `center` with `articles` articles, their sections and categories.
+    """
+    paragraph = '<p>%s</p>\n' % (SENTENCE * 4)
+    body = '<h2>Overview</h2>\n' + paragraph * max(1, body_size // len(paragraph))
+    content = _attachment_content(attachment_size)
+    categories, sections = {}, {}
+    for category_number, section_number, number in _layout(articles):
+        if category_number not in categories:
+            categories[category_number] = center.add('categories', {
+                'name': 'Category %s' % category_number, 'description': 'Category %s' % category_number})
+        if section_number not in sections:
+            sections[section_number] = center.add('sections', {
+                'name': 'Section %s' % section_number, 'description': 'Section %s' % section_number},
+                categories[category_number]['id'])
+        article = center.add('articles', {
+            'title': 'Article %s' % number, 'body': body, 'draft': False, 'author_id': 1,
+            'comments_disabled': False, 'user_segment_id': None}, sections[section_number]['id'])
+        for j in range(attachments):
+            center.add_attachment(article['id'], 'image-%s.png' % j, content)
+
+
+def _save_yaml(path, data):
+    with open(path, 'w') as fp:
+        yaml.dump(data, fp)
+
+
+def write_tree(root, articles, attachments=1, body_size=BODY_SIZE, attachment_size=ATTACHMENT_SIZE):
+    """
+    Writes a local tree of `articles` new articles, their sections and categories to `root`, as an author would
+    before their first export.
+    """
+    paragraph = SENTENCE * 4 + '\n\n'
+    links = ''.join('![image %s](attachments/image-%s.png)\n\n' % (j, j) for j in range(attachments))
+    body = '## Overview\n\n' + paragraph * max(1, body_size // len(paragraph)) + links
+    content = _attachment_content(attachment_size)
+    for category_number, section_number, number in _layout(articles):
+        category_path = os.path.join(root, 'category-%s' % category_number)
+        section_path = os.path.join(category_path, 'section-%s' % section_number)
+        if not os.path.exists(category_path):
+            os.makedirs(category_path)
+            _save_yaml(os.path.join(category_path, '__group__.yaml'),
+                       {'name': 'Category %s' % category_number, 'description': 'Category %s' % category_number})
+        if not os.path.exists(section_path):
+            os.makedirs(section_path)
+            _save_yaml(os.path.join(section_path, '__group__.yaml'),
+                       {'name': 'Section %s' % section_number, 'description': 'Section %s' % section_number})
+        article_path = os.path.join(section_path, 'article-%s' % number)
+        os.makedirs(os.path.join(article_path, 'attachments'))
+        _save_yaml(os.path.join(article_path, '__article__.yaml'),
+                   {'name': 'Article %s' % number, 'author': 'author@example.com', 'visibility': 'all'})
+        with open(os.path.join(article_path, 'README.md'), 'w') as fp:
+            fp.write(body)
+        for j in range(attachments):
+            with open(os.path.join(article_path, 'attachments', 'image-%s.png' % j), 'wb') as fp:
+                fp.write(content)
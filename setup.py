@@ -25,10 +25,11 @@ setup(name='zendesk-helpcenter-cms',
       url='https://github.com/KeepSafe/zendesk-helpcenter-cms/',
       license='Apache',
       packages=find_packages('src', exclude=['test', 'test.fixtures']),
-      py_modules=['cms', 'filesystem', 'model', 'translate', 'utils', 'zendesk'],
+      py_modules=['aiozendesk', 'cms', 'filesystem', 'manifest', 'metrics', 'model', 'profiling', 'ratelimit', 'render', 'scheduler', 'translate', 'utils', 'zendesk'],
       package_dir = {'': 'src'},
       namespace_packages=[],
       install_requires = reqs,
+      extras_require={'async': ['aiohttp']},
       entry_points={
           'console_scripts': [
               'zendesk-help-cms = cms:main']
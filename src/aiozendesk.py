@@ -0,0 +1,392 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+import aiohttp
+
+import metrics
+import model
+import ratelimit
+import utils
+import zendesk
+
+DEFAULT_CONCURRENCY = 20
+
+
+class AsyncZendeskRequest(zendesk.BaseZendeskRequest):
+
+    """
+    asyncio version of `zendesk.ZendeskRequest`, every request method is a coroutine. At most `concurrency`
+    requests are in flight at the same time, fewer while Zendesk is rate limiting. Use it with `async with`
+    or call `open` and `close` explicitly.
+    """
+
+    def __init__(self, company_uri, user, password, public_uri=None, concurrency=DEFAULT_CONCURRENCY):
+        super().__init__(company_uri, user, password, public_uri)
+        self.concurrency = concurrency
+        self.limiter = ratelimit.RateLimiter(concurrency)
+        self.metrics = metrics.RequestMetrics()
+        self.session = None
+
+    async def open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency),
+                                                 auth=aiohttp.BasicAuth(self.user, self.password),
+                                                 headers={'Accept': 'application/json'})
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _parse_response(self, response):
+        if response.status == 404:
+            raise zendesk.RecordNotFoundError('Missing record for {}'.format(response.url))
+        if response.status == ratelimit.TOO_MANY_REQUESTS:
+            raise zendesk.RateLimitError('Rate limit still exceeded for {} after retries'.format(response.url))
+        if response.status not in [200, 201]:
+            logging.error('getting data from %s failed. status was %s and message %s',
+                          response.url, response.status, await response.text())
+            return {}
+        return await response.json(content_type=None)
+
+    async def _acquire(self):
+        delay = self.limiter.try_acquire()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self.limiter.try_acquire()
+
+    async def _send(self, method, url, handle, data=None, **kwargs):
+        """
+        Sends the request, retrying it as `ratelimit.RateLimiter` allows, and returns `handle(response)`.
+        `data` can be a callable building the body for each attempt.
+        """
+        attempt = 0
+        while True:
+            await self._acquire()
+            start = time.perf_counter()
+            try:
+                body = data() if callable(data) else data
+                async with self.session.request(method, url, data=body, **kwargs) as response:
+                    self.metrics.record(method, url, response.status, time.perf_counter() - start,
+                                        metrics.payload_size(body), response.content_length or 0)
+                    self.limiter.update(response.status, response.headers)
+                    if not self.limiter.should_retry(method, response.status, attempt):
+                        return await handle(response)
+                    delay = self.limiter.retry_delay(attempt, response.headers)
+                    logging.warning('%s %s returned %s, retrying in %.1fs', method, url, response.status, delay)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.metrics.record(method, url, 'error', time.perf_counter() - start)
+                if not self.limiter.should_retry(method, None, attempt):
+                    raise
+                delay = self.limiter.retry_delay(attempt)
+                logging.warning('%s %s failed (%s), retrying in %.1fs', method, url, e, delay)
+            finally:
+                self.limiter.release()
+            self.metrics.record_retry(method, url)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _request(self, method, url, **kwargs):
+        return await self._send(method, url, self._parse_response, ssl=False, **kwargs)
+
+    async def _send_json(self, method, full_url, data):
+        return await self._request(method, full_url, data=json.dumps(data),
+                                   headers={'Content-type': 'application/json'})
+
+    async def _get_json(self, full_url, params=None):
+        return await self._request('GET', full_url, params=params)
+
+    async def get_user(self, uid):
+        full_url = self._user_url_for(self.user_url.format(uid))
+        return (await self._get_json(full_url)).get('user', {})
+
+    async def search_user(self, query):
+        full_url = self._search_url.format(self.company_url)
+        results = (await self._get_json(full_url, {'query': query})).get('results', [])
+        if len(results) == 0:
+            return False
+        return await self.get_user(results[0]['id'])
+
+    async def get_user_segments(self):
+        full_url = self._user_segments_url.format(self.company_url)
+        return (await self._get_json(full_url)).get('user_segments', [])
+
+    async def get_permission_groups(self):
+        full_url = self._permission_groups_url.format(self.company_url)
+        return (await self._get_json(full_url)).get('permission_groups', [])
+
+    async def get_item(self, item):
+        return (await self._get_json(self._item_url_for(item))).get(item.zendesk_name, {})
+
+    async def iter_pages(self, full_url):
+        next_page = asyncio.ensure_future(self._get_json(full_url))
+        try:
+            while next_page:
+                page = await next_page
+                next_url = self._next_page_url(page)
+                next_page = asyncio.ensure_future(self._get_json(next_url)) if next_url else None
+                yield page
+        finally:
+            if next_page:
+                next_page.cancel()
+
+    async def iter_items(self, item, parent=None):
+        key = item.zendesk_group_list_prefix + item.zendesk_group
+        async for page in self.iter_pages(self._items_url_for(item, parent)):
+            for record in page.get(key, []):
+                yield record
+
+    async def get_items(self, item, parent=None):
+        return [record async for record in self.iter_items(item, parent)]
+
+    async def get_translation(self, item):
+        return (await self._get_json(self._item_translation_url_for(item))).get('translation', {})
+
+    async def put(self, item, data):
+        return (await self._send_json('PUT', self._item_url_for(item), data)).get(item.zendesk_name, {})
+
+    async def put_translation(self, item, data):
+        return (await self._send_json('PUT', self._item_translation_url_for(item), data)).get('translation', {})
+
+    async def post(self, item, data, parent=None):
+        return (await self._send_json('POST', self._items_url_for(item, parent), data)).get(item.zendesk_name, {})
+
+    async def post_attachment(self, attachment, attachment_filepath):
+        full_url = self._url_for(attachment.new_item_url)
+        # aiohttp closes a file once it is sent, every attempt builds its form from the content read once
+        content = await _run_blocking(utils.read_bytes, attachment_filepath)
+
+        def form():
+            data = aiohttp.FormData()
+            data.add_field('inline', 'true')
+            data.add_field('file', content, filename=os.path.basename(attachment_filepath))
+            return data
+        return await self._request('POST', full_url, data=form)
+
+    async def get_attachment(self, relative_path, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        async def save(response):
+            if response.status not in (200, zendesk.PARTIAL_CONTENT):
+                return response.status
+            size = self._expected_size(response.status, response.headers)
+            file, hasher = self._open_part(path, response.status, response.headers)
+            with file:
+                async for chunk in response.content.iter_chunked(utils.BLOCKSIZE):
+                    hasher.update(chunk)
+                    file.write(chunk)
+            return size, hasher
+
+        result = await self._send('GET', self._attachment_download_url(relative_path), save,
+                                  headers=self._range_headers(path))
+        if result == zendesk.RANGE_NOT_SATISFIABLE:
+            self._remove_part(path)
+            return await self.get_attachment(relative_path, path)
+        if isinstance(result, int):
+            return None
+        size, hasher = result
+        if not self._finish_part(path, size):
+            return None
+        return hasher.hexdigest()
+
+    async def delete(self, item):
+        return await self.raw_delete(self._delete_url_for(item))
+
+    async def raw_delete(self, full_url):
+        async def is_deleted(response):
+            return response.status == 200
+
+        return await self._send('DELETE', full_url, is_deleted, ssl=False)
+
+
+async def _run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+class AsyncFetcher(zendesk.Fetcher):
+
+    """
+    Fetches the same tree as `zendesk.Fetcher`, listing every node of a level concurrently on the event loop.
+    """
+
+    def __init__(self, req, processes=0):
+        self.req = req
+        self.processes = processes
+        self.converter = None
+        self.conversions = []
+        self.users = {}
+        self.user_requests = {}
+        self.user_segments = {}
+
+    def _get_user_by_uid(self, uid):
+        return self.users[uid]
+
+    async def _fetch_user(self, uid):
+        if uid not in self.user_requests:
+            self.user_requests[uid] = asyncio.ensure_future(self.req.get_user(uid))
+        self.users[uid] = await self.user_requests[uid]
+
+    async def _list(self, item, parent=None):
+        return [record async for record in self.req.iter_items(item, parent)]
+
+    async def _fetch_sections(self, category):
+        return self._add_sections(category, await self._list(model.Section, category))
+
+    async def _fetch_articles(self, section):
+        zendesk_articles = await self._list(model.Article, section)
+        await asyncio.gather(*[self._fetch_user(uid) for uid in {a['author_id'] for a in zendesk_articles}])
+        return self._add_articles(section, zendesk_articles)
+
+    async def _fetch_attachments(self, article):
+        return self._add_attachments(article, await self._list(model.Attachment, article))
+
+    async def _fan_out(self, parents, fetch_children):
+        children = []
+        for parent_children in await asyncio.gather(*[fetch_children(parent) for parent in parents]):
+            children.extend(parent_children)
+        return children
+
+    async def fetch(self):
+        self._set_user_segments(await self.req.get_user_segments())
+        with self._converting_bodies():
+            categories = self._add_categories(await self._list(model.Category))
+            sections = await self._fan_out(categories, self._fetch_sections)
+            articles = await self._fan_out(sections, self._fetch_articles)
+            await self._fan_out(articles, self._fetch_attachments)
+        return categories
+
+
+class AsyncPusher(zendesk.Pusher):
+
+    """
+    Pushes the tree like `zendesk.Pusher`, running every item whose parent is already pushed concurrently.
+    Hashing and body rendering run in the default executor so they don't block the event loop.
+    """
+
+    def __init__(self, req, fs, render_cache=None, hash_cache=None):
+        self.req = req
+        self.fs = fs
+        self.render_cache = render_cache
+        self.hash_cache = hash_cache
+        self.renderer = None
+        self.users = {}
+        self.user_segments = {}
+        self.permission_groups = {}
+
+    async def _get_user_id_from_email(self, email):
+        if email not in self.users:
+            self.users[email] = asyncio.ensure_future(self.req.search_user(self._user_query(email)))
+        return (await self.users[email])['id']
+
+    async def _push_new_article(self, article, parent=None):
+        data = self._new_article_data(article, await self._get_user_id_from_email(article.author))
+        self._save_article_meta(article, await self.req.post(article, data, parent))
+
+    async def _push_group_translation(self, item):
+        if self._have_attributes_changed(item.to_attributes(), item):
+            logging.info('Updating translation')
+            await self.req.put_translation(item, {'translation': item.to_translation()})
+            meta = await self.req.get_item(item)
+            item.meta = self.fs.save_json(item.meta_filepath, meta)
+
+    async def _check_and_update_section_category(self, section):
+        data = self._section_category_changes(section)
+        if data:
+            meta = await self.req.put(section, data)
+            section.meta = self.fs.save_json(section.meta_filepath, meta)
+
+    async def _push_group(self, item, parent=None):
+        if not item.zendesk_id:
+            meta = await self.req.post(item, {item.zendesk_name: item.to_dict()}, parent)
+            item.meta = self.fs.save_json(item.meta_filepath, meta)
+        else:
+            await self._push_group_translation(item)
+        if isinstance(item, model.Section):
+            await self._check_and_update_section_category(item)
+
+    async def _check_and_update_article_translation(self, article, attachments_changed):
+        data, body = await _run_blocking(self._article_translation_changes, article, attachments_changed)
+        if data:
+            await self.req.put_translation(article, {'translation': data})
+            self._save_article_translation(article, await self.req.get_item(article), body)
+
+    async def _check_and_update_article_attributes(self, article):
+        data = self._resolve_visibility(self._article_attribute_changes(article))
+        if 'author' in data:
+            data['author_id'] = await self._get_user_id_from_email(data.pop('author'))
+        if data:
+            meta = await self.req.put(article, {'article': data})
+            self._save_article_attributes(article, meta)
+
+    async def _push_article(self, article, section, attachments_changed):
+        logging.debug('Pushing article %s' % article.name)
+        await self._check_and_update_article_translation(article, attachments_changed)
+        await self._check_and_update_article_attributes(article)
+
+    async def _push_new_attachment(self, attachment):
+        attachment_full_path = self.fs.path_for(attachment.filepath)
+        meta = (await self.req.post_attachment(attachment, attachment_full_path))['article_attachment']
+        meta['md5_hash'] = await _run_blocking(self._md5_hash, attachment)
+        attachment.meta = self.fs.save_json(attachment.meta_filepath, meta)
+
+    async def _push_attachment(self, attachment):
+        if not attachment.zendesk_id:
+            await self._push_new_attachment(attachment)
+            return True
+        elif await _run_blocking(self._has_attachment_changed, attachment):
+            await self.req.delete(attachment)
+            await self._push_new_attachment(attachment)
+            return True
+        return False
+
+    async def _push_synced_article(self, article, section):
+        if article.synced != True:
+            logging.debug('Skipping un-synced article %s' % article.name)
+            return
+        if not article.zendesk_id:
+            logging.info('Pushing new article: %s' % article.name)
+            await self._push_new_article(article, section)
+        attachments_changed = await asyncio.gather(*[self._push_attachment(attachment)
+                                                     for attachment in article.attachments.values()])
+        await self._push_article(article, section, any(attachments_changed))
+        article.release()
+
+    async def _push_section(self, section, category):
+        await self._push_group(section, category)
+        await asyncio.gather(*[self._push_synced_article(article, section) for article in section.articles])
+
+    async def _push_category(self, category):
+        await self._push_group(category)
+        await asyncio.gather(*[self._push_section(section, category) for section in category.sections])
+
+    async def push(self, categories):
+        self._set_user_segments(await self.req.get_user_segments())
+        self._set_permission_groups(await self.req.get_permission_groups())
+        try:
+            await asyncio.gather(*[self._push_category(category) for category in categories])
+        finally:
+            self.fs.flush()
+            if self.hash_cache:
+                self.hash_cache.save()
+
+
+def client(company_uri, user, password, public_uri=None, concurrency=DEFAULT_CONCURRENCY):
+    return AsyncZendeskRequest(company_uri, user, password, public_uri, concurrency)
+
+
+def fetcher(req, processes=0):
+    return AsyncFetcher(req, processes)
+
+
+def pusher(req, fs, render_cache=None, hash_cache=None):
+    return AsyncPusher(req, fs, render_cache, hash_cache)
@@ -1,36 +1,169 @@
 import argparse
+import json
 import os
 import logging
 import configparser
+import time
 
 import zendesk
 import filesystem
+import manifest
+import profiling
+import render
+import scheduler
 
 DEFAULE_LOG_LEVEL = 'WARNING'
 CONFIG_FILE = 'zendesk-help-cms.config'
+MB = 1024 * 1024
+# items loaded ahead of the upload during an export
+LOADER_BUFFER_SIZE = 100
+
+
+def zendesk_client(args):
+    # every worker can hold a connection for its request plus one for a prefetched page
+    pool_size = max(args['pool_size'], 2 * args.get('jobs', 1))
+    return zendesk.client(args['company_uri'], args['user'], args['password'], args['public_uri'], pool_size)
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics-json', metavar='FILE',
+                        help='Write the request metrics (counts, latencies, status codes, bytes) as json to FILE')
+    parser.add_argument('--metrics-prometheus', metavar='FILE',
+                        help='Write the request metrics in the Prometheus text format to FILE')
+
+
+def report_metrics(args, req):
+    print(req.metrics.summary())
+    req.metrics.save(args.get('metrics_json'), args.get('metrics_prometheus'))
 
 
 class ImportTask(object):
 
+    def add_arguments(self, parser):
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='Number of parallel requests to Zendesk, default: 1')
+        parser.add_argument('-i', '--incremental', action='store_true', default=False,
+                            help='Only import articles changed since the last import')
+        parser.add_argument('-p', '--processes', type=int, default=0,
+                            help='Number of processes converting article bodies to markdown, default: 0 (convert inline)')
+        add_metrics_arguments(parser)
+
+    def _import(self, args, req, last_import):
+        fetcher = zendesk.fetcher(req, args['jobs'], args['processes'])
+        saver = filesystem.saver(args['root_folder'], req, args['jobs'])
+        if last_import:
+            logging.info('Importing articles changed since %s', time.ctime(last_import))
+            categories = fetcher.fetch_changed(last_import)
+            existing_paths = filesystem.loader(args['root_folder'], args['disable_article_comments']).article_paths()
+            saver.relocate_articles(categories, existing_paths)
+        else:
+            categories = fetcher.fetch()
+        saver.save(categories)
+
     def execute(self, args):
         logging.info('Running import task...')
-        categories = zendesk.fetcher(args['company_uri'], args['user'], args['password']).fetch()
-        zendesk_client = zendesk.ZendeskRequest(args['company_uri'], args['user'], args['password'], args['public_uri'])
-        filesystem.saver(args['root_folder'], zendesk_client).save(categories)
+        fs = filesystem.client(args['root_folder'])
+        last_import = fs.read_json(filesystem.SYNC_META_PATH).get('last_import') if args['incremental'] else None
+        # changes made while the import runs are picked up by the next one
+        import_time = int(time.time())
+        req = zendesk_client(args)
+        try:
+            self._import(args, req, last_import)
+        finally:
+            req.close()
+            report_metrics(args, req)
+        fs.save_json(filesystem.SYNC_META_PATH, {'last_import': import_time})
         logging.info('Import task completed')
 
 
 class ExportTask(object):
 
+    def add_arguments(self, parser):
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='Number of parallel requests to Zendesk, default: 1')
+        parser.add_argument('--full', action='store_true', default=False,
+                            help='Check every article, even the ones whose files did not change since the last export')
+        parser.add_argument('-p', '--processes', type=int, default=0,
+                            help='Number of processes rendering article bodies ahead of the upload, default: 0 (render inline)')
+        parser.add_argument('--plan', action='store_true', default=False,
+                            help='Only show what would be changed in Zendesk, without sending any request')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='Print the plan as json')
+        add_metrics_arguments(parser)
+
+    def _print_plan(self, plan):
+        for action in plan['actions']:
+            if action['action'] != 'skip':
+                print('%s %s %s: %s' % (action['action'], action['type'], action['path'], ', '.join(action['changes'])))
+        counts = {}
+        for action in plan['actions']:
+            key = (action['type'], action['action'])
+            counts[key] = counts.get(key, 0) + 1
+        for (item_type, action), count in sorted(counts.items()):
+            print('%s: %s %s' % (item_type, count, action))
+        print('requests: %s' % plan['requests'])
+        for stage, seconds in sorted(plan['timings'].items()):
+            print('%s: %.2fs' % (stage, seconds))
+
+    def _plan(self, args, loader, filesystem_client, sync_manifest, render_cache):
+        start = time.perf_counter()
+        categories = loader.load()
+        loading = time.perf_counter() - start
+        planner = zendesk.planner(filesystem_client, sync_manifest, render_cache, manifest.HashCache(filesystem_client))
+        plan = planner.plan(categories)
+        plan['timings']['loading'] = loading
+        if args['json']:
+            print(json.dumps(plan, indent=4, sort_keys=True))
+        else:
+            self._print_plan(plan)
+
     def execute(self, args):
         logging.info('Running export task...')
-        categories = filesystem.loader(args['root_folder'], args['disable_article_comments']).load()
-        filesystem_client = filesystem.client(args['root_folder'])
-        zendesk.pusher(args['company_uri'], args['user'], args['password'],
-                       filesystem_client).push(categories)
+        loader = filesystem.loader(args['root_folder'], args['disable_article_comments'])
+        filesystem_client = filesystem.buffered_client(args['root_folder'])
+        sync_manifest = manifest.Manifest(filesystem_client)
+        if args['full']:
+            sync_manifest.fingerprints = {}
+        render_cache = render.RenderCache(max_size=args['render_cache_size'] * MB) if args['render_cache_size'] else None
+        if args['plan']:
+            self._plan(args, loader, filesystem_client, sync_manifest, render_cache)
+            return
+        renderer = render.RenderPool(args['processes'], render_cache) if args['processes'] else None
+        req = zendesk_client(args)
+        try:
+            pusher = zendesk.pusher(req, filesystem_client, args['jobs'], sync_manifest, render_cache,
+                                    manifest.HashCache(filesystem_client), renderer)
+            pusher.push_stream(scheduler.buffered(loader.iter_tree(), LOADER_BUFFER_SIZE))
+        finally:
+            req.close()
+            report_metrics(args, req)
+            if renderer:
+                renderer.close()
         logging.info('Export task completed')
 
 
+class MigrateTask(object):
+
+    """
+    Moves the sync state from the hidden .meta files to a single SQLite database in the root folder. Once the
+    database exists every task uses it.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--remove', action='store_true', default=False,
+                            help='Remove the .meta files once they are copied to the database')
+
+    def execute(self, args):
+        logging.info('Running migrate task...')
+        fs = filesystem.state_client(args['root_folder'])
+        try:
+            count = fs.migrate(args['remove'])
+        finally:
+            fs.close()
+        print('%s meta files copied to %s' % (count, filesystem.STATE_DB_PATH))
+        logging.info('Migrate task completed')
+
+
 class ConfigTask(object):
 
     """
@@ -83,6 +216,7 @@ class ConfigTask(object):
 tasks = {
     'import': ImportTask(),
     'export': ExportTask(),
+    'migrate': MigrateTask(),
     'config': ConfigTask()
 }
 
@@ -92,8 +226,10 @@ def parse_args():
 
     # Subparsers
     subparsers = parser.add_subparsers(help='Task to be performed.', dest='task')
-    for task_parser in tasks:
-        subparsers.add_parser(task_parser)
+    for task_name, task in tasks.items():
+        task_parser = subparsers.add_parser(task_name)
+        if hasattr(task, 'add_arguments'):
+            task.add_arguments(task_parser)
 
     # Global settings
     parser.add_argument('-l', '--loglevel',
@@ -106,6 +242,10 @@ def parse_args():
     parser.add_argument('-f', '--force', help='Don\'t ask questions. YES all the way',
                         action='store_true', default=False)
     parser.add_argument('-v', '--version', help='Show version', action='store_true')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile the task, write the pstats to FILE and print the hottest functions by phase')
+    parser.add_argument('--profile-top', type=int, default=profiling.DEFAULT_TOP,
+                        help='Functions shown for each phase with --profile, default: %s' % profiling.DEFAULT_TOP)
 
     return parser.parse_args()
 
@@ -123,9 +263,22 @@ def parse_config(args):
     options['disable_article_comments'] = False if options.get('disable_article_comments', 0) == '0' else True
     if 'public_uri' not in options:
         options['public_uri'] = options['company_uri']
+    options['pool_size'] = int(options.get('pool_size', zendesk.DEFAULT_POOL_SIZE))
+    options['render_cache_size'] = int(options.get('render_cache_size', render.DEFAULT_CACHE_SIZE // MB))
     return options
 
 
+def profile_task(task, options):
+    profiler = profiling.TaskProfiler().start()
+    try:
+        task.execute(options)
+    finally:
+        stats = profiler.stop()
+        stats.dump_stats(options['profile'])
+        print(profiling.summary(stats, options['profile_top']))
+        logging.info('Profile written to %s', options['profile'])
+
+
 def main():
     args = parse_args()
     if args.version:
@@ -138,7 +291,10 @@ def main():
     task_name = options.get('task')
     if task_name:
         task = tasks[task_name]
-        task.execute(options)
+        if options.get('profile'):
+            profile_task(task, options)
+        else:
+            task.execute(options)
     else:
         print('No task provided, run with -h to see available options')
 
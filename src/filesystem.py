@@ -4,10 +4,23 @@ import os
 import logging
 import re
 import shutil
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import model
-import utils
 
+SYNC_META_PATH = '.sync.meta'
+STATE_DB_PATH = '.sync.db'
+DEFAULT_LOADER_JOBS = 8
+# articles of a section being loaded ahead of the consumer of `Loader.iter_tree`, per job
+LOADER_WINDOW = 2
+# metas buffered by BufferedFilesystemClient before they are written out
+DEFAULT_FLUSH_SIZE = 200
+# libyaml's loader is several times faster, fall back to the pure python one when pyyaml is built without it
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
 
 class FilesystemClient(object):
 
@@ -20,27 +33,36 @@ class FilesystemClient(object):
     def save_text(self, path, data):
         full_path = self.path_for(path)
         os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        with open(full_path, 'w') as fp:
+        # write next to the file and rename it over so a crash never leaves a half written file
+        tmp_path = os.path.join(os.path.dirname(full_path), '.%s.%s-%s.tmp' % (
+            os.path.basename(full_path), os.getpid(), threading.get_ident()))
+        with open(tmp_path, 'w') as fp:
             fp.write(data)
+        os.replace(tmp_path, full_path)
         return data
 
     def read_text(self, path):
         full_path = self.path_for(path)
-        if os.path.exists(full_path):
+        try:
             with open(full_path, 'r') as fp:
                 return fp.read()
-        else:
+        except FileNotFoundError:
             return ''
 
     def _path_exists(self, path):
         full_path = self.path_for(path)
         return os.path.exists(full_path)
 
-    def save_json(self, path, data):
+    def save_json(self, path, data, compact=None):
+        """
+        Merges `data` into the json file at `path`. `compact` is applied to the merged data before it is written.
+        """
         if self._path_exists(path):
             new_data = data
             data = self.read_json(path)
             data.update(new_data)
+        if compact:
+            data = compact(data)
         text = json.dumps(data, indent=4, sort_keys=True)
         self.save_text(path, text)
         return data
@@ -52,6 +74,12 @@ class FilesystemClient(object):
         else:
             return {}
 
+    def meta_reader(self, path):
+        """
+        Returns a function reading the meta files under `path`.
+        """
+        return self.read_json
+
     def save_yaml(self, path, data):
         if os.path.exists(path):
             new_data = data
@@ -64,23 +92,25 @@ class FilesystemClient(object):
     def read_yaml(self, path):
         text = self.read_text(path)
         if text:
-            return yaml.load(text, Loader=yaml.FullLoader)
+            return yaml.load(text, Loader=YAML_LOADER)
         else:
             return {}
 
-    def read_directories(self, path):
-        full_path = self.path_for(path)
-        if os.path.exists(full_path):
-            return [d for d in os.listdir(full_path) if os.path.isdir(os.path.join(full_path, d)) and not d.startswith('.')]
-        else:
+    def _scan(self, path):
+        try:
+            with os.scandir(self.path_for(path)) as entries:
+                return list(entries)
+        except FileNotFoundError:
             return []
 
+    def read_directories(self, path):
+        return [e.name for e in self._scan(path) if e.is_dir() and not e.name.startswith('.')]
+
     def read_files(self, path):
-        full_path = self.path_for(path)
-        if os.path.exists(full_path):
-            return [f for f in os.listdir(full_path) if os.path.isfile(os.path.join(full_path, f))]
-        else:
-            return []
+        return [e.name for e in self._scan(path) if e.is_file()]
+
+    def flush(self):
+        pass
 
     def remove(self, path):
         full_path = self.path_for(path)
@@ -99,23 +129,250 @@ class FilesystemClient(object):
             shutil.move(old_full_path, new_full_path)
 
 
+class BufferedFilesystemClient(FilesystemClient):
+
+    """
+    Keeps the json files saved with `save_json` in memory and writes them out in batches of `flush_size`
+    files and on `flush`. Several saves of the same file between two flushes only read it once and write
+    it once.
+    """
+
+    def __init__(self, root_folder, flush_size=DEFAULT_FLUSH_SIZE):
+        super().__init__(root_folder)
+        self.flush_size = flush_size
+        self.pending = {}
+        # the batch being written, still read from memory until it is on disk
+        self.flushing = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def _buffered(self, path):
+        if path in self.pending:
+            return self.pending[path]
+        if path in self.flushing:
+            return self.flushing[path]
+        return None
+
+    def save_json(self, path, data, compact=None):
+        with self.lock:
+            if path not in self.pending:
+                buffered = self._buffered(path)
+                self.pending[path] = dict(buffered) if buffered is not None else super().read_json(path)
+            self.pending[path].update(data)
+            if compact:
+                self.pending[path] = compact(self.pending[path])
+            saved = dict(self.pending[path])
+            full = len(self.pending) >= self.flush_size
+        if full:
+            self.flush()
+        return saved
+
+    def read_json(self, path):
+        with self.lock:
+            buffered = self._buffered(path)
+            if buffered is not None:
+                return dict(buffered)
+        return super().read_json(path)
+
+    def flush(self):
+        # one batch at a time so an older batch can't overwrite a newer one
+        with self.flush_lock:
+            with self.lock:
+                self.flushing, self.pending = self.pending, {}
+            for path, data in self.flushing.items():
+                self.save_text(path, json.dumps(data, indent=4, sort_keys=True))
+            with self.lock:
+                flushed, self.flushing = len(self.flushing), {}
+        logging.debug('Flushed %s meta files', flushed)
+
+
+class SqliteFilesystemClient(FilesystemClient):
+
+    """
+    Keeps every `.meta` file (Zendesk metadata, attachment hashes, the manifest) as a row of a single SQLite
+    database in the root folder instead of hidden files next to the items. Rows are indexed by their local
+    path, by file name and by Zendesk id. Everything else is still read from and written to the files.
+    """
+
+    def __init__(self, root_folder, db_path=STATE_DB_PATH):
+        super().__init__(root_folder)
+        self.lock = threading.Lock()
+        # shared by the loader and pusher threads, the lock serializes its use
+        self.db = sqlite3.connect(self.path_for(db_path), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta '
+                        '(path TEXT PRIMARY KEY, name TEXT, zendesk_id INTEGER, data TEXT NOT NULL)')
+        self._add_name_column()
+        self.db.execute('CREATE INDEX IF NOT EXISTS meta_zendesk_id ON meta (zendesk_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS meta_name ON meta (name, zendesk_id)')
+        self.db.commit()
+
+    def _add_name_column(self):
+        # databases created before the file name was indexed
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(meta)')]
+        if 'name' not in columns:
+            self.db.execute('ALTER TABLE meta ADD COLUMN name TEXT')
+            paths = [row[0] for row in self.db.execute('SELECT path FROM meta')]
+            self.db.executemany('UPDATE meta SET name = ? WHERE path = ?',
+                                [(os.path.basename(path), path) for path in paths])
+
+    def _is_meta(self, path):
+        return path.endswith(model.Base._meta_exp)
+
+    def _key(self, path):
+        return os.path.normpath(path)
+
+    def _zendesk_id(self, data):
+        try:
+            meta = json.loads(data)
+        except ValueError:
+            return None
+        return meta.get('id') if isinstance(meta, dict) else None
+
+    def _query(self, sql, *params):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def _write(self, sql, params):
+        with self.lock:
+            with self.db:
+                self.db.executemany(sql, params)
+
+    def save_text(self, path, data):
+        if not self._is_meta(path):
+            return super().save_text(path, data)
+        self._write('INSERT OR REPLACE INTO meta (path, name, zendesk_id, data) VALUES (?, ?, ?, ?)',
+                    [self._row(path, data)])
+        return data
+
+    def _row(self, path, data):
+        return self._key(path), os.path.basename(path), self._zendesk_id(data), data
+
+    def read_text(self, path):
+        if not self._is_meta(path):
+            return super().read_text(path)
+        rows = self._query('SELECT data FROM meta WHERE path = ?', self._key(path))
+        return rows[0][0] if rows else ''
+
+    def _path_exists(self, path):
+        if not self._is_meta(path):
+            return super()._path_exists(path)
+        return bool(self._query('SELECT 1 FROM meta WHERE path = ?', self._key(path)))
+
+    def paths_for_zendesk_id(self, zendesk_id):
+        return [row[0] for row in self._query('SELECT path FROM meta WHERE zendesk_id = ?', zendesk_id)]
+
+    def meta_paths(self, meta_filename):
+        """
+        Maps the Zendesk id of every item whose meta is named `meta_filename` to the item's path.
+        """
+        rows = self._query('SELECT path, zendesk_id FROM meta WHERE name = ? AND zendesk_id IS NOT NULL', meta_filename)
+        return {zendesk_id: os.path.dirname(path) for path, zendesk_id in rows}
+
+    def meta_reader(self, path):
+        """
+        Reads every meta under `path` with a single range query on the path index and returns a function
+        looking them up.
+        """
+        prefix = self._key(path)
+        if prefix == '.':
+            rows = self._query('SELECT path, data FROM meta')
+        else:
+            # every path starting with `prefix/` sorts between it and `prefix` followed by the next character
+            rows = self._query('SELECT path, data FROM meta WHERE path > ? AND path < ?',
+                               prefix + os.sep, prefix + chr(ord(os.sep) + 1))
+        metas = dict(rows)
+
+        def read_meta(meta_path):
+            data = metas.get(self._key(meta_path))
+            return json.loads(data) if data else {}
+        return read_meta
+
+    def remove(self, path):
+        if not self._is_meta(path):
+            return super().remove(path)
+        self._write('DELETE FROM meta WHERE path = ?', [(self._key(path),)])
+
+    def remove_dir(self, path):
+        super().remove_dir(path)
+        prefix = self._key(path) + os.sep
+        self._write('DELETE FROM meta WHERE substr(path, 1, ?) = ?', [(len(prefix), prefix)])
+
+    def move(self, old_path, new_path):
+        super().move(old_path, new_path)
+        old_prefix, new_prefix = self._key(old_path) + os.sep, self._key(new_path) + os.sep
+        self._write('UPDATE meta SET path = ? || substr(path, ?) WHERE substr(path, 1, ?) = ?',
+                    [(new_prefix, len(old_prefix) + 1, len(old_prefix), old_prefix)])
+
+    def migrate(self, remove=False):
+        """
+        Copies every `.meta` file under the root folder to the database, removing the files if `remove` is set.
+        Returns the number of files copied.
+        """
+        paths = []
+        for dirpath, _, filenames in os.walk(self.root_folder):
+            for filename in filenames:
+                if self._is_meta(filename):
+                    paths.append(os.path.relpath(os.path.join(dirpath, filename), self.root_folder))
+        rows = []
+        for path in paths:
+            rows.append(self._row(path, super().read_text(path)))
+        self._write('INSERT OR REPLACE INTO meta (path, name, zendesk_id, data) VALUES (?, ?, ?, ?)', rows)
+        if remove:
+            for path in paths:
+                super().remove(path)
+        return len(rows)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
 class Saver(object):
 
-    def __init__(self, fs, zd):
+    def __init__(self, fs, zd, jobs=1):
         self.fs = fs
         self.zd = zd
+        self.jobs = jobs
 
     def _save_item(self, item):
-        self.fs.save_json(item.meta_filepath, item.meta)
+        self.fs.save_json(item.meta_filepath, item.meta, item.compact_meta)
         self.fs.save_yaml(item.attributes_filepath, item.to_attributes())
 
     def _save_attachment(self, attachment):
         attachment_path = self.fs.path_for(attachment.filepath)
-        self.zd.get_attachment(attachment.meta['relative_path'], attachment_path)
-        attachment.meta['md5_hash'] = utils.md5_hash(attachment_path)
+        md5_hash = self.zd.get_attachment(attachment.meta['relative_path'], attachment_path)
+        if md5_hash is None:
+            logging.error('Attachment %s could not be downloaded' % attachment.name)
+            return
+        attachment.meta['md5_hash'] = md5_hash
         self.fs.save_json(attachment.meta_filepath, attachment.meta)
+        logging.info('Attachment %s saved' % attachment.name)
+
+    def relocate_articles(self, categories, existing_paths):
+        """
+        Moves the local directory of every article whose Zendesk id is in `existing_paths` to the article's current
+        path, so articles renamed or moved to another section are not duplicated.
+        """
+        for category in categories:
+            for section in category.sections:
+                for article in section.articles:
+                    old_path = existing_paths.get(article.zendesk_id)
+                    if not old_path or old_path == article.path:
+                        continue
+                    if self.fs._path_exists(article.path):
+                        logging.warning('Article %s moved to existing %s, leaving %s in place' % (article.name, article.path, old_path))
+                        continue
+                    logging.info('Article %s moved from %s to %s' % (article.name, old_path, article.path))
+                    os.makedirs(self.fs.path_for(section.path), exist_ok=True)
+                    self.fs.move(old_path, article.path)
 
     def save(self, categories):
+        """
+        Saves the tree, downloading the attachments on a pool of `jobs` workers once their articles are saved.
+        """
+        attachments = []
         for category in categories:
             self._save_item(category)
             logging.info('Category %s saved' % category.name)
@@ -127,19 +384,21 @@ class Saver(object):
                     logging.info('Article %s saved' % article.name)
                     self.fs.save_text(article.body_filepath, article.body)
                     self.fs.save_text(article.html_filepath, article.html)
-                    for _, attachment in article.attachments.items():
-                        self._save_attachment(attachment)
-                        logging.info('Attachment %s saved' % attachment.name)
+                    attachments.extend(article.attachments.values())
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            # consume the results so a failed download is raised here
+            list(pool.map(self._save_attachment, attachments))
 
 class Loader(object):
 
-    def __init__(self, fs, disable_comments):
+    def __init__(self, fs, disable_comments, jobs=DEFAULT_LOADER_JOBS):
         self.fs = fs
         self.disable_comments = False if disable_comments == 0 else True
+        self.jobs = jobs
 
-    def _load_category(self, category_dirname):
+    def _load_category(self, category_dirname, read_meta=None):
         meta_path, attributes_path = model.Category.filepaths_from_path(category_dirname)
-        meta = self.fs.read_json(meta_path)
+        meta = (read_meta or self.fs.read_json)(meta_path)
         attributes = self.fs.read_yaml(attributes_path)
         attributes =  {
             'name': attributes.get('name', category_dirname),
@@ -147,9 +406,9 @@ class Loader(object):
         }
         return model.Category.from_dict(meta, attributes, category_dirname)
 
-    def _load_section(self, category, section_path, section_dirname):
+    def _load_section(self, category, section_path, section_dirname, read_meta=None):
         meta_path, attributes_path = model.Section.filepaths_from_path(category, section_dirname)
-        meta = self.fs.read_json(meta_path)
+        meta = (read_meta or self.fs.read_json)(meta_path)
         attributes = self.fs.read_yaml(attributes_path)
         attributes = {
             'name': attributes.get('name', section_dirname),
@@ -157,9 +416,9 @@ class Loader(object):
         }
         return model.Section.from_dict(category, meta, attributes, section_dirname)
 
-    def _load_article(self, section, article_path, article_dirname):
+    def _load_article(self, section, article_path, article_dirname, read_meta=None):
         meta_path, attributes_path, body_path = model.Article.filepaths_from_path(section, article_dirname)
-        meta = self.fs.read_json(meta_path)
+        meta = (read_meta or self.fs.read_json)(meta_path)
         attributes = self.fs.read_yaml(attributes_path)
         attributes = {
             'name': attributes.get('name', article_dirname),
@@ -169,60 +428,141 @@ class Loader(object):
             'visibility': attributes.get('visibility', 'signed-in-users'),
             'comments_disabled': attributes.get('comments_disabled', self.disable_comments)
         }
-        body = self.fs.read_text(body_path)
-        return model.Article.from_dict(section, meta, attributes, body, article_dirname)
+        article = model.Article.from_dict(section, meta, attributes, None, article_dirname)
+        # only the articles that are pushed need their body, read it when it's first used
+        article.lazy_body(partial(self.fs.read_text, body_path))
+        return article
 
-    def _load_attachment(self, article, attachment_name):
+    def _load_attachment(self, article, attachment_name, read_meta=None):
         meta_path = model.Attachment.filepaths_from_path(article, attachment_name)
-        meta = self.fs.read_json(meta_path)
-        return model.Attachment.from_dict(article, meta, attachment_name)
+        attachment = model.Attachment(article, attachment_name)
+        attachment.lazy_meta(partial(read_meta or self.fs.read_json, meta_path))
+        return attachment
     
     def _filter_attachment_names(self, files):
         return [a for a in files if not a.endswith(model.Attachment._meta_exp) and not a.startswith('.')]
 
-    def _fill_category(self, category_dirname):
-        category = self._load_category(category_dirname)
-        self._fill_sections(category)
-        return category
-
-    def _fill_sections(self, category):
-        for section_dirname in self.fs.read_directories(category.path):
-            section_path = os.path.join(category.path, section_dirname)
-            section = self._load_section(category, section_path, section_dirname)
-            category.sections.append(section)
-            self._fill_articles(section)
-
-    def _fill_articles(self, section):
-        for article_dirname in self.fs.read_directories(section.path):
-            article_path = os.path.join(section.path, article_dirname)
-            article = self._load_article(section, article_path, article_dirname)
-            section.articles.append(article)
-            self._fill_attachments(article)
-
-    def _fill_attachments(self, article):
+    def _fill_section(self, category, section_dirname, read_meta=None):
+        section_path = os.path.join(category.path, section_dirname)
+        return self._load_section(category, section_path, section_dirname, read_meta)
+
+    def _fill_article(self, section, article_dirname, read_meta=None):
+        article_path = os.path.join(section.path, article_dirname)
+        article = self._load_article(section, article_path, article_dirname, read_meta)
+        self._fill_attachments(article, read_meta)
+        return article
+
+    def _fan_out(self, pool, parents, fill_child):
+        """
+        Lists the directories of every parent and loads them with `fill_child(parent, dirname)` on the pool,
+        returning the children in directory order.
+        """
+        dirnames = pool.map(self.fs.read_directories, [parent.path for parent in parents])
+        pairs = [(parent, dirname) for parent, parent_dirnames in zip(parents, dirnames) for dirname in parent_dirnames]
+        return list(pool.map(lambda pair: fill_child(*pair), pairs))
+
+    def _fill_attachments(self, article, read_meta=None):
         attachments_path = model.Attachment.path_from_article(article)
         attachment_names = self._filter_attachment_names(self.fs.read_files(attachments_path))
         for attachment_name in attachment_names:
-            attachment = self._load_attachment(article, attachment_name)
+            attachment = self._load_attachment(article, attachment_name, read_meta)
             article.attachments[attachment_name] = attachment
 
+    def article_paths(self):
+        """
+        Maps the Zendesk id of every local article to its path, reading only the article meta files.
+        """
+        if isinstance(self.fs, SqliteFilesystemClient):
+            return self.fs.meta_paths(model.Article.meta_filename + model.Article._meta_exp)
+        paths = {}
+        for category_dirname in self.fs.read_directories(self.fs.root_folder):
+            for section_dirname in self.fs.read_directories(category_dirname):
+                section_path = os.path.join(category_dirname, section_dirname)
+                for article_dirname in self.fs.read_directories(section_path):
+                    article_path = os.path.join(section_path, article_dirname)
+                    meta = self.fs.read_json(os.path.join(article_path, model.Article.meta_filename + model.Article._meta_exp))
+                    if meta.get('id'):
+                        paths[meta['id']] = article_path
+        return paths
+
+    def iter_tree(self):
+        """
+        Yields every category, section and article as it is loaded, each after its parent. Sections and articles
+        are not added to their parent so nothing is kept once the consumer is done with it. The articles of a
+        section are loaded on `jobs` threads.
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for category_dirname in self.fs.read_directories(self.fs.root_folder):
+                category = self._load_category(category_dirname)
+                yield category
+                for section_dirname in self.fs.read_directories(category.path):
+                    section = self._fill_section(category, section_dirname)
+                    yield section
+                    # the metas of the section's articles and attachments are read at once
+                    read_meta = self.fs.meta_reader(section.path)
+                    yield from self._map_ahead(pool, partial(self._fill_article, section, read_meta=read_meta),
+                                               self.fs.read_directories(section.path))
+
+    def _map_ahead(self, pool, fn, items):
+        """
+        Like `pool.map` but submits at most `LOADER_WINDOW` calls per job ahead of the consumer, so a large
+        section is not loaded all at once.
+        """
+        window = deque()
+        try:
+            for item in items:
+                if len(window) >= self.jobs * LOADER_WINDOW:
+                    yield window.popleft().result()
+                window.append(pool.submit(fn, item))
+            while window:
+                yield window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
+
     def load(self):
-        categories = []
-        for category_name in self.fs.read_directories(self.fs.root_folder):
-            category = self._fill_category(category_name)
-            categories.append(category)
+        """
+        Loads the tree one level at a time, reading and parsing the files of a level on `jobs` threads.
+        With the SQLite store every meta is read in a single query.
+        """
+        read_meta = self.fs.meta_reader('')
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            categories = list(pool.map(partial(self._load_category, read_meta=read_meta),
+                                       self.fs.read_directories(self.fs.root_folder)))
+            for section in self._fan_out(pool, categories, partial(self._fill_section, read_meta=read_meta)):
+                section.category.sections.append(section)
+            sections = [s for c in categories for s in c.sections]
+            for article in self._fan_out(pool, sections, partial(self._fill_article, read_meta=read_meta)):
+                article.section.articles.append(article)
         return categories
 
 
-def saver(root_folder, zendesk_client=None):
-    fs = FilesystemClient(root_folder)
-    return Saver(fs, zendesk_client)
+def has_state_db(root_folder):
+    return os.path.exists(os.path.join(root_folder, STATE_DB_PATH))
+
 
+def saver(root_folder, zendesk_client=None, jobs=1):
+    fs = client(root_folder)
+    return Saver(fs, zendesk_client, jobs)
 
-def loader(root_folder, disable_comments):
-    fs = FilesystemClient(root_folder)
-    return Loader(fs, disable_comments)
+
+def loader(root_folder, disable_comments, jobs=DEFAULT_LOADER_JOBS):
+    fs = client(root_folder)
+    return Loader(fs, disable_comments, jobs)
 
 
 def client(root_folder):
+    if has_state_db(root_folder):
+        return SqliteFilesystemClient(root_folder)
     return FilesystemClient(root_folder)
+
+
+def buffered_client(root_folder, flush_size=DEFAULT_FLUSH_SIZE):
+    # the database already coalesces the writes
+    if has_state_db(root_folder):
+        return SqliteFilesystemClient(root_folder)
+    return BufferedFilesystemClient(root_folder, flush_size)
+
+
+def state_client(root_folder):
+    return SqliteFilesystemClient(root_folder)
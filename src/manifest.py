@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import utils
+
+MANIFEST_PATH = '.manifest.meta'
+HASH_CACHE_PATH = '.hashes.meta'
+DEFAULT_HASH_JOBS = 4
+
+
+class Manifest(object):
+
+    """
+    Remembers a fingerprint of the local sources of every article pushed to Zendesk. The fingerprint is made of
+    stat data and already loaded attributes only, so telling an article has not changed since its last push
+    does not read or render anything.
+    """
+
+    def __init__(self, fs, path=MANIFEST_PATH):
+        super().__init__()
+        self.fs = fs
+        self.path = path
+        self.fingerprints = fs.read_json(path)
+        self.observed = {}
+        self.pushed = {}
+
+    def _stat(self, path):
+        try:
+            stat = os.stat(self.fs.path_for(path))
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _source_paths(self, article):
+        paths = [article.body_filepath, article.attributes_filepath, article.meta_filepath]
+        for name in sorted(article.attachments):
+            attachment = article.attachments[name]
+            paths.extend([attachment.filepath, attachment.meta_filepath])
+        return paths
+
+    def _meta_paths(self, article):
+        return {article.meta_filepath} | {attachment.meta_filepath for attachment in article.attachments.values()}
+
+    def is_unchanged(self, article):
+        fingerprint = self.fingerprints.get(article.path)
+        # fingerprints are stored as json so compare them in their json form
+        return fingerprint is not None and fingerprint == json.loads(json.dumps(self.fingerprint(article)))
+
+    def _attributes(self, article):
+        return [article.section.zendesk_id, article.title, article.draft, article.author,
+                article.visibility, article.comments_disabled]
+
+    def fingerprint(self, article):
+        return [self._attributes(article)] + [[path, self._stat(path)] for path in self._source_paths(article)]
+
+    def _stat_sources(self, article):
+        meta_paths = self._meta_paths(article)
+        return {path: self._stat(path) for path in self._source_paths(article) if path not in meta_paths}
+
+    def observe(self, article):
+        """
+        Stats the files of `article` that are edited by hand before they are read to push it, so a change made
+        while the export runs is pushed by the next one instead of being recorded as already pushed.
+        """
+        self.observed[article.path] = self._stat_sources(article)
+
+    def update(self, article):
+        sources = self.observed.pop(article.path, None)
+        if sources is None:
+            sources = self._stat_sources(article)
+        # the meta files may still be buffered, stat them when saving
+        self.pushed[article.path] = (self._attributes(article), self._source_paths(article), sources)
+
+    def save(self):
+        for path, (attributes, paths, sources) in self.pushed.items():
+            self.fingerprints[path] = [attributes] + [
+                [source, sources[source] if source in sources else self._stat(source)] for source in paths]
+        self.pushed = {}
+        self.fs.save_text(self.path, json.dumps(self.fingerprints, sort_keys=True))
+
+
+class HashCache(object):
+
+    """
+    Remembers the md5 hash of local files along with their size, modification time and inode, so a file
+    whose stat data did not change is not read again to hash it.
+    """
+
+    def __init__(self, fs, path=HASH_CACHE_PATH, jobs=DEFAULT_HASH_JOBS):
+        super().__init__()
+        self.fs = fs
+        self.path = path
+        self.jobs = jobs
+        self.hashes = fs.read_json(path)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.futures = {}
+
+    def _stat(self, path):
+        stat = os.stat(self.fs.path_for(path))
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def md5_hash(self, path):
+        with self.lock:
+            future = self.futures.pop(path, None)
+        if future is not None:
+            # a failed hash is retried below and raises there
+            wait([future])
+        return self._md5_hash(path)
+
+    def _md5_hash(self, path):
+        stat = self._stat(path)
+        with self.lock:
+            entry = self.hashes.get(path)
+        if entry is not None and entry[:3] == stat:
+            return entry[3]
+        md5_hash = utils.md5_hash(self.fs.path_for(path))
+        with self.lock:
+            self.hashes[path] = stat + [md5_hash]
+        return md5_hash
+
+    def prefetch(self, paths):
+        """
+        Hashes the files of `paths` missing from the cache on `jobs` threads.
+        """
+        with self.lock:
+            misses = [path for path in paths if path not in self.hashes or self.hashes[path][:3] != self._stat(path)]
+        if misses:
+            logging.info('Hashing %s changed attachments', len(misses))
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                list(pool.map(self.md5_hash, misses))
+
+    def submit(self, paths):
+        """
+        Starts hashing the files of `paths` on `jobs` background threads, `md5_hash` waits for them.
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+            for path in paths:
+                if path not in self.futures:
+                    self.futures[path] = self.executor.submit(self._md5_hash, path)
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+            futures, self.futures = self.futures, {}
+        for future in futures.values():
+            future.cancel()
+        if executor:
+            executor.shutdown()
+
+    def save(self):
+        with self.lock:
+            self.fs.save_text(self.path, json.dumps(self.hashes, sort_keys=True))
@@ -0,0 +1,182 @@
+import json
+import re
+import threading
+import urllib.parse
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+PROMETHEUS_PREFIX = 'zendesk'
+
+# ids and attachment file names vary per request, they are replaced to group requests by endpoint
+ID_RE = re.compile(r'/\d+(?=/|\.json|$)')
+ATTACHMENT_NAME_RE = re.compile(r'(/hc/article_attachments/\{id\})/.+')
+
+
+def endpoint(url):
+    path = urllib.parse.urlsplit(url).path
+    path = ID_RE.sub('/{id}', path)
+    return ATTACHMENT_NAME_RE.sub(r'\1/{name}', path)
+
+
+def payload_size(body):
+    if body is None or hasattr(body, 'read'):
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join('%s="%s"' % (name, _label_value(value)) for name, value in sorted(labels.items())) + '}'
+
+
+class EndpointMetrics(object):
+
+    __slots__ = ('requests', 'retries', 'statuses', 'seconds', 'buckets', 'bytes_sent', 'bytes_received')
+
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+        self.retries = 0
+        self.statuses = {}
+        self.seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def errors(self):
+        return sum(count for status, count in self.statuses.items() if status == 'error' or int(status) >= 400)
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'statuses': {str(status): count for status, count in self.statuses.items()},
+            'seconds': self.seconds,
+            'latency_buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS], self.buckets)),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received
+        }
+
+
+class RequestMetrics(object):
+
+    """
+    Counts the requests of one Zendesk client per method and endpoint: attempts, retries, status codes
+    ('error' when no response was received), a latency histogram and the payload bytes in both directions.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def _endpoint(self, method, url):
+        key = (method.upper(), endpoint(url))
+        entry = self.endpoints.get(key)
+        if entry is None:
+            entry = self.endpoints[key] = EndpointMetrics()
+        return entry
+
+    def record(self, method, url, status, seconds, bytes_sent=0, bytes_received=0):
+        with self.lock:
+            entry = self._endpoint(method, url)
+            entry.requests += 1
+            entry.statuses[status] = entry.statuses.get(status, 0) + 1
+            entry.seconds += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    entry.buckets[i] += 1
+                    break
+            entry.bytes_sent += bytes_sent
+            entry.bytes_received += bytes_received
+
+    def record_retry(self, method, url):
+        with self.lock:
+            self._endpoint(method, url).retries += 1
+
+    def totals(self):
+        with self.lock:
+            entries = list(self.endpoints.values())
+        return {
+            'requests': sum(entry.requests for entry in entries),
+            'retries': sum(entry.retries for entry in entries),
+            'errors': sum(entry.errors() for entry in entries),
+            'seconds': sum(entry.seconds for entry in entries),
+            'bytes_sent': sum(entry.bytes_sent for entry in entries),
+            'bytes_received': sum(entry.bytes_received for entry in entries)
+        }
+
+    def summary(self, top=10):
+        """
+        Human readable totals and the `top` endpoints that took the most time waiting for Zendesk.
+        """
+        totals = self.totals()
+        lines = ['%s requests (%s retried, %s error responses) in %.1fs, %.1f kB sent, %.1f kB received' % (
+            totals['requests'], totals['retries'], totals['errors'], totals['seconds'],
+            totals['bytes_sent'] / 1024, totals['bytes_received'] / 1024)]
+        with self.lock:
+            entries = sorted(self.endpoints.items(), key=lambda item: item[1].seconds, reverse=True)
+        for (method, path), entry in entries[:top]:
+            statuses = ' '.join('%s:%s' % (status, count) for status, count in sorted(entry.statuses.items(),
+                                                                                     key=lambda item: str(item[0])))
+            lines.append('  %-6s %-60s %6d requests %8.1fs %7.0fms avg  %s' % (
+                method, path, entry.requests, entry.seconds, 1000 * entry.seconds / entry.requests, statuses))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        with self.lock:
+            endpoints = [dict(entry.to_dict(), method=method, endpoint=path)
+                         for (method, path), entry in sorted(self.endpoints.items())]
+        return {'totals': self.totals(), 'endpoints': endpoints}
+
+    def to_prometheus(self):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        metrics = {
+            'requests_total': ('counter', 'Requests sent to Zendesk, including retried attempts.', []),
+            'request_retries_total': ('counter', 'Requests sent to Zendesk again after a failed attempt.', []),
+            'request_duration_seconds': ('histogram', 'Time until Zendesk answered.', []),
+            'request_bytes_total': ('counter', 'Payload bytes sent to Zendesk.', []),
+            'response_bytes_total': ('counter', 'Payload bytes received from Zendesk.', [])
+        }
+        with self.lock:
+            for (method, path), entry in sorted(self.endpoints.items()):
+                labels = {'method': method, 'endpoint': path}
+                for status, count in sorted(entry.statuses.items(), key=lambda item: str(item[0])):
+                    metrics['requests_total'][2].append(('', dict(labels, status=status), count))
+                metrics['request_retries_total'][2].append(('', labels, entry.retries))
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, entry.buckets):
+                    cumulative += count
+                    metrics['request_duration_seconds'][2].append(('_bucket', dict(labels, le=bound), cumulative))
+                metrics['request_duration_seconds'][2].extend([
+                    ('_bucket', dict(labels, le='+Inf'), entry.requests),
+                    ('_sum', labels, entry.seconds),
+                    ('_count', labels, entry.requests)])
+                metrics['request_bytes_total'][2].append(('', labels, entry.bytes_sent))
+                metrics['response_bytes_total'][2].append(('', labels, entry.bytes_received))
+        lines = []
+        for name, (metric_type, help_text, samples) in metrics.items():
+            name = PROMETHEUS_PREFIX + '_' + name
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for suffix, labels, value in samples:
+                lines.append('%s%s%s %s' % (name, suffix, _labels(**labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, json_path=None, prometheus_path=None):
+        if json_path:
+            with open(json_path, 'w') as fp:
+                json.dump(self.to_dict(), fp, indent=4, sort_keys=True)
+        if prometheus_path:
+            with open(prometheus_path, 'w') as fp:
+                fp.write(self.to_prometheus())
@@ -1,12 +1,14 @@
+import logging
 import os
 import utils
-import markdown
-import re
+import render
 
 DEFAULT_LOCALE = 'en-US'
 
 
 class Base(object):
+    # a help center has tens of thousands of these, keep them small
+    __slots__ = ('name', 'filename', '_meta', '_meta_loader')
     _meta_exp = '.meta'
     _attributes_exp = '.yaml'
     _zendesk_id_key = 'id'
@@ -20,18 +22,42 @@ class Base(object):
         self.name = name
         self.filename = filename
         self._meta = {}
+        self._meta_loader = None
 
     @property
     def meta(self):
+        if self._meta is None:
+            self._meta = self._meta_loader() or {}
         return self._meta
         
     @meta.setter
     def meta(self, value):
         self._meta = value or {}
 
+    def lazy_meta(self, loader):
+        """
+        Leaves the meta to be read by `loader` on first access.
+        """
+        self._meta_loader = loader
+        self._meta = None
+
+    @staticmethod
+    def compact_meta(meta):
+        """
+        Drops what doesn't need to be kept from a meta before it is saved, nothing for most items.
+        """
+        return meta
+
+    def release(self):
+        """
+        Drops the content that can be loaded again, it is read again on the next access.
+        """
+        if self._meta_loader:
+            self._meta = None
+
     @property
     def zendesk_id(self):
-        return self._meta.get(self._zendesk_id_key)
+        return self.meta.get(self._zendesk_id_key)
 
     @property
     def meta_filepath(self):
@@ -43,6 +69,7 @@ class Base(object):
 
 
 class Group(Base):
+    __slots__ = ('description',)
     meta_filename = '.group'
     attributes_filename = '__group__'
 
@@ -73,6 +100,7 @@ class Group(Base):
 
 
 class Category(Group):
+    __slots__ = ('sections',)
     zendesk_name = 'category'
     zendesk_group = 'categories'
 
@@ -102,6 +130,7 @@ class Category(Group):
 
 
 class Section(Group):
+    __slots__ = ('articles', 'category')
     zendesk_name = 'section'
     zendesk_group = 'sections'
 
@@ -132,6 +161,8 @@ class Section(Group):
 
 
 class Article(Base):
+    __slots__ = ('attachments', '_body', '_body_loader', 'section', 'synced', 'draft', 'author', 'visibility', 'title',
+                 'comments_disabled', 'html')
     zendesk_name = 'article'
     zendesk_group = 'articles'
 
@@ -143,7 +174,8 @@ class Article(Base):
     def __init__(self, section, attributes, body, filename):
         super().__init__(attributes['name'], filename)
         self.attachments = {}
-        self.body = body
+        self._body = body
+        self._body_loader = None
         self.section = section
         self.synced = attributes['synced']
         self.draft = attributes['draft']
@@ -153,6 +185,30 @@ class Article(Base):
         self.comments_disabled = attributes['comments_disabled']
         self.html = ''
 
+    @property
+    def body(self):
+        if self._body is None and self._body_loader:
+            self._body = self._body_loader()
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+
+    def lazy_body(self, loader):
+        """
+        Leaves the body to be read by `loader` on first access.
+        """
+        self._body_loader = loader
+        self._body = None
+
+    def release(self):
+        super().release()
+        if self._body_loader:
+            self._body = None
+        for attachment in self.attachments.values():
+            attachment.release()
+
     @property
     def body_filepath(self):
         return os.path.join(self.path, self.body_filename)
@@ -183,14 +239,24 @@ class Article(Base):
             attributes['synced'] = False
         return attributes
 
-    def generate_body(self):
-        body = self.body
-        for _, attachment in self.attachments.items():
-            zendesk_url = '('+attachment.meta['relative_path']
-            regex = r'\((./|/|)attachments/'+attachment.filename
-            body = re.sub(regex, zendesk_url, body)
+    def attachment_links(self):
+        return {name: attachment.meta['relative_path'] for name, attachment in self.attachments.items()}
 
-        body = markdown.markdown(body, extensions=['pymdownx.superfences', 'tables', 'mdx_truly_sane_lists'])
+    def generate_body(self, cache=None):
+        links = self.attachment_links()
+        if cache:
+            key = render.render_key(self.body, links)
+            cached_body = cache.get(key)
+            if cached_body is not None:
+                return cached_body
+
+        body, missing = render.rewrite_attachment_links(self.body, links)
+        for filename in missing:
+            logging.warning('Article %s links to missing attachment %s' % (self.name, filename))
+
+        body = render.render_markdown(body)
+        if cache:
+            cache.put(key, body)
         return body
 
     def paths(self):
@@ -211,14 +277,28 @@ class Article(Base):
     @staticmethod
     def from_dict(section, meta, attributes, body, filename):
         article = Article(section, attributes, body, filename)
-        article.meta = meta
+        article.meta = Article.compact_meta(meta)
         return article
 
+    @staticmethod
+    def compact_meta(meta):
+        """
+        Drops the copies of the body from an article meta: the HTML body Zendesk returns is saved next to the
+        article and only a hash of the last pushed body is needed to detect changes. Metas saved by older
+        versions still have the whole pushed body under `generated_body`, it is replaced by its hash.
+        """
+        meta.pop('body', None)
+        generated_body = meta.pop('generated_body', None)
+        if generated_body is not None and 'generated_body_hash' not in meta:
+            meta['generated_body_hash'] = utils.md5_text(generated_body)
+        return meta
+
     @property
     def new_item_url(self):
         return 'sections/{}/articles.json'.format(self.section.zendesk_id)
 
 class Attachment(Base):
+    __slots__ = ('article',)
     zendesk_name = 'attachment'
     zendesk_group = 'attachments'
     zendesk_group_list_prefix = 'article_'
@@ -0,0 +1,93 @@
+import cProfile
+import io
+import pstats
+import re
+import sys
+import threading
+
+DEFAULT_TOP = 10
+
+# functions are put in the first phase whose pattern matches their file and name, in that order
+PHASES = [
+    ('network wait', re.compile(r'requests|urllib3|http/client|socket|/ssl\.py|_ssl\.|aiohttp|selectors|select\.')),
+    ('render', re.compile(r'render\.py|markdown|pymdownx|mdx_truly_sane_lists|html2text')),
+    ('hash', re.compile(r'manifest\.py|hashlib|md5')),
+    ('load', re.compile(r'filesystem\.py|yaml|json|scandir|posix\.|_io\.|io\.open|sqlite3')),
+]
+OTHER_PHASE = 'other'
+
+
+def phase_of(function):
+    filename, line, name = function
+    text = '%s:%s' % (filename, name)
+    for phase, pattern in PHASES:
+        if pattern.search(text):
+            return phase
+    return OTHER_PHASE
+
+
+class TaskProfiler(object):
+
+    """
+    Profiles the calling thread and every thread started while it runs, each with its own `cProfile.Profile`,
+    and merges them when stopped. Work done in worker processes is not profiled.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def _new_profile(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        return profile
+
+    def _profile_thread(self, frame, event, arg):
+        # installed by threading in every new thread, it hands over to a profile of that thread
+        try:
+            self._new_profile().enable()
+        except ValueError:
+            # another profiler is active, don't run this hook again on every call of the thread
+            sys.setprofile(None)
+
+    def start(self):
+        # from python 3.12 on a profile follows every thread and only one can be active at a time
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._profile_thread)
+        self.main = self._new_profile()
+        self.main.enable()
+        return self
+
+    def stop(self):
+        self.main.disable()
+        threading.setprofile(None)
+        with self.lock:
+            profiles = [profile for profile in self.profiles if profile.getstats()]
+        return pstats.Stats(*profiles)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stats = self.stop()
+
+
+def summary(stats, top=DEFAULT_TOP):
+    """
+    The time spent in every phase, counting the own time of its functions, and its `top` hottest functions.
+    """
+    phases = {}
+    for function, (calls, _, own_time, cumulative_time, _) in stats.stats.items():
+        phases.setdefault(phase_of(function), []).append((own_time, cumulative_time, calls, function))
+    total = sum(sum(entry[0] for entry in entries) for entries in phases.values()) or 1
+    out = io.StringIO()
+    for phase in [name for name, _ in PHASES] + [OTHER_PHASE]:
+        entries = sorted(phases.get(phase, []), reverse=True)
+        phase_time = sum(entry[0] for entry in entries)
+        out.write('%s: %.2fs (%.0f%%)\n' % (phase, phase_time, 100 * phase_time / total))
+        for own_time, cumulative_time, calls, function in entries[:top]:
+            out.write('  %8.3fs own %8.3fs cumulative %9d calls  %s\n' % (
+                own_time, cumulative_time, calls, pstats.func_std_string(function)))
+    return out.getvalue()
@@ -0,0 +1,106 @@
+import logging
+import random
+import threading
+import time
+
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+SERVER_ERRORS = [500, 502, 503, 504]
+TOO_MANY_REQUESTS = 429
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# below this share of the minute's budget the concurrency is lowered instead of raised
+LOW_BUDGET = 0.1
+
+
+def _header(headers, *names):
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+
+class RateLimiter(object):
+
+    """
+    Schedules the requests of one Zendesk client. At most `limit` requests are in flight: the limit is halved
+    on every 429 and grows back by one per response while the account's rate limit budget is comfortable.
+    After a 429, or once the budget is spent, no request is started before Zendesk's Retry-After/reset time.
+    """
+
+    def __init__(self, max_concurrency, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF):
+        super().__init__()
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.resume_at = 0
+        self.condition = threading.Condition()
+
+    def try_acquire(self):
+        """
+        Takes a slot and returns 0, or returns how many seconds to wait before trying again.
+        """
+        with self.condition:
+            delay = self.resume_at - time.monotonic()
+            if delay > 0:
+                return delay
+            if self.in_flight >= self.limit:
+                return 0.05
+            self.in_flight += 1
+            return 0
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                delay = self.try_acquire()
+                if not delay:
+                    return
+                self.condition.wait(delay)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def update(self, status, headers):
+        with self.condition:
+            now = time.monotonic()
+            if status == TOO_MANY_REQUESTS:
+                self.limit = max(1, self.limit // 2)
+                self.resume_at = max(self.resume_at, now + self.retry_delay(0, headers))
+                logging.info('Rate limited by Zendesk, lowering concurrency to %s', self.limit)
+            else:
+                total = _header(headers, 'X-Rate-Limit', 'ratelimit-limit')
+                remaining = _header(headers, 'X-Rate-Limit-Remaining', 'ratelimit-remaining')
+                reset = _header(headers, 'ratelimit-reset')
+                if remaining is not None and remaining <= 0 and reset:
+                    self.resume_at = max(self.resume_at, now + reset)
+                if total and remaining is not None and remaining < total * LOW_BUDGET:
+                    self.limit = max(1, self.limit - 1)
+                elif self.limit < self.max_concurrency:
+                    self.limit += 1
+            self.condition.notify_all()
+
+    def should_retry(self, method, status, attempt):
+        """
+        A 429 means the request was not processed so any request is retried, other failures only when
+        repeating the request is safe.
+        """
+        if attempt >= self.max_retries:
+            return False
+        if status == TOO_MANY_REQUESTS:
+            return True
+        return method.upper() in IDEMPOTENT_METHODS and (status is None or status in SERVER_ERRORS)
+
+    def retry_delay(self, attempt, headers=None):
+        retry_after = _header(headers or {}, 'Retry-After')
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+
+import markdown
+
+MARKDOWN_EXTENSIONS = ['pymdownx.superfences', 'tables', 'mdx_truly_sane_lists']
+# bump when the way bodies are rendered changes so cached renders are not reused
+RENDER_VERSION = 2
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+DEFAULT_CACHE_FOLDER = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                    'zendesk-help-cms', 'render')
+# eviction frees space down to this share of the maximum size so it doesn't run on every write
+EVICTION_TARGET = 0.8
+
+# `(attachments/name`, `(./attachments/name` or `(/attachments/name` as found in markdown links and images
+ATTACHMENT_LINK_RE = re.compile(r'\((?:\./|/)?attachments/([^\s)#?]+)')
+
+
+def rewrite_attachment_links(body, links):
+    """
+    Replaces every link to a local attachment with its Zendesk path from `links` in a single pass over the body.
+    Returns the new body and the names of referenced attachments missing from `links`.
+    """
+    missing = []
+
+    def replace(match):
+        filename = match.group(1)
+        relative_path = links.get(filename) or links.get(urllib.parse.unquote(filename))
+        if relative_path is None:
+            missing.append(filename)
+            return match.group(0)
+        return '(' + relative_path
+
+    return ATTACHMENT_LINK_RE.sub(replace, body), missing
+
+
+_local = threading.local()
+
+
+def render_markdown(text):
+    # building the extension stack is a large part of rendering a short body, so every thread keeps its instance
+    md = getattr(_local, 'markdown', None)
+    if md is None:
+        md = _local.markdown = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    return md.reset().convert(text)
+
+
+def render_key(body, links):
+    """
+    Identifies a rendered body by everything it depends on: the markdown source, the attachment filename to
+    Zendesk path map and the markdown configuration.
+    """
+    source = [body, sorted(links.items()), MARKDOWN_EXTENSIONS, markdown.__version__, RENDER_VERSION]
+    return hashlib.sha256(json.dumps(source).encode('utf-8')).hexdigest()
+
+
+class RenderCache(object):
+
+    """
+    Rendered article bodies stored on disk, one file per key. Reading an entry updates its modification time so
+    once the cache grows over `max_size` bytes the least recently used entries are removed first.
+    """
+
+    def __init__(self, folder=DEFAULT_CACHE_FOLDER, max_size=DEFAULT_CACHE_SIZE):
+        super().__init__()
+        self.folder = folder
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.folder):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime_ns, stat.st_size, path
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                html = fp.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return html
+
+    def put(self, key, html):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+                fp.write(html)
+            size = os.path.getsize(tmp_path)
+            with self.lock:
+                # the same body may be rendered twice, only the size it adds to the entry it replaces counts
+                replaced = self._size(path)
+                os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._entries())
+            else:
+                self.size += size - replaced
+            if self.size > self.max_size:
+                self._evict()
+
+    def _size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        self.size = sum(size for _, size, _ in entries)
+        target = self.max_size * EVICTION_TARGET
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+        logging.debug('Render cache evicted down to %s bytes', self.size)
+
+
+class RenderPool(object):
+
+    """
+    Renders article bodies on `processes` worker processes ahead of the push. `get` waits for the body submitted
+    under that key, falling back to the wrapped `RenderCache`. The body of an article whose attachments change
+    during the push gets another key, `release` drops what was rendered ahead for it.
+    """
+
+    def __init__(self, processes, cache=None):
+        super().__init__()
+        self.executor = ProcessPoolExecutor(max_workers=processes)
+        self.cache = cache
+        self.futures = {}
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def submit(self, article):
+        try:
+            links = article.attachment_links()
+        except KeyError:
+            # attachments not uploaded yet, their Zendesk paths are only known during the push
+            return
+        key = render_key(article.body, links)
+        with self.lock:
+            self.keys[article.path] = key
+            if key in self.futures:
+                return
+        if self.cache and self.cache.get(key) is not None:
+            return
+        source, missing = rewrite_attachment_links(article.body, links)
+        for filename in missing:
+            logging.warning('Article %s links to missing attachment %s' % (article.name, filename))
+        future = self.executor.submit(render_markdown, source)
+        with self.lock:
+            self.futures[key] = future
+
+    def get(self, key):
+        with self.lock:
+            future = self.futures.pop(key, None)
+        if future is None:
+            return self.cache.get(key) if self.cache else None
+        html = future.result()
+        self.put(key, html)
+        return html
+
+    def release(self, article):
+        with self.lock:
+            future = self.futures.pop(self.keys.pop(article.path, None), None)
+        if future is not None:
+            future.cancel()
+
+    def put(self, key, html):
+        if self.cache:
+            self.cache.put(key, html)
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown()
@@ -0,0 +1,148 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# how long a producer blocked on a full queue waits before checking whether the consumer stopped
+PUT_TIMEOUT = 0.1
+
+
+class Task(object):
+
+    def __init__(self, fn, args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.dependents = []
+        self.pending = 0
+        self.done = False
+        self.skipped = False
+        self.result = None
+        self.error = None
+
+
+class Scheduler(object):
+
+    """
+    Runs each task as soon as all the tasks it depends on are done, on a pool of `jobs` threads.
+    With a single job tasks run inline as they are added, so they must be added in dependency order.
+    Once a task fails no new task is started and `wait` re-raises the first error.
+    With `max_pending` set, `add` blocks while that many tasks are not finished yet.
+    """
+
+    def __init__(self, jobs=1, max_pending=None):
+        super().__init__()
+        self.pool = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        self.unfinished = 0
+        self.errors = []
+
+    def add(self, fn, *args, depends_on=()):
+        task = Task(fn, args)
+        with self.lock:
+            while self.max_pending and self.unfinished >= self.max_pending:
+                self.finished.wait()
+            self.unfinished += 1
+            for dependency in depends_on:
+                if not dependency.done:
+                    task.pending += 1
+                    dependency.dependents.append(task)
+            ready = task.pending == 0
+        if ready:
+            self._start(task)
+        return task
+
+    def _start(self, task):
+        if self.errors:
+            task.skipped = True
+            self._finish(task)
+        elif self.pool:
+            self.pool.submit(self._run, task)
+        else:
+            self._run(task)
+
+    def _run(self, task):
+        try:
+            task.result = task.fn(*task.args)
+        except Exception as e:
+            logging.error('Task %s failed: %s', task.fn.__name__, e)
+            task.error = e
+            with self.lock:
+                self.errors.append(e)
+        self._finish(task)
+
+    def _finish(self, task):
+        ready = []
+        with self.lock:
+            task.done = True
+            for dependent in task.dependents:
+                dependent.pending -= 1
+                if dependent.pending == 0:
+                    ready.append(dependent)
+            # tasks added from now on don't wait for this one, don't keep the finished ones alive
+            task.dependents = []
+            self.unfinished -= 1
+            self.finished.notify_all()
+        for dependent in ready:
+            self._start(dependent)
+
+    def wait(self):
+        with self.lock:
+            while self.unfinished:
+                self.finished.wait()
+        if self.pool:
+            self.pool.shutdown()
+        if self.errors:
+            raise self.errors[0]
+
+
+class _Failure(object):
+
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+
+_DONE = object()
+
+
+def buffered(iterable, maxsize):
+    """
+    Iterates over `iterable` on a background thread, at most `maxsize` items ahead of the consumer.
+    An exception raised by `iterable` is raised to the consumer.
+    """
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_Failure(e))
+        else:
+            put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
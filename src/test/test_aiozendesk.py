@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+from unittest import IsolatedAsyncioTestCase, skipIf
+from unittest.mock import AsyncMock, create_autospec
+
+import filesystem
+import model
+
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    import aiozendesk
+except ImportError:
+    aiozendesk = None
+
+
+async def _iter(records):
+    for record in records:
+        yield record
+
+
+@skipIf(aiozendesk is None, 'aiohttp is not installed')
+class TestAsyncZendeskRequest(IsolatedAsyncioTestCase):
+
+    async def test_iter_items_follows_next_page(self):
+        req = aiozendesk.AsyncZendeskRequest('test_company.com', 'test_user', 'test_password')
+        req._get_json = AsyncMock(side_effect=[
+            {'categories': [{'id': 1}], 'next_page': 'https://test_company.com/page2'},
+            {'categories': [{'id': 2}], 'next_page': None}])
+
+        items = await req.get_items(model.Category)
+
+        self.assertEqual([1, 2], [item['id'] for item in items])
+
+    async def test_post_attachment_after_rate_limit(self):
+        uploads = []
+
+        async def upload(request):
+            form = await request.post()
+            uploads.append(form['file'].file.read())
+            if len(uploads) == 1:
+                return web.json_response({}, status=429, headers={'Retry-After': '0'})
+            return web.json_response({'article_attachment': {'id': 1}})
+
+        app = web.Application()
+        app.router.add_post('/api/v2/help_center/en-us/articles/{id}/attachments.json', upload)
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        attributes = {'name': 'article', 'synced': True, 'draft': False, 'author': 'a@example.com',
+                      'visibility': 'all', 'comments_disabled': False}
+        article = model.Article(None, attributes, '', 'article')
+        article.meta = {'id': 5}
+        path = os.path.join(folder, 'image.png')
+        with open(path, 'wb') as fp:
+            fp.write(b'image')
+
+        async with TestServer(app) as server:
+            async with aiozendesk.client(str(server.make_url('')), 'user', 'password') as req:
+                response = await req.post_attachment(model.Attachment(article, 'image.png'), path)
+
+        self.assertEqual({'article_attachment': {'id': 1}}, response)
+        self.assertEqual([b'image', b'image'], uploads)
+
+
+@skipIf(aiozendesk is None, 'aiohttp is not installed')
+class TestAsyncFetcher(IsolatedAsyncioTestCase):
+
+    def _iter_items(self, item, parent=None):
+        prefix = parent.name + ' ' if parent else ''
+        if item is model.Attachment:
+            return _iter([{'file_name': prefix + 'image.png'}])
+        if item is model.Article:
+            return _iter([{'title': prefix + str(i), 'author_id': i % 2, 'draft': False, 'comments_disabled': False}
+                          for i in range(3)])
+        return _iter([{'name': prefix + str(i), 'description': ''} for i in range(2)])
+
+    async def test_fetch_keeps_order(self):
+        req = create_autospec(aiozendesk.AsyncZendeskRequest)
+        req.iter_items.side_effect = self._iter_items
+        req.get_user_segments.return_value = []
+        req.get_user.return_value = {'email': 'author@example.com'}
+
+        categories = await aiozendesk.AsyncFetcher(req).fetch()
+
+        self.assertEqual(['0', '1'], [c.name for c in categories])
+        self.assertEqual(['1 1 0', '1 1 1', '1 1 2'], [a.name for a in categories[1].sections[1].articles])
+        self.assertEqual('author@example.com', categories[1].sections[1].articles[0].author)
+        self.assertEqual(2, req.get_user.call_count)
+
+
+@skipIf(aiozendesk is None, 'aiohttp is not installed')
+class TestAsyncPusher(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.root_folder = tempfile.mkdtemp()
+        self.fs = filesystem.FilesystemClient(self.root_folder)
+        self.req = create_autospec(aiozendesk.AsyncZendeskRequest)
+        self.req.get_user_segments.return_value = []
+        self.req.get_permission_groups.return_value = [{'name': 'Agents and admins', 'id': 1}]
+        self.req.search_user.return_value = {'id': 2}
+        self.req.post.side_effect = lambda item, data, parent=None: {'id': item.name}
+        self.req.post_attachment.side_effect = lambda attachment, path: {
+            'article_attachment': {'id': attachment.name, 'relative_path': '/hc/' + attachment.name}}
+        self.req.get_item.return_value = {}
+        self.req.put.return_value = {}
+        self.category = model.Category({'name': 'category', 'description': ''}, 'category')
+        section = model.Section(self.category, {'name': 'section', 'description': ''}, 'section')
+        self.category.sections.append(section)
+        attributes = {'name': 'article', 'synced': True, 'draft': False, 'author': 'a@example.com',
+                      'visibility': 'all', 'comments_disabled': False}
+        article = model.Article(section, attributes, '![image](attachments/image.png)', 'article')
+        section.articles.append(article)
+        article.attachments['image.png'] = model.Attachment(article, 'image.png')
+        self.fs.save_text(article.attachments['image.png'].filepath, 'image')
+
+    def tearDown(self):
+        shutil.rmtree(self.root_folder)
+
+    async def test_push_new_tree(self):
+        await aiozendesk.AsyncPusher(self.req, self.fs).push([self.category])
+
+        self.assertEqual(3, self.req.post.call_count)
+        self.req.post_attachment.assert_called_once()
+        translation = self.req.put_translation.call_args[0][1]['translation']
+        self.assertIn('/hc/image.png', translation['body'])
@@ -1,5 +1,8 @@
+from contextlib import redirect_stdout
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
+import io
+import json
 import tempfile
 import shutil
 import os
@@ -103,3 +106,31 @@ class TestRemoveTask(TestCase):
         self._assert_section_deleted(zendesk_requests, translate_requests)
         self._assert_article_deleted(zendesk_requests, translate_requests)
         zendesk_requests.delete.assert_any_call('https://test_company.com/api/v2/help_center/en-us/categories/1.json', verify=False, auth=('test_user', 'test_password'))
+
+
+class TestExportPlan(TestCase):
+    def setUp(self):
+        self.root_folder = tempfile.mkdtemp()
+        self.fs = filesystem.FilesystemClient(self.root_folder)
+        self.fs.save_yaml('category/__group__.yaml', {'name': 'renamed category', 'description': ''})
+        self.fs.save_json('category/.group.meta', {'id': 1, 'name': 'category', 'description': ''})
+        self.args = {
+            'root_folder': self.root_folder,
+            'disable_article_comments': False,
+            'full': False,
+            'render_cache_size': 0,
+            'plan': True,
+            'json': True
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.root_folder)
+
+    def test_json_plan_is_the_only_output(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            cms.ExportTask().execute(self.args)
+
+        plan = json.loads(out.getvalue())
+        self.assertEqual([('update', ['name', 'description'])],
+                         [(action['action'], action['changes']) for action in plan['actions']])
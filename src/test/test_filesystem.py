@@ -1,8 +1,14 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 from unittest import TestCase
-from unittest.mock import create_autospec
+from unittest.mock import MagicMock, create_autospec, patch
 
 import filesystem
 import model
+import utils
 from . import fixtures
 
 
@@ -105,3 +111,323 @@ class TestLoader(TestCase):
         self.assertEqual('dummy body', translations[0].body)
         self.assertEqual('en-US', translations[0].locale)
         self.assertEqual('pl', translations[1].locale)
+
+
+class TestIncrementalSave(TestCase):
+
+    def setUp(self):
+        self.root_folder = tempfile.mkdtemp()
+        self.fs = filesystem.FilesystemClient(self.root_folder)
+        self.fs.save_json('category/section/old-title/.article.meta', {'id': 3})
+        self.fs.save_text('category/section/old-title/README.md', 'body')
+
+    def tearDown(self):
+        shutil.rmtree(self.root_folder)
+
+    def test_article_paths(self):
+        paths = filesystem.Loader(self.fs, False).article_paths()
+
+        self.assertEqual({3: 'category/section/old-title'}, paths)
+
+    def test_relocate_renamed_article(self):
+        category = model.Category({'name': 'category', 'description': ''}, 'category')
+        section = model.Section(category, {'name': 'other section', 'description': ''}, 'other-section')
+        attributes = {'name': 'new title', 'synced': False, 'draft': False, 'author': '', 'visibility': 'all',
+                      'comments_disabled': False}
+        article = model.Article(section, attributes, 'body', 'new-title')
+        article.meta = {'id': 3}
+        section.articles.append(article)
+        category.sections.append(section)
+
+        filesystem.Saver(self.fs, None).relocate_articles([category], {3: 'category/section/old-title'})
+
+        self.assertFalse(os.path.exists(self.fs.path_for('category/section/old-title')))
+        self.assertEqual('body', self.fs.read_text('category/other-section/new-title/README.md'))
+
+
+class TestAttachmentDownload(TestCase):
+
+    def setUp(self):
+        self.root_folder = tempfile.mkdtemp()
+        self.fs = filesystem.FilesystemClient(self.root_folder)
+        self.zd = MagicMock()
+        self.zd.get_attachment.side_effect = lambda relative_path, path: None if 'missing' in path else 'hash'
+        self.category = model.Category({'name': 'category', 'description': ''}, 'category')
+        section = model.Section(self.category, {'name': 'section', 'description': ''}, 'section')
+        attributes = {'name': 'article', 'synced': False, 'draft': False, 'author': '', 'visibility': 'all',
+                      'comments_disabled': False}
+        self.article = model.Article(section, attributes, 'body', 'article')
+        for name in ['a.png', 'b.png', 'missing.png']:
+            attachment = model.Attachment(self.article, name)
+            attachment.meta = {'relative_path': '/hc/' + name}
+            self.article.attachments[name] = attachment
+        section.articles.append(self.article)
+        self.category.sections.append(section)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_folder)
+
+    def test_downloads_attachments_concurrently(self):
+        filesystem.Saver(self.fs, self.zd, jobs=3).save([self.category])
+
+        self.assertEqual(3, self.zd.get_attachment.call_count)
+        self.assertEqual('hash', self.fs.read_json(self.article.attachments['a.png'].meta_filepath)['md5_hash'])
+        self.assertEqual({}, self.fs.read_json(self.article.attachments['missing.png'].meta_filepath))
+
+
+class TestLoadTree(TestCase):
+
+    def setUp(self):
+        self.root_folder = tempfile.mkdtemp()
+        self.fs = filesystem.FilesystemClient(self.root_folder)
+        for section_path in ['a-category/a-section', 'a-category/b-section', 'b-category/a-section']:
+            for i in range(3):
+                article_path = '%s/article-%s' % (section_path, i)
+                self.fs.save_text(article_path + '/README.md', 'body %s' % i)
+                self.fs.save_yaml(article_path + '/__article__.yaml', {'name': 'article %s' % i, 'draft': True})
+                self.fs.save_text(article_path + '/attachments/image.png', 'image')
+        self.fs.save_json('a-category/.group.meta', {'id': 1})
+
+    def tearDown(self):
+        shutil.rmtree(self.root_folder)
+
+    def test_load_keeps_tree_and_order(self):
+        for i in range(3, 20):
+            article_path = 'a-category/b-section/article-%s' % i
+            self.fs.save_text(article_path + '/README.md', 'body %s' % i)
+            self.fs.save_yaml(article_path + '/__article__.yaml', {'name': 'article %s' % i, 'draft': True})
+
+        categories = filesystem.Loader(self.fs, False, jobs=4).load()
+
+        def listing(path):
+            return [entry.name for entry in os.scandir(os.path.join(self.root_folder, path))
+                    if entry.is_dir() and not entry.name.startswith('.')]
+
+        self.assertEqual(listing(''), [c.filename for c in categories])
+        for category in categories:
+            self.assertEqual(listing(category.path), [s.filename for s in category.sections])
+            for section in category.sections:
+                self.assertEqual(listing(section.path), [a.filename for a in section.articles])
+                for article in section.articles:
+                    self.assertIs(section, article.section)
+                    self.assertTrue(article.draft)
+                    self.assertEqual('body ' + article.filename.split('-')[1], article.body)
+        category = [c for c in categories if c.filename == 'a-category'][0]
+        self.assertEqual(1, category.zendesk_id)
+        section = [s for s in category.sections if s.filename == 'a-section'][0]
+        self.assertEqual([['image.png']] * 3, [list(a.attachments) for a in section.articles])
+
+    def test_iter_tree_loads_a_bounded_number_of_articles_ahead(self):
+        category_dirname = self.fs.read_directories(self.root_folder)[0]
+        section_path = os.path.join(category_dirname, self.fs.read_directories(category_dirname)[0])
+        for i in range(3, 50):
+            self.fs.save_yaml('%s/article-%s/__article__.yaml' % (section_path, i), {'name': 'article %s' % i})
+        loader = filesystem.Loader(self.fs, False, jobs=2)
+        loaded = []
+        fill_article = loader._fill_article
+        loader._fill_article = lambda section, dirname, **kwargs: loaded.append(dirname) or fill_article(
+            section, dirname, **kwargs)
+        tree = loader.iter_tree()
+
+        items = [next(tree) for _ in range(7)]
+        tree.close()
+
+        self.assertEqual(section_path, items[1].path)
+        self.assertLessEqual(len(loaded), 5 + 2 * filesystem.LOADER_WINDOW)
+
+    def test_body_and_attachment_meta_are_read_on_access(self):
+        self.fs.save_json('b-category/a-section/article-0/attachments/.image.png.meta', {'id': 5})
+        category = [c for c in filesystem.Loader(self.fs, False).load() if c.name == 'b-category'][0]
+        article = [a for a in category.sections[0].articles if a.filename == 'article-0'][0]
+        self.fs.save_text(article.body_filepath, 'new body')
+
+        self.assertEqual('new body', article.body)
+        self.assertEqual(5, article.attachments['image.png'].zendesk_id)
+
+        self.fs.save_text(article.body_filepath, 'newer body')
+        self.assertEqual('new body', article.body)
+        article.release()
+        self.assertEqual('newer body', article.body)
+
+    def test_old_meta_keeps_only_body_hash(self):
+        self.fs.save_json('b-category/a-section/article-1/.article.meta',
+                          {'id': 3, 'body': '<p>body</p>', 'generated_body': '<p>body</p>'})
+
+        category = [c for c in filesystem.Loader(self.fs, False).load() if c.name == 'b-category'][0]
+        article = [a for a in category.sections[0].articles if a.filename == 'article-1'][0]
+
+        self.assertEqual({'id': 3, 'generated_body_hash': utils.md5_text('<p>body</p>')}, article.meta)
+
+    def test_missing_files_read_as_empty(self):
+        self.assertEqual('', self.fs.read_text('missing/README.md'))
+        self.assertEqual([], self.fs.read_directories('missing'))
+
+
+class TestBufferedFilesystemClient(TestCase):
+
+    def setUp(self):
+        self.root_folder = tempfile.mkdtemp()
+        self.fs = filesystem.BufferedFilesystemClient(self.root_folder, flush_size=2)
+        filesystem.FilesystemClient(self.root_folder).save_json('a/.article.meta', {'id': 1, 'title': 'old'})
+
+    def tearDown(self):
+        shutil.rmtree(self.root_folder)
+
+    def _read_from_disk(self, path):
+        return filesystem.FilesystemClient(self.root_folder).read_json(path)
+
+    def test_coalesces_saves_until_flush(self):
+        self.fs.save_json('a/.article.meta', {'title': 'new'})
+        saved = self.fs.save_json('a/.article.meta', {'draft': True})
+
+        self.assertEqual({'id': 1, 'title': 'new', 'draft': True}, saved)
+        self.assertEqual(saved, self.fs.read_json('a/.article.meta'))
+        self.assertEqual({'id': 1, 'title': 'old'}, self._read_from_disk('a/.article.meta'))
+
+        self.fs.flush()
+
+        self.assertEqual(saved, self._read_from_disk('a/.article.meta'))
+        self.assertEqual(['.article.meta'], os.listdir(os.path.join(self.root_folder, 'a')))
+
+    def test_flushes_full_batches(self):
+        self.fs.save_json('a/.article.meta', {'title': 'new'})
+        self.fs.save_json('b/.article.meta', {'id': 2})
+
+        self.assertEqual({}, self.fs.pending)
+        self.assertEqual({'id': 2}, self._read_from_disk('b/.article.meta'))
+
+    def test_compacts_merged_meta(self):
+        self.fs.save_json('a/.article.meta', {'body': '<p>body</p>'})
+
+        saved = self.fs.save_json('a/.article.meta', {'draft': True}, model.Article.compact_meta)
+        self.fs.flush()
+
+        self.assertEqual({'id': 1, 'title': 'old', 'draft': True}, saved)
+        self.assertEqual(saved, self._read_from_disk('a/.article.meta'))
+
+    def test_saves_during_a_flush_see_the_batch_being_written(self):
+        writing, resume = threading.Event(), threading.Event()
+        save_text = filesystem.FilesystemClient.save_text
+
+        def slow_save_text(fs, path, data):
+            writing.set()
+            resume.wait(5)
+            save_text(fs, path, data)
+
+        self.fs.save_json('a/.article.meta', {'generated_body_hash': 'hash'})
+        with patch.object(filesystem.FilesystemClient, 'save_text', slow_save_text):
+            flush = threading.Thread(target=self.fs.flush)
+            flush.start()
+            writing.wait(5)
+            saved = self.fs.save_json('a/.article.meta', {'author_id': 5})
+            read = self.fs.read_json('a/.article.meta')
+            resume.set()
+            flush.join()
+        self.fs.flush()
+
+        expected = {'id': 1, 'title': 'old', 'generated_body_hash': 'hash', 'author_id': 5}
+        self.assertEqual(expected, saved)
+        self.assertEqual(expected, read)
+        self.assertEqual(expected, self._read_from_disk('a/.article.meta'))
+
+    def test_concurrent_saves_are_not_lost(self):
+        def save(i):
+            for j in range(20):
+                self.fs.save_json('a/.article.meta', {'key %s %s' % (i, j): j})
+                self.fs.save_json('%s/%s/.article.meta' % (i, j), {'id': j})
+
+        threads = [threading.Thread(target=save, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.fs.flush()
+
+        meta = self._read_from_disk('a/.article.meta')
+        self.assertEqual(2 + 4 * 20, len(meta))
+
+
+class TestSqliteFilesystemClient(TestCase):
+
+    def setUp(self):
+        self.root_folder = tempfile.mkdtemp()
+        files = filesystem.FilesystemClient(self.root_folder)
+        files.save_json('category/section/article/.article.meta', {'id': 3, 'title': 'article'})
+        files.save_json('category/section/article/attachments/.image.png.meta', {'id': 4, 'md5_hash': 'hash'})
+        files.save_text('category/section/article/README.md', 'body')
+
+    def tearDown(self):
+        shutil.rmtree(self.root_folder)
+
+    def _exists(self, path):
+        return os.path.exists(os.path.join(self.root_folder, path))
+
+    def test_migrate_copies_meta_files(self):
+        fs = filesystem.state_client(self.root_folder)
+
+        self.assertEqual(2, fs.migrate(remove=True))
+
+        self.assertFalse(self._exists('category/section/article/.article.meta'))
+        self.assertIsInstance(filesystem.client(self.root_folder), filesystem.SqliteFilesystemClient)
+        self.assertEqual({'id': 3, 'title': 'article'}, fs.read_json('category/section/article/.article.meta'))
+        self.assertEqual(['category/section/article/attachments/.image.png.meta'], fs.paths_for_zendesk_id(4))
+        self.assertEqual('body', fs.read_text('category/section/article/README.md'))
+
+    def test_meta_is_saved_in_database(self):
+        fs = filesystem.state_client(self.root_folder)
+        fs.migrate(remove=True)
+
+        saved = fs.save_json('category/section/article/.article.meta', {'draft': True})
+
+        self.assertEqual({'id': 3, 'title': 'article', 'draft': True}, saved)
+        self.assertFalse(self._exists('category/section/article/.article.meta'))
+        self.assertEqual(saved, filesystem.state_client(self.root_folder).read_json('category/section/article/.article.meta'))
+
+    def test_moving_article_moves_its_state(self):
+        fs = filesystem.state_client(self.root_folder)
+        fs.migrate(remove=True)
+
+        fs.move('category/section/article', 'category/section/renamed')
+
+        self.assertEqual({3: 'category/section/renamed'}, filesystem.Loader(fs, False).article_paths())
+        self.assertEqual('hash', fs.read_json('category/section/renamed/attachments/.image.png.meta')['md5_hash'])
+
+    def test_meta_paths_query_uses_the_name_index(self):
+        fs = filesystem.state_client(self.root_folder)
+        fs.migrate()
+
+        plan = fs._query('EXPLAIN QUERY PLAN SELECT path, zendesk_id FROM meta WHERE name = ? AND zendesk_id IS NOT NULL',
+                         '.article.meta')
+
+        self.assertIn('INDEX meta_name', ' '.join(row[-1] for row in plan))
+        self.assertEqual({3: 'category/section/article'}, fs.meta_paths('.article.meta'))
+
+    def test_loader_reads_metas_in_one_query(self):
+        filesystem.FilesystemClient(self.root_folder).save_text('category/section/article/attachments/image.png', 'image')
+        fs = filesystem.state_client(self.root_folder)
+        fs.migrate(remove=True)
+
+        with patch.object(fs, '_query', wraps=fs._query) as query:
+            categories = filesystem.Loader(fs, False).load()
+            article = categories[0].sections[0].articles[0]
+            self.assertEqual(3, article.zendesk_id)
+            self.assertEqual('hash', article.attachments['image.png'].meta['md5_hash'])
+            self.assertEqual(1, query.call_count)
+
+        with patch.object(fs, '_query', wraps=fs._query) as query:
+            items = list(filesystem.Loader(fs, False).iter_tree())
+            self.assertEqual(3, items[2].zendesk_id)
+            self.assertEqual('hash', items[2].attachments['image.png'].meta['md5_hash'])
+            # the category and the section meta, then all the metas of the section
+            self.assertEqual(3, query.call_count)
+
+    def test_adds_name_column_to_older_databases(self):
+        db = sqlite3.connect(os.path.join(self.root_folder, filesystem.STATE_DB_PATH))
+        db.execute('CREATE TABLE meta (path TEXT PRIMARY KEY, zendesk_id INTEGER, data TEXT NOT NULL)')
+        db.execute('INSERT INTO meta VALUES (?, ?, ?)', ('category/section/article/.article.meta', 3, '{"id": 3}'))
+        db.commit()
+        db.close()
+
+        fs = filesystem.SqliteFilesystemClient(self.root_folder)
+
+        self.assertEqual({3: 'category/section/article'}, fs.meta_paths('.article.meta'))
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import filesystem
+import manifest
+import model
+
+
+class TestManifest(TestCase):
+
+    def setUp(self):
+        self.root_folder = tempfile.mkdtemp()
+        self.fs = filesystem.FilesystemClient(self.root_folder)
+        category = model.Category({'name': 'category', 'description': ''}, 'category')
+        category.meta = {'id': 1}
+        section = model.Section(category, {'name': 'section', 'description': ''}, 'section')
+        section.meta = {'id': 2}
+        attributes = {'name': 'article', 'synced': True, 'draft': False, 'author': 'a@example.com',
+                      'visibility': 'all', 'comments_disabled': False}
+        self.article = model.Article(section, attributes, 'body', 'article')
+        self.article.meta = {'id': 3}
+        self.fs.save_text(self.article.body_filepath, 'body')
+        self.fs.save_json(self.article.meta_filepath, {'id': 3})
+        self.manifest = manifest.Manifest(self.fs)
+        self.manifest.update(self.article)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_folder)
+
+    def test_unchanged_after_save(self):
+        self.manifest.save()
+
+        self.assertTrue(manifest.Manifest(self.fs).is_unchanged(self.article))
+
+    def test_changed_body(self):
+        self.fs.save_text(self.article.body_filepath, 'new body')
+        stat = os.stat(self.fs.path_for(self.article.body_filepath))
+        os.utime(self.fs.path_for(self.article.body_filepath), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+        self.assertFalse(self.manifest.is_unchanged(self.article))
+
+    def test_changed_attributes(self):
+        self.article.draft = True
+
+        self.assertFalse(self.manifest.is_unchanged(self.article))
+
+    def test_new_attachment(self):
+        self.article.attachments['image.png'] = model.Attachment(self.article, 'image.png')
+
+        self.assertFalse(self.manifest.is_unchanged(self.article))
+
+
+class TestHashCache(TestCase):
+
+    def setUp(self):
+        self.root_folder = tempfile.mkdtemp()
+        self.fs = filesystem.FilesystemClient(self.root_folder)
+        self.fs.save_text('image.png', 'image')
+        self.cache = manifest.HashCache(self.fs)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_folder)
+
+    def test_unchanged_file_is_not_read(self):
+        md5_hash = self.cache.md5_hash('image.png')
+        self.cache.save()
+
+        with patch('utils.md5_hash') as md5:
+            self.assertEqual(md5_hash, manifest.HashCache(self.fs).md5_hash('image.png'))
+            md5.assert_not_called()
+
+    def test_changed_file_is_hashed_again(self):
+        md5_hash = self.cache.md5_hash('image.png')
+        self.fs.save_text('image.png', 'other image')
+
+        self.assertNotEqual(md5_hash, self.cache.md5_hash('image.png'))
+
+    def test_prefetch_hashes_misses(self):
+        self.fs.save_text('other.png', 'other')
+        self.cache.md5_hash('image.png')
+
+        with patch('utils.md5_hash', return_value='hash') as md5:
+            self.cache.prefetch(['image.png', 'other.png'])
+            md5.assert_called_once_with(self.fs.path_for('other.png'))
+
+    def test_submitted_files_are_hashed_once(self):
+        self.fs.save_text('other.png', 'other')
+
+        with patch('utils.md5_hash', return_value='hash') as md5:
+            self.cache.submit(['image.png', 'other.png'])
+            self.assertEqual('hash', self.cache.md5_hash('image.png'))
+            self.assertEqual('hash', self.cache.md5_hash('other.png'))
+            self.cache.close()
+            self.assertEqual(2, md5.call_count)
+        self.assertEqual({}, self.cache.futures)
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import requests
+
+import metrics
+import zendesk
+
+
+class TestRequestMetrics(TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.RequestMetrics()
+
+    def test_endpoint_groups_ids_and_attachment_names(self):
+        self.assertEqual('/api/v2/help_center/en-us/sections/{id}/articles.json',
+                         metrics.endpoint('https://x.zendesk.com/api/v2/help_center/en-us/sections/12/articles.json?page=2'))
+        self.assertEqual('/api/v2/help_center/articles/{id}/translations/en-US.json',
+                         metrics.endpoint('https://x.zendesk.com/api/v2/help_center/articles/3/translations/en-US.json'))
+        self.assertEqual('/hc/article_attachments/{id}/{name}',
+                         metrics.endpoint('https://x.zendesk.com/hc/article_attachments/7/image 2.png'))
+
+    def test_record(self):
+        self.metrics.record('get', 'https://x/api/v2/users/1.json', 200, 0.07, 0, 100)
+        self.metrics.record('GET', 'https://x/api/v2/users/2.json', 429, 3.0, 0, 2)
+        self.metrics.record_retry('GET', 'https://x/api/v2/users/2.json')
+
+        entry = self.metrics.endpoints[('GET', '/api/v2/users/{id}.json')]
+        self.assertEqual(2, entry.requests)
+        self.assertEqual(1, entry.retries)
+        self.assertEqual({200: 1, 429: 1}, entry.statuses)
+        self.assertEqual([0, 1, 0, 0, 0, 0, 1, 0], entry.buckets)
+        self.assertEqual(102, entry.bytes_received)
+        self.assertEqual({'requests': 2, 'retries': 1, 'errors': 1, 'seconds': 3.07, 'bytes_sent': 0,
+                          'bytes_received': 102}, self.metrics.totals())
+
+    def test_prometheus(self):
+        self.metrics.record('PUT', 'https://x/api/v2/help_center/en-us/articles/1.json', 200, 0.2, 50, 70)
+        self.metrics.record('PUT', 'https://x/api/v2/help_center/en-us/articles/1.json', 'error', 20.0)
+
+        text = self.metrics.to_prometheus()
+
+        endpoint = 'endpoint="/api/v2/help_center/en-us/articles/{id}.json"'
+        labels = endpoint + ',method="PUT"'
+        self.assertIn('# TYPE zendesk_request_duration_seconds histogram', text)
+        self.assertIn('zendesk_requests_total{%s,status="error"} 1' % labels, text)
+        self.assertIn('zendesk_request_duration_seconds_bucket{%s,le="0.25",method="PUT"} 1' % endpoint, text)
+        self.assertIn('zendesk_request_duration_seconds_bucket{%s,le="+Inf",method="PUT"} 2' % endpoint, text)
+        self.assertIn('zendesk_request_bytes_total{%s} 50' % labels, text)
+
+    def test_save(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.metrics.record('GET', 'https://x/api/v2/search.json', 200, 0.1)
+
+        self.metrics.save(os.path.join(folder, 'metrics.json'), os.path.join(folder, 'metrics.prom'))
+
+        with open(os.path.join(folder, 'metrics.json')) as fp:
+            self.assertEqual(1, json.load(fp)['totals']['requests'])
+        self.assertTrue(os.path.exists(os.path.join(folder, 'metrics.prom')))
+
+
+class TestZendeskRequestMetrics(TestCase):
+
+    def setUp(self):
+        self.req = zendesk.ZendeskRequest('company.zendesk.com', 'user', 'password')
+
+    def _response(self, status, body=b'{}'):
+        response = MagicMock()
+        response.status_code = status
+        response.headers = {'Content-Length': str(len(body))}
+        response.request.body = '{"article": {}}'
+        return response
+
+    @patch('time.sleep')
+    def test_counts_attempts_and_retries(self, sleep):
+        responses = [self._response(429), self._response(200, b'{"article": {"id": 1}}')]
+        with patch.object(self.req.session, 'request', side_effect=responses):
+            self.req._request('PUT', 'https://company.zendesk.com/api/v2/help_center/en-us/articles/1.json')
+
+        entry = self.req.metrics.endpoints[('PUT', '/api/v2/help_center/en-us/articles/{id}.json')]
+        self.assertEqual(2, entry.requests)
+        self.assertEqual(1, entry.retries)
+        self.assertEqual({429: 1, 200: 1}, entry.statuses)
+        self.assertEqual(30, entry.bytes_sent)
+        self.assertEqual(24, entry.bytes_received)
+
+    def test_counts_connection_errors(self):
+        with patch.object(self.req.session, 'request', side_effect=requests.ConnectionError()):
+            with self.assertRaises(requests.ConnectionError):
+                self.req._send('POST', 'https://company.zendesk.com/api/v2/help_center/en-us/categories.json')
+
+        entry = self.req.metrics.endpoints[('POST', '/api/v2/help_center/en-us/categories.json')]
+        self.assertEqual({'error': 1}, entry.statuses)
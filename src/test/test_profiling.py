@@ -0,0 +1,58 @@
+import hashlib
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch
+
+import profiling
+
+
+def _hash_in_worker():
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(hashlib.md5, b'data').result()
+
+
+class TestProfiling(TestCase):
+
+    def test_phase_of(self):
+        self.assertEqual('network wait', profiling.phase_of(
+            ('/usr/lib/python3/site-packages/urllib3/connectionpool.py', 1, 'urlopen')))
+        self.assertEqual('render', profiling.phase_of(('/src/render.py', 1, 'render_markdown')))
+        self.assertEqual('hash', profiling.phase_of(('~', 0, '<built-in method _hashlib.openssl_md5>')))
+        self.assertEqual('load', profiling.phase_of(('/src/filesystem.py', 1, 'read_yaml')))
+        self.assertEqual('other', profiling.phase_of(('/src/scheduler.py', 1, 'wait')))
+
+    def test_profiles_worker_threads(self):
+        with profiling.TaskProfiler() as profiler:
+            _hash_in_worker()
+
+        names = [name for _, _, name in profiler.stats.stats]
+        self.assertIn('<built-in method _hashlib.openssl_md5>', names)
+        self.assertIn('_hash_in_worker', names)
+
+    def test_summary_lists_every_phase(self):
+        with profiling.TaskProfiler() as profiler:
+            _hash_in_worker()
+
+        summary = profiling.summary(profiler.stats, top=1)
+
+        for phase in ['network wait', 'render', 'hash', 'load', 'other']:
+            self.assertIn(phase + ':', summary)
+        self.assertIn('openssl_md5', summary)
+
+    def test_thread_hook_removes_itself_when_a_profiler_is_active(self):
+        profiler = profiling.TaskProfiler()
+        hooks = []
+
+        def run():
+            sys.setprofile(profiler._profile_thread)
+            profiler._profile_thread(None, 'call', None)
+            hooks.append(sys.getprofile())
+
+        with patch('cProfile.Profile.enable', side_effect=ValueError('Another profiling tool is already active')):
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            thread.join(5)
+
+        self.assertEqual([None], hooks)
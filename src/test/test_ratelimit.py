@@ -0,0 +1,68 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import ratelimit
+import zendesk
+
+
+def _response(status, headers=None, data=None):
+    response = MagicMock()
+    response.status_code = status
+    response.headers = headers or {}
+    response.json.return_value = data or {}
+    return response
+
+
+class TestRateLimiter(TestCase):
+
+    def setUp(self):
+        self.limiter = ratelimit.RateLimiter(8)
+
+    def test_too_many_requests_halves_limit(self):
+        self.limiter.update(429, {'Retry-After': '0'})
+        self.assertEqual(4, self.limiter.limit)
+
+        self.limiter.update(200, {'X-Rate-Limit': '700', 'X-Rate-Limit-Remaining': '500'})
+        self.assertEqual(5, self.limiter.limit)
+
+    def test_low_budget_lowers_limit(self):
+        self.limiter.update(200, {'X-Rate-Limit': '700', 'X-Rate-Limit-Remaining': '10'})
+        self.assertEqual(7, self.limiter.limit)
+
+    def test_retry_after_blocks_new_requests(self):
+        self.limiter.update(429, {'Retry-After': '30'})
+        self.assertGreater(self.limiter.try_acquire(), 29)
+
+    def test_should_retry(self):
+        self.assertTrue(self.limiter.should_retry('POST', 429, 0))
+        self.assertTrue(self.limiter.should_retry('PUT', 503, 0))
+        self.assertTrue(self.limiter.should_retry('GET', None, 0))
+        self.assertFalse(self.limiter.should_retry('POST', 503, 0))
+        self.assertFalse(self.limiter.should_retry('GET', 429, ratelimit.DEFAULT_MAX_RETRIES))
+        self.assertFalse(self.limiter.should_retry('GET', 400, 0))
+
+    def test_retry_delay_honors_retry_after(self):
+        self.assertEqual(12, self.limiter.retry_delay(3, {'Retry-After': '12'}))
+        self.assertLessEqual(self.limiter.retry_delay(2), 4 * ratelimit.DEFAULT_BACKOFF)
+
+
+@patch('zendesk.time.sleep')
+class TestZendeskRequestRetries(TestCase):
+
+    def setUp(self):
+        self.req = zendesk.ZendeskRequest('test_company.com', 'test_user', 'test_password')
+        self.req.limiter = ratelimit.RateLimiter(4)
+        self.req.session = MagicMock()
+
+    def test_retries_rate_limited_request(self, sleep):
+        self.req.session.request.side_effect = [_response(429, {'Retry-After': '0'}),
+                                                _response(200, data={'user': {'id': 1}})]
+
+        self.assertEqual({'id': 1}, self.req.get_user(1))
+        self.assertEqual(2, self.req.session.request.call_count)
+
+    def test_raises_when_rate_limit_persists(self, sleep):
+        self.req.session.request.return_value = _response(429, {'Retry-After': '0'})
+
+        self.assertRaises(zendesk.RateLimitError, self.req.put, MagicMock(), {})
+        self.assertEqual(ratelimit.DEFAULT_MAX_RETRIES + 1, self.req.session.request.call_count)
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import model
+import render
+
+
+def _article(body):
+    category = model.Category({'name': 'category', 'description': ''}, 'category')
+    section = model.Section(category, {'name': 'section', 'description': ''}, 'section')
+    attributes = {'name': 'article', 'synced': True, 'draft': False, 'author': '', 'visibility': 'all',
+                  'comments_disabled': False}
+    article = model.Article(section, attributes, body, 'article')
+    attachment = model.Attachment(article, 'image.png')
+    attachment.meta = {'relative_path': '/hc/article_attachments/1/image.png'}
+    article.attachments['image.png'] = attachment
+    return article
+
+
+class TestRewriteAttachmentLinks(TestCase):
+
+    def setUp(self):
+        self.links = {'image.png': '/hc/1/image.png', 'my file.png': '/hc/2/my file.png'}
+
+    def test_rewrites_all_link_forms(self):
+        body = '![a](attachments/image.png) [b](./attachments/image.png "title") ![c](/attachments/my%20file.png)'
+
+        body, missing = render.rewrite_attachment_links(body, self.links)
+
+        self.assertEqual('![a](/hc/1/image.png) [b](/hc/1/image.png "title") ![c](/hc/2/my file.png)', body)
+        self.assertEqual([], missing)
+
+    def test_dot_in_filename_is_literal(self):
+        body, missing = render.rewrite_attachment_links('![a](attachments/imageXpng)', self.links)
+
+        self.assertEqual('![a](attachments/imageXpng)', body)
+        self.assertEqual(['imageXpng'], missing)
+
+    def test_reports_missing_attachments(self):
+        body, missing = render.rewrite_attachment_links('[a](attachments/gone.pdf) [b](other/image.png)', self.links)
+
+        self.assertEqual('[a](attachments/gone.pdf) [b](other/image.png)', body)
+        self.assertEqual(['gone.pdf'], missing)
+
+
+class TestRenderCache(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = render.RenderCache(self.folder, max_size=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_key_depends_on_body_and_links(self):
+        key = render.render_key('body', {'image.png': '/hc/1'})
+
+        self.assertEqual(key, render.render_key('body', {'image.png': '/hc/1'}))
+        self.assertNotEqual(key, render.render_key('other body', {'image.png': '/hc/1'}))
+        self.assertNotEqual(key, render.render_key('body', {'image.png': '/hc/2'}))
+
+    def test_put_and_get(self):
+        self.cache.put('abcdef', '<p>body</p>')
+
+        self.assertEqual('<p>body</p>', self.cache.get('abcdef'))
+        self.assertIsNone(self.cache.get('missing'))
+
+    def test_evicts_least_recently_used(self):
+        for i in range(3):
+            key = '%02d' % i + 'key'
+            self.cache.put(key, 'x' * 300)
+            os.utime(self.cache._path(key), ns=(i, i))
+        self.cache.get('00key')
+
+        self.cache.put('03key', 'x' * 300)
+
+        self.assertIsNotNone(self.cache.get('00key'))
+        self.assertIsNone(self.cache.get('01key'))
+        self.assertIsNotNone(self.cache.get('03key'))
+
+    def test_replacing_an_entry_counts_its_size_once(self):
+        for _ in range(5):
+            self.cache.put('abcdef', 'x' * 300)
+
+        self.assertEqual(300, self.cache.size)
+        self.assertIsNotNone(self.cache.get('abcdef'))
+
+    def test_failed_write_leaves_no_temporary_file(self):
+        with self.assertRaises(UnicodeEncodeError):
+            self.cache.put('abcdef', '\udc80')
+
+        self.assertEqual([], os.listdir(os.path.dirname(self.cache._path('abcdef'))))
+
+    def test_generate_body_reuses_cached_render(self):
+        article = _article('![image](attachments/image.png)')
+        body = article.generate_body(self.cache)
+
+        with patch('render.render_markdown') as render_markdown:
+            self.assertEqual(body, article.generate_body(self.cache))
+            render_markdown.assert_not_called()
+        self.assertIn('/hc/article_attachments/1/image.png', body)
+
+
+class TestRenderPool(TestCase):
+
+    def setUp(self):
+        self.pool = render.RenderPool(2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_renders_submitted_articles(self):
+        article = _article('# title\n\n![image](attachments/image.png)')
+        expected = article.generate_body()
+
+        self.pool.submit(article)
+
+        self.assertEqual(1, len(self.pool.futures))
+        self.assertEqual(expected, article.generate_body(self.pool))
+        self.assertEqual({}, self.pool.futures)
+
+    def test_skips_articles_with_new_attachments(self):
+        article = _article('body')
+        article.attachments['image.png'].meta = {}
+
+        self.pool.submit(article)
+
+        self.assertEqual({}, self.pool.futures)
+
+    def test_release_drops_unused_render(self):
+        article = _article('body')
+        self.pool.submit(article)
+
+        self.pool.release(article)
+
+        self.assertEqual({}, self.pool.futures)
+        self.assertEqual({}, self.pool.keys)
+
+    def test_render_markdown_reuses_instance(self):
+        self.assertEqual(render.render_markdown('*a*'), render.render_markdown('*a*'))
+        self.assertEqual('<p><em>a</em></p>', render.render_markdown('*a*'))
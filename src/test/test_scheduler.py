@@ -0,0 +1,77 @@
+import threading
+from unittest import TestCase
+
+import scheduler
+
+
+class TestScheduler(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _record(self, name):
+        with self.lock:
+            self.calls.append(name)
+        return name
+
+    def _fail(self):
+        raise ValueError('boom')
+
+    def test_runs_dependencies_first(self):
+        tasks = scheduler.Scheduler(4)
+        parent = tasks.add(self._record, 'parent')
+        children = [tasks.add(self._record, 'child %s' % i, depends_on=[parent]) for i in range(10)]
+        tasks.add(self._record, 'last', depends_on=children)
+        tasks.wait()
+
+        self.assertEqual(12, len(self.calls))
+        self.assertEqual('parent', self.calls[0])
+        self.assertEqual('last', self.calls[-1])
+        self.assertEqual('child 3', children[3].result)
+
+    def test_runs_inline_with_single_job(self):
+        tasks = scheduler.Scheduler()
+        first = tasks.add(self._record, 'first')
+        tasks.add(self._record, 'second', depends_on=[first])
+
+        self.assertEqual(['first', 'second'], self.calls)
+        tasks.wait()
+
+    def test_failure_stops_dependents(self):
+        tasks = scheduler.Scheduler(2)
+        failed = tasks.add(self._fail)
+        dependent = tasks.add(self._record, 'dependent', depends_on=[failed])
+
+        self.assertRaises(ValueError, tasks.wait)
+        self.assertTrue(dependent.skipped)
+        self.assertEqual([], self.calls)
+
+    def test_max_pending_blocks_add(self):
+        release = threading.Event()
+        tasks = scheduler.Scheduler(2, max_pending=1)
+        tasks.add(release.wait)
+        added = threading.Event()
+        adder = threading.Thread(target=lambda: (tasks.add(self._record, 'second'), added.set()))
+        adder.start()
+
+        self.assertFalse(added.wait(0.2))
+        release.set()
+        adder.join()
+        tasks.wait()
+        self.assertEqual(['second'], self.calls)
+
+
+class TestBuffered(TestCase):
+
+    def test_yields_all_items_in_order(self):
+        self.assertEqual(list(range(100)), list(scheduler.buffered(iter(range(100)), 3)))
+
+    def test_raises_producer_error(self):
+        def items():
+            yield 1
+            raise ValueError('boom')
+
+        buffered = scheduler.buffered(items(), 3)
+        self.assertEqual(1, next(buffered))
+        self.assertRaises(ValueError, next, buffered)
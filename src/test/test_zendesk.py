@@ -1,10 +1,20 @@
 import os
+import hashlib
 import json
+import shutil
+import tempfile
+import threading
 from unittest import TestCase
-from unittest.mock import MagicMock, create_autospec
+from unittest.mock import MagicMock, create_autospec, patch
+
+import requests
 
 import zendesk
 import filesystem
+import manifest
+import scheduler
+import model
+import render
 from . import fixtures
 
 
@@ -14,11 +24,183 @@ def load_fixture(name):
         return json.load(fp)
 
 
+class TestZendeskRequest(TestCase):
+
+    def setUp(self):
+        self.req = zendesk.ZendeskRequest('test_company.com', 'test_user', 'test_password', pool_size=5)
+
+    def test_session_is_pooled(self):
+        adapter = self.req.session.get_adapter('https://test_company.com')
+        self.assertEqual(5, adapter._pool_maxsize)
+        self.assertEqual(('test_user', 'test_password'), self.req.session.auth)
+
+    def test_requests_share_session(self):
+        self.req.session = MagicMock()
+        self.req.session.request.return_value.status_code = 200
+        self.req.session.request.return_value.json.return_value = {'user': {'id': 1}}
+
+        self.req.get_user(1)
+        self.req.get_user(2)
+
+        self.assertEqual(2, self.req.session.request.call_count)
+        self.req.session.request.assert_any_call('GET', 'https://test_company.com/api/v2/users/1.json', params=None)
+
+    def _download(self, status, chunks, headers=None):
+        response = MagicMock()
+        response.status_code = status
+        response.headers = headers or {}
+        response.__enter__.return_value = response
+        response.iter_content.return_value = iter(chunks)
+        self.req.session = MagicMock()
+        self.req.session.request.return_value = response
+
+    def test_get_attachment_hashes_while_streaming(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'attachments', 'image.png')
+        self._download(200, [b'ima', b'ge'])
+
+        md5_hash = self.req.get_attachment('/hc/1/image.png', path)
+
+        self.assertEqual(hashlib.md5(b'image').hexdigest(), md5_hash)
+        with open(path, 'rb') as fp:
+            self.assertEqual(b'image', fp.read())
+        self.assertEqual(['image.png'], os.listdir(os.path.dirname(path)))
+
+    def test_get_attachment_resumes_partial_download(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'image.png')
+        with open(os.path.join(folder, '.image.png.part'), 'wb') as fp:
+            fp.write(b'ima')
+        with open(os.path.join(folder, '.image.png.part.validator'), 'w') as fp:
+            fp.write('"v1"')
+        self._download(206, [b'ge'], {'Content-Range': 'bytes 3-4/5'})
+
+        md5_hash = self.req.get_attachment('/hc/1/image.png', path)
+
+        self.assertEqual(hashlib.md5(b'image').hexdigest(), md5_hash)
+        self.assertEqual({'Range': 'bytes=3-', 'If-Range': '"v1"'}, self.req.session.request.call_args[1]['headers'])
+        with open(path, 'rb') as fp:
+            self.assertEqual(b'image', fp.read())
+        self.assertEqual(['image.png'], os.listdir(folder))
+
+    def test_get_attachment_starts_over_when_the_attachment_was_replaced(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'image.png')
+        with open(os.path.join(folder, '.image.png.part'), 'wb') as fp:
+            fp.write(b'old')
+        with open(os.path.join(folder, '.image.png.part.validator'), 'w') as fp:
+            fp.write('"v1"')
+        # If-Range does not match the replaced attachment, the server answers with all of it
+        self._download(200, [b'image'], {'ETag': '"v2"', 'Content-Length': '5'})
+
+        md5_hash = self.req.get_attachment('/hc/1/image.png', path)
+
+        self.assertEqual(hashlib.md5(b'image').hexdigest(), md5_hash)
+        with open(path, 'rb') as fp:
+            self.assertEqual(b'image', fp.read())
+
+    def test_get_attachment_does_not_resume_without_validator(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'image.png')
+        with open(os.path.join(folder, '.image.png.part'), 'wb') as fp:
+            fp.write(b'old')
+        self._download(200, [b'image'])
+
+        self.assertEqual(hashlib.md5(b'image').hexdigest(), self.req.get_attachment('/hc/1/image.png', path))
+        self.assertEqual({}, self.req.session.request.call_args[1]['headers'])
+
+    def test_get_attachment_drops_download_of_wrong_size(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'image.png')
+        self._download(200, [b'ima'], {'ETag': '"v1"', 'Content-Length': '5'})
+
+        self.assertIsNone(self.req.get_attachment('/hc/1/image.png', path))
+        self.assertEqual([], os.listdir(folder))
+
+    def test_get_attachment_returns_none_on_error_status(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'image.png')
+        self._download(404, [])
+
+        self.assertIsNone(self.req.get_attachment('/hc/1/image.png', path))
+        self.assertFalse(os.path.exists(path))
+
+    def _broken_download(self, status, chunks, headers=None):
+        def iter_content(size):
+            yield from chunks
+            raise requests.exceptions.ChunkedEncodingError('connection broken')
+        response = MagicMock()
+        response.status_code = status
+        response.headers = headers or {}
+        response.__enter__.return_value = response
+        response.iter_content.side_effect = iter_content
+        return response
+
+    def test_get_attachment_resumes_interrupted_download(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'image.png')
+        self._download(206, [b'ge'], {'Content-Range': 'bytes 3-4/5'})
+        self.req.session.request.side_effect = [
+            self._broken_download(200, [b'ima'], {'ETag': '"v1"', 'Content-Length': '5'}),
+            self.req.session.request.return_value]
+        self.req.limiter.backoff = 0
+
+        md5_hash = self.req.get_attachment('/hc/1/image.png', path)
+
+        self.assertEqual(hashlib.md5(b'image').hexdigest(), md5_hash)
+        self.assertEqual({'Range': 'bytes=3-', 'If-Range': '"v1"'}, self.req.session.request.call_args[1]['headers'])
+        with open(path, 'rb') as fp:
+            self.assertEqual(b'image', fp.read())
+        self.assertEqual(['image.png'], os.listdir(folder))
+
+    def test_get_attachment_keeps_partial_file_when_retries_run_out(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'image.png')
+        self.req.session = MagicMock()
+        self.req.session.request.side_effect = [self._broken_download(200, [b'ima'], {'ETag': '"v1"'})] + [
+            self._broken_download(206, []) for _ in range(self.req.limiter.max_retries)]
+        self.req.limiter.backoff = 0
+
+        self.assertIsNone(self.req.get_attachment('/hc/1/image.png', path))
+        self.assertFalse(os.path.exists(path))
+        with open(os.path.join(folder, '.image.png.part'), 'rb') as fp:
+            self.assertEqual(b'ima', fp.read())
+        self.assertEqual(self.req.limiter.max_retries + 1, self.req.session.request.call_count)
+
+    def test_iter_items_follows_next_page(self):
+        first_page = {'categories': [{'id': 1}, {'id': 2}], 'next_page': 'https://test_company.com/page2'}
+        second_page = {'categories': [{'id': 3}], 'next_page': None}
+        self.req._get_json = MagicMock(side_effect=[first_page, second_page])
+
+        items = list(self.req.iter_items(model.Category))
+
+        self.assertEqual([1, 2, 3], [item['id'] for item in items])
+        self.req._get_json.assert_called_with('https://test_company.com/page2')
+
+    def test_iter_items_follows_cursor(self):
+        first_page = {'categories': [{'id': 1}], 'meta': {'has_more': True},
+                      'links': {'next': 'https://test_company.com/cursor'}}
+        second_page = {'categories': [{'id': 2}], 'meta': {'has_more': False}, 'links': {'next': None}}
+        self.req._get_json = MagicMock(side_effect=[first_page, second_page])
+
+        items = list(self.req.iter_items(model.Category))
+
+        self.assertEqual([1, 2], [item['id'] for item in items])
+
+
 class TestFetcher(TestCase):
 
     def setUp(self):
         req = create_autospec(zendesk.ZendeskRequest)
-        req.get_items.side_effect = lambda *c: load_fixture(c[0].zendesk_group)[c[0].zendesk_group]
+        req.iter_items.side_effect = lambda *c: iter(load_fixture(c[0].zendesk_group)[c[0].zendesk_group])
         self.fetcher = zendesk.Fetcher(req)
 
     def test_fetch_happy_path(self):
@@ -50,6 +232,77 @@ class TestFetcher(TestCase):
         self.assertEqual('### title\n\nbody\n\n', article.body)
         self.assertFalse(hasattr(article, 'description'))
 
+    def test_fetch_does_not_keep_body_in_meta(self):
+        categories = self.fetcher.fetch()
+
+        article = categories[0].sections[0].articles[0]
+        self.assertNotIn('body', article.meta)
+        self.assertTrue(article.html)
+
+
+class TestFetcherConversionPool(TestCase):
+
+    def setUp(self):
+        self.req = create_autospec(zendesk.ZendeskRequest)
+        self.req.iter_items.side_effect = lambda *c: iter(load_fixture(c[0].zendesk_group)[c[0].zendesk_group])
+
+    def test_fetch_converts_bodies_on_processes(self):
+        fetcher = zendesk.Fetcher(self.req, processes=2)
+
+        categories = fetcher.fetch()
+
+        article = categories[0].sections[0].articles[0]
+        self.assertEqual('### title\n\nbody\n\n', article.body)
+        self.assertIsNone(fetcher.converter)
+        self.assertEqual([], fetcher.conversions)
+
+
+class TestConcurrentFetcher(TestCase):
+
+    def setUp(self):
+        req = create_autospec(zendesk.ZendeskRequest)
+        req.iter_items.side_effect = self._iter_items
+        req.get_user.return_value = {'email': 'author@example.com'}
+        self.fetcher = zendesk.Fetcher(req, jobs=4)
+
+    def _iter_items(self, item, parent=None):
+        prefix = parent.name + ' ' if parent else ''
+        if item is model.Attachment:
+            return iter([{'file_name': prefix + 'image.png'}])
+        if item is model.Article:
+            return iter([{'title': prefix + str(i), 'author_id': 1, 'draft': False, 'comments_disabled': False}
+                         for i in range(5)])
+        return iter([{'name': prefix + str(i), 'description': ''} for i in range(3)])
+
+    def test_fetch_keeps_order(self):
+        categories = self.fetcher.fetch()
+
+        self.assertEqual(['0', '1', '2'], [c.name for c in categories])
+        self.assertEqual(['2 0', '2 1', '2 2'], [s.name for s in categories[2].sections])
+        self.assertEqual(['2 1 0', '2 1 1', '2 1 2', '2 1 3', '2 1 4'],
+                         [a.name for a in categories[2].sections[1].articles])
+        self.assertEqual(['2 1 4 image.png'], list(categories[2].sections[1].articles[4].attachments))
+
+
+class TestIncrementalFetcher(TestCase):
+
+    def setUp(self):
+        self.req = create_autospec(zendesk.ZendeskRequest)
+        self.req.iter_items.side_effect = lambda *c: iter(load_fixture(c[0].zendesk_group)[c[0].zendesk_group])
+        self.fetcher = zendesk.Fetcher(self.req)
+
+    def test_fetch_changed_only_has_changed_articles(self):
+        changed = load_fixture('articles')['articles'][0]
+        outdated = dict(changed, title='outdated title')
+        orphan = dict(changed, id=1, section_id=1)
+        self.req.iter_incremental_articles.return_value = iter([outdated, changed, orphan])
+
+        categories = self.fetcher.fetch_changed(1400000000)
+
+        self.req.iter_incremental_articles.assert_called_with(1400000000)
+        articles = categories[0].sections[0].articles
+        self.assertEqual(['test article'], [article.name for article in articles])
+
 
 class TestPusher(TestCase):
 
@@ -96,3 +349,208 @@ class TestPusher(TestCase):
 
         article = self.category.sections[0].articles[0]
         self.req.put.assert_called_with(article, {'comments_disabled': True})
+
+
+class TestPusherScheduling(TestCase):
+
+    def setUp(self):
+        self.root_folder = tempfile.mkdtemp()
+        self.fs = filesystem.FilesystemClient(self.root_folder)
+        self.req = create_autospec(zendesk.ZendeskRequest)
+        self.req.get_user_segments.return_value = []
+        self.req.get_permission_groups.return_value = [{'name': 'Agents and admins', 'id': 1}]
+        self.req.search_user.return_value = {'id': 2}
+        self.req.post.side_effect = lambda item, data, parent=None: {'id': item.name}
+        self.req.post_attachment.side_effect = lambda attachment, path: {
+            'article_attachment': {'id': attachment.name, 'relative_path': '/hc/' + attachment.name}}
+        self.req.get_item.return_value = {}
+        self.req.put.return_value = {}
+        self.category = model.Category({'name': 'category', 'description': ''}, 'category')
+        for i in range(3):
+            section = model.Section(self.category, {'name': 'section %s' % i, 'description': ''}, 'section-%s' % i)
+            self.category.sections.append(section)
+            attributes = {'name': 'article %s' % i, 'synced': True, 'draft': False, 'author': 'a@example.com',
+                          'visibility': 'all', 'comments_disabled': False}
+            article = model.Article(section, attributes, '![image](attachments/image.png)', 'article-%s' % i)
+            section.articles.append(article)
+            attachment = model.Attachment(article, 'image.png')
+            article.attachments['image.png'] = attachment
+            self.fs.save_text(attachment.filepath, 'image %s' % i)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_folder)
+
+    def test_push_in_parallel_keeps_dependencies(self):
+        zendesk.Pusher(self.req, self.fs, jobs=4).push([self.category])
+
+        self.assertEqual(7, self.req.post.call_count)
+        self.assertEqual(3, self.req.post_attachment.call_count)
+        for article_call in self.req.put_translation.call_args_list:
+            self.assertIn('/hc/image.png', article_call[0][1]['translation']['body'])
+
+    def test_renderer_drops_bodies_rendered_before_attachments_changed(self):
+        zendesk.Pusher(self.req, self.fs).push([self.category])
+        for section in self.category.sections:
+            self.fs.save_text(section.articles[0].attachments['image.png'].filepath, 'new image')
+        self.req.post_attachment.side_effect = lambda attachment, path: {
+            'article_attachment': {'id': attachment.name, 'relative_path': '/hc/new/' + attachment.name}}
+        self.req.reset_mock()
+        renderer = render.RenderPool(2)
+        try:
+            zendesk.Pusher(self.req, self.fs, jobs=4, renderer=renderer).push([self.category])
+
+            self.assertEqual({}, renderer.futures)
+            self.assertEqual({}, renderer.keys)
+        finally:
+            renderer.close()
+        article_calls = [call for call in self.req.put_translation.call_args_list if isinstance(call[0][0], model.Article)]
+        self.assertEqual(3, len(article_calls))
+        for article_call in article_calls:
+            self.assertIn('/hc/new/image.png', article_call[0][1]['translation']['body'])
+
+    def test_push_skips_articles_unchanged_since_last_push(self):
+        sync_manifest = manifest.Manifest(self.fs)
+        zendesk.Pusher(self.req, self.fs, manifest=sync_manifest).push([self.category])
+        self.req.reset_mock()
+
+        zendesk.Pusher(self.req, self.fs, manifest=manifest.Manifest(self.fs)).push([self.category])
+
+        pushed = [call[0][0] for call in self.req.put_translation.call_args_list]
+        self.assertFalse([item for item in pushed if isinstance(item, model.Article)])
+        self.req.post_attachment.assert_not_called()
+
+    def test_edit_during_push_is_pushed_next_time(self):
+        article = self.category.sections[0].articles[0]
+        self.fs.save_text(article.body_filepath, 'v1')
+
+        def edit(item, data):
+            if item is article:
+                self.fs.save_text(article.body_filepath, 'edited v2')
+            return {}
+
+        self.req.put_translation.side_effect = edit
+        zendesk.Pusher(self.req, self.fs, manifest=manifest.Manifest(self.fs)).push([self.category])
+        self.req.reset_mock()
+
+        sync_manifest = manifest.Manifest(self.fs)
+        self.assertFalse(sync_manifest.is_unchanged(article))
+        self.assertTrue(sync_manifest.is_unchanged(self.category.sections[1].articles[0]))
+
+    def test_article_meta_never_keeps_the_body(self):
+        self.req.post.side_effect = lambda item, data, parent=None: dict(id=item.name, body='<p>body</p>')
+        self.req.get_item.return_value = {'body': '<p>body</p>', 'draft': False}
+        self.req.put.return_value = {'body': '<p>body</p>', 'author_id': 3}
+        article = self.category.sections[0].articles[0]
+        self.fs.save_json(article.meta_filepath, {'body': '<p>old</p>', 'generated_body': '<p>old</p>'})
+
+        zendesk.Pusher(self.req, self.fs).push([self.category])
+
+        self.assertIn(article, [call[0][0] for call in self.req.put.call_args_list])
+        for section in self.category.sections:
+            for pushed in section.articles:
+                self.assertNotIn('body', pushed.meta)
+                self.assertNotIn('generated_body', pushed.meta)
+                self.assertNotIn('body', self.fs.read_json(pushed.meta_filepath))
+                self.assertNotIn('generated_body', self.fs.read_json(pushed.meta_filepath))
+                self.assertIn('generated_body_hash', self.fs.read_json(pushed.meta_filepath))
+
+    def test_push_stream_from_loader(self):
+        section = self.category.sections[0]
+        for i in range(20):
+            attributes = {'name': 'more %s' % i, 'synced': True, 'draft': False, 'author': 'a@example.com',
+                          'visibility': 'all', 'comments_disabled': False}
+            section.articles.append(model.Article(section, attributes, 'body', 'more-%s' % i))
+        for section in self.category.sections:
+            self.fs.save_yaml(section.attributes_filepath, section.to_attributes())
+            for article in section.articles:
+                self.fs.save_yaml(article.attributes_filepath, article.to_attributes())
+                self.fs.save_text(article.body_filepath, article.body)
+        loaded = []
+        events = []
+        lock = threading.Lock()
+
+        def load():
+            for item in filesystem.Loader(self.fs, False).iter_tree():
+                loaded.append(item.path)
+                yield item
+
+        def record(event, item):
+            with lock:
+                events.append((event, item.path, len(loaded)))
+
+        def post(item, data, parent=None):
+            record('post', item)
+            return {'id': item.name}
+
+        def post_attachment(attachment, path):
+            record('attachment', attachment.article)
+            return {'article_attachment': {'id': attachment.name, 'relative_path': '/hc/' + attachment.name}}
+
+        self.req.post.side_effect = post
+        self.req.post_attachment.side_effect = post_attachment
+        self.req.put_translation.side_effect = lambda item, data: record('translation', item) or {}
+        most_pending = []
+
+        class Scheduler(scheduler.Scheduler):
+            def add(self, *args, **kwargs):
+                task = super().add(*args, **kwargs)
+                most_pending.append(self.unfinished)
+                return task
+
+        hash_cache = manifest.HashCache(self.fs)
+        with patch('scheduler.Scheduler', Scheduler), patch.object(hash_cache, 'submit', wraps=hash_cache.submit):
+            zendesk.Pusher(self.req, self.fs, jobs=4, hash_cache=hash_cache).push_stream(
+                scheduler.buffered(load(), 2), max_pending=3)
+            submitted = [path for call in hash_cache.submit.call_args_list for path in call[0][0]]
+
+        self.assertEqual(27, self.req.post.call_count)
+        self.assertEqual(3, self.req.post_attachment.call_count)
+        self.assertEqual(sorted(a.filepath for s in self.category.sections for a in s.articles[0].attachments.values()),
+                         sorted(submitted))
+        self.assertEqual(sorted(submitted), sorted(hash_cache.hashes))
+        # no more than max_pending tasks queued and the loader only a bounded number of items ahead of them
+        self.assertLessEqual(max(most_pending), 3)
+        first_article = [loaded_count for event, path, loaded_count in events
+                         if event == 'post' and path.count(os.sep) == 2][0]
+        self.assertLess(first_article, len(loaded) / 2)
+        # every item after its parent, an article's body after its attachments
+        order = [(event, path) for event, path, _ in events]
+        for event, path in order:
+            if event == 'post' and os.sep in path:
+                self.assertLess(order.index(('post', os.path.dirname(path))), order.index((event, path)))
+            elif event == 'translation':
+                self.assertLess(order.index(('post', path)), order.index((event, path)))
+                if ('attachment', path) in order:
+                    self.assertLess(order.index(('attachment', path)), order.index((event, path)))
+
+    def test_plan_only_reports_changes(self):
+        zendesk.Pusher(self.req, self.fs).push([self.category])
+        self.category.name = 'renamed'
+        self.category.sections[0].articles[0].draft = True
+
+        with self.assertNoLogs(level='INFO'):
+            actions = zendesk.Planner(self.fs).plan([self.category])['actions']
+
+        changes = [(a['path'], a['changes']) for a in actions]
+        self.assertIn(('category', ['name', 'description']), changes)
+        self.assertIn('draft', dict(changes)[self.category.sections[0].articles[0].path])
+
+    def test_plan_matches_push(self):
+        self.req.put.side_effect = lambda item, data: dict(data.get('article', {}))
+        self.req.post.side_effect = lambda item, data, parent=None: dict(
+            data[item.zendesk_name], id=item.name, **({parent.zendesk_name + '_id': parent.zendesk_id} if parent else {}))
+
+        plan = zendesk.Planner(self.fs).plan([self.category])
+
+        self.assertEqual(['create'] * 10, [action['action'] for action in plan['actions']])
+        self.assertEqual({'hashing', 'rendering'}, set(plan['timings']))
+
+        zendesk.Pusher(self.req, self.fs).push([self.category])
+        self.req.reset_mock()
+        self.category.sections[0].articles[0].draft = True
+
+        actions = zendesk.Planner(self.fs).plan([self.category])['actions']
+
+        self.assertEqual([('article', 'update', ['draft'])],
+                         [(a['type'], a['action'], a['changes']) for a in actions if a['action'] != 'skip'])
+        self.assertFalse(self.req.method_calls)
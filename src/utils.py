@@ -1,4 +1,5 @@
 import unicodedata
+import os
 import re
 import hashlib
 
@@ -25,11 +26,37 @@ def to_iso_locale(locale):
     else:
         return locale
 
-def md5_hash(path):
-    hasher = hashlib.md5()
+def md5_update(hasher, path):
     with open(path, 'rb') as f:
         buf = f.read(BLOCKSIZE)
         while len(buf) > 0:
             hasher.update(buf)
             buf = f.read(BLOCKSIZE)
-    return hasher.hexdigest()
\ No newline at end of file
+    return hasher
+
+
+def md5_hash(path):
+    return md5_update(hashlib.md5(), path).hexdigest()
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def md5_text(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def partial_path(path):
+    """
+    Hidden file next to `path` holding its content while it is being downloaded.
+    """
+    return os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.part')
+
+
+def validator_path(path):
+    """
+    Hidden file next to the partial file of `path` holding the ETag or Last-Modified date of the download.
+    """
+    return partial_path(path) + '.validator'
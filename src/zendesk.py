@@ -5,20 +5,41 @@ import hashlib
 from operator import attrgetter
 import html2text
 import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 
+import metrics
 import model
+import ratelimit
+import scheduler
 import utils
 
 requests.packages.urllib3.disable_warnings()
 
+DEFAULT_POOL_SIZE = 10
+# tasks queued ahead of the workers when streaming the tree to Zendesk
+DEFAULT_MAX_PENDING = 1000
+PARTIAL_CONTENT = 206
+RANGE_NOT_SATISFIABLE = 416
 
-class ZendeskRequest(object):
-    _default_url = 'https://{}/api/v2/help_center/' + utils.to_zendesk_locale(model.DEFAULT_LOCALE) + '/{}'
-    _translations_url = 'https://{}/api/v2/help_center/{}'
-    _users_url = 'https://{}/api/v2/users/{}'
-    _search_url = 'https://{}/api/v2/search.json'
-    _user_segments_url = 'https://{}/api/v2/help_center/user_segments/applicable.json'
-    _permission_groups_url = 'https://{}/api/v2/guide/permission_groups.json'
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class BaseZendeskRequest(object):
+    _default_url = '{}/api/v2/help_center/' + utils.to_zendesk_locale(model.DEFAULT_LOCALE) + '/{}'
+    _translations_url = '{}/api/v2/help_center/{}'
+    _users_url = '{}/api/v2/users/{}'
+    _search_url = '{}/api/v2/search.json'
+    _user_segments_url = '{}/api/v2/help_center/user_segments/applicable.json'
+    _permission_groups_url = '{}/api/v2/guide/permission_groups.json'
+    _incremental_articles_url = '{}/api/v2/help_center/incremental/articles.json?start_time={}'
 
     item_url = '{}/{}.json'
     items_url = '{}.json?per_page=100'
@@ -34,56 +55,219 @@ class ZendeskRequest(object):
         self.company_uri = company_uri
         self.user = user
         self.password = password
-        self.public_uri = public_uri
+        self.public_uri = public_uri or company_uri
+        self.company_url = self._base_url(company_uri)
+        self.public_url = self._base_url(self.public_uri)
+
+    def _base_url(self, uri):
+        # a uri with a scheme, like http://localhost:8000 for a local server, is used as is
+        return uri if '://' in uri else 'https://' + uri
 
     def _url_for(self, path):
-        return self._default_url.format(self.company_uri, path)
+        return self._default_url.format(self.company_url, path)
 
     def _translation_url_for(self, path):
-        return self._translations_url.format(self.company_uri, path)
+        return self._translations_url.format(self.company_url, path)
 
     def _user_url_for(self, path):
-        return self._users_url.format(self.company_uri, path)
+        return self._users_url.format(self.company_url, path)
+
+    def _item_url_for(self, item):
+        return self._url_for(self.item_url.format(item.zendesk_group, item.zendesk_id))
+
+    def _items_url_for(self, item, parent=None):
+        if parent:
+            url = self.items_in_group_url.format(parent.zendesk_group, parent.zendesk_id, item.zendesk_group)
+        else:
+            url = self.items_url.format(item.zendesk_group)
+        return self._url_for(url)
+
+    def _item_translation_url_for(self, item):
+        url = self.translation_url.format(item.zendesk_group, item.zendesk_id, model.DEFAULT_LOCALE)
+        return self._translation_url_for(url)
+
+    def _delete_url_for(self, item):
+        if isinstance(item, model.Attachment):
+            return self._url_for(self.attachment_url.format(item.zendesk_id))
+        return self._item_url_for(item)
+
+    def _attachment_download_url(self, relative_path):
+        return self.public_url + relative_path
+
+    def _range_headers(self, path):
+        """
+        Resumes the partial download of `path` only with the validator of the response it started from, with
+        If-Range the server sends the whole attachment again if it was replaced since.
+        """
+        part_path = utils.partial_path(path)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        try:
+            with open(utils.validator_path(path)) as fp:
+                validator = fp.read()
+        except OSError:
+            validator = None
+        if not offset or not validator:
+            return {}
+        return {'Range': 'bytes=%d-' % offset, 'If-Range': validator}
+
+    def _validator(self, headers):
+        # If-Range only takes a strong ETag or a date
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return headers.get('Last-Modified')
+
+    def _expected_size(self, status, headers):
+        if headers.get('Content-Encoding', 'identity') != 'identity':
+            # the content is decoded while streaming, its size is not the one announced
+            return None
+        if status == PARTIAL_CONTENT:
+            total = headers.get('Content-Range', '').rpartition('/')[2]
+            return int(total) if total.isdigit() else None
+        length = headers.get('Content-Length')
+        return int(length) if length is not None and length.isdigit() else None
+
+    def _open_part(self, path, status, headers):
+        """
+        Opens the partial file for a download answered with `status` and returns it with an md5 hasher
+        of the content it already holds: 206 appends to it, anything else starts it over and remembers
+        the validator of the response to resume it.
+        """
+        part_path = utils.partial_path(path)
+        hasher = hashlib.md5()
+        if status == PARTIAL_CONTENT:
+            return open(part_path, 'ab'), utils.md5_update(hasher, part_path)
+        validator = self._validator(headers)
+        if validator:
+            with open(utils.validator_path(path), 'w') as fp:
+                fp.write(validator)
+        else:
+            _remove(utils.validator_path(path))
+        return open(part_path, 'wb'), hasher
+
+    def _remove_part(self, path):
+        _remove(utils.partial_path(path))
+        _remove(utils.validator_path(path))
+
+    def _finish_part(self, path, size):
+        """
+        Moves a complete download to `path`. A download of another size than announced is dropped.
+        """
+        part_path = utils.partial_path(path)
+        if size is not None and os.path.getsize(part_path) != size:
+            logging.warning('Download of %s has %s bytes instead of %s, dropping it',
+                            path, os.path.getsize(part_path), size)
+            self._remove_part(path)
+            return False
+        os.replace(part_path, path)
+        _remove(utils.validator_path(path))
+        return True
+
+    def _incremental_articles_url_for(self, start_time):
+        return self._incremental_articles_url.format(self.company_url, int(start_time))
+
+    def _next_page_url(self, page):
+        if page.get('end_of_stream'):
+            return None
+        if 'meta' in page:
+            return page.get('links', {}).get('next') if page['meta'].get('has_more') else None
+        return page.get('next_page')
+
+
+class ZendeskRequest(BaseZendeskRequest):
+
+    def __init__(self, company_uri, user, password, public_uri=None, pool_size=DEFAULT_POOL_SIZE):
+        super().__init__(company_uri, user, password, public_uri)
+        self.session = self._create_session(pool_size)
+        self.limiter = ratelimit.RateLimiter(pool_size)
+        self.metrics = metrics.RequestMetrics()
+
+    def _create_session(self, pool_size):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.auth = (self.user, self.password)
+        session.headers.update({'Accept': 'application/json'})
+        session.verify = False
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def _send(self, method, url, **kwargs):
+        for fp in kwargs.get('files', {}).values():
+            fp.seek(0)
+        self.limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self.metrics.record(method, url, 'error', time.perf_counter() - start)
+            raise
+        finally:
+            self.limiter.release()
+        self.metrics.record(method, url, response.status_code, time.perf_counter() - start,
+                            metrics.payload_size(response.request.body),
+                            self._response_size(response, kwargs.get('stream', False)))
+        return response
+
+    def _response_size(self, response, stream):
+        length = response.headers.get('Content-Length')
+        if length is not None:
+            return int(length)
+        # streamed downloads are not read yet
+        return 0 if stream else len(response.content)
+
+    def _request(self, method, url, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                response = self._send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not self.limiter.should_retry(method, None, attempt):
+                    raise
+                delay = self.limiter.retry_delay(attempt)
+                logging.warning('%s %s failed (%s), retrying in %.1fs', method, url, e, delay)
+                self.metrics.record_retry(method, url)
+            else:
+                self.limiter.update(response.status_code, response.headers)
+                if not self.limiter.should_retry(method, response.status_code, attempt):
+                    return response
+                delay = self.limiter.retry_delay(attempt, response.headers)
+                logging.warning('%s %s returned %s, retrying in %.1fs', method, url, response.status_code, delay)
+                self.metrics.record_retry(method, url)
+                response.close()
+            time.sleep(delay)
+            attempt += 1
 
     def _parse_response(self, response):
         if response.status_code == 404:
             raise RecordNotFoundError('Missing record for {}'.format(response.url))
+        if response.status_code == ratelimit.TOO_MANY_REQUESTS:
+            raise RateLimitError('Rate limit still exceeded for {} after retries'.format(response.url))
         if response.status_code not in [200, 201]:
             logging.error('getting data from %s failed. status was %s and message %s',
                           response.url, response.status_code, response.text)
             return {}
         return response.json()
 
-    def _send_request(self, request_fn, url, data):
-        full_url = self._url_for(url)
-        response = request_fn(full_url, data=json.dumps(data),
-                              auth=(self.user, self.password),
-                              headers={'Content-type': 'application/json'},
-                              verify=False)
+    def _send_json(self, method, full_url, data):
+        response = self._request(method, full_url, data=json.dumps(data),
+                                 headers={'Content-type': 'application/json'})
         return self._parse_response(response)
 
-    def _send_translation(self, request_fn, url, data):
-        full_url = self._translation_url_for(url)
-        response = request_fn(full_url, data=json.dumps(data),
-                              auth=(self.user, self.password),
-                              headers={'Content-type': 'application/json'},
-                              verify=False)
+    def _get_json(self, full_url, params=None):
+        response = self._request('GET', full_url, params=params)
         return self._parse_response(response)
 
     def get_user(self, uid):
         full_url = self._user_url_for(self.user_url.format(uid))
-        response = requests.get(full_url,
-                              auth=(self.user, self.password),
-                              verify=False)
-        return self._parse_response(response).get('user', {})
+        return self._get_json(full_url).get('user', {})
 
     def search_user(self, query):
-        full_url = self._search_url.format(self.company_uri)
-        response = requests.get(full_url,
-                              params={'query': query},
-                              auth=(self.user, self.password),
-                              verify=False)
-        results = self._parse_response(response).get('results', [])
+        full_url = self._search_url.format(self.company_url)
+        results = self._get_json(full_url, {'query': query}).get('results', [])
         if len(results) == 0:
             return False
         else:
@@ -91,105 +275,135 @@ class ZendeskRequest(object):
             return self.get_user(uid)
 
     def get_user_segments(self):
-        full_url = self._user_segments_url.format(self.company_uri)
-        response = requests.get(full_url,
-                              auth=(self.user, self.password),
-                              verify=False)
-        return self._parse_response(response).get('user_segments', [])
+        full_url = self._user_segments_url.format(self.company_url)
+        return self._get_json(full_url).get('user_segments', [])
 
     def get_permission_groups(self):
-        full_url = self._permission_groups_url.format(self.company_uri)
-        response = requests.get(full_url,
-                              auth=(self.user, self.password),
-                              verify=False)
-        return self._parse_response(response).get('permission_groups', [])
+        full_url = self._permission_groups_url.format(self.company_url)
+        return self._get_json(full_url).get('permission_groups', [])
 
     def get_item(self, item):
-        url = self.item_url.format(item.zendesk_group, item.zendesk_id)
-        full_url = self._url_for(url)
-        response = requests.get(full_url, auth=(self.user, self.password), verify=False)
-        return self._parse_response(response).get(item.zendesk_name, {})
+        return self._get_json(self._item_url_for(item)).get(item.zendesk_name, {})
+
+    def iter_pages(self, full_url):
+        """
+        Yields every page of a listing, following `next_page` (offset) or `links.next` (cursor) pagination.
+        The next page is requested in the background while the caller is busy with the current one.
+        """
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            next_page = prefetcher.submit(self._get_json, full_url)
+            while next_page:
+                page = next_page.result()
+                next_url = self._next_page_url(page)
+                next_page = prefetcher.submit(self._get_json, next_url) if next_url else None
+                yield page
+
+    def iter_items(self, item, parent=None):
+        key = item.zendesk_group_list_prefix + item.zendesk_group
+        for page in self.iter_pages(self._items_url_for(item, parent)):
+            yield from page.get(key, [])
 
     def get_items(self, item, parent=None):
-        if parent:
-            url = self.items_in_group_url.format(parent.zendesk_group, parent.zendesk_id, item.zendesk_group)
-        else:
-            url = self.items_url.format(item.zendesk_group)
-        full_url = self._url_for(url)
-        response = requests.get(full_url, auth=(self.user, self.password), verify=False)
-        return self._parse_response(response).get(item.zendesk_group_list_prefix + item.zendesk_group, {})
+        return list(self.iter_items(item, parent))
+
+    def iter_incremental_articles(self, start_time):
+        for page in self.iter_pages(self._incremental_articles_url_for(start_time)):
+            yield from page.get('articles', [])
 
     def get_translation(self, item):
-        url = self.translation_url.format(item.zendesk_group, item.zendesk_id, model.DEFAULT_LOCALE)
-        full_url = self._translation_url_for(url)
-        response = requests.get(full_url, auth=(self.user, self.password), verify=False)
-        return self._parse_response(response).get('translation', {})
+        return self._get_json(self._item_translation_url_for(item)).get('translation', {})
 
     def put(self, item, data):
-        url = self.item_url.format(item.zendesk_group, item.zendesk_id)
-        return self._send_request(requests.put, url, data).get(item.zendesk_name, {})
+        return self._send_json('PUT', self._item_url_for(item), data).get(item.zendesk_name, {})
 
     def put_translation(self, item, data):
-        url = self.translation_url.format(item.zendesk_group, item.zendesk_id, model.DEFAULT_LOCALE)
-        return self._send_translation(requests.put, url, data).get('translation', {})
+        return self._send_json('PUT', self._item_translation_url_for(item), data).get('translation', {})
 
     def post(self, item, data, parent=None):
-        if parent:
-            url = self.items_in_group_url.format(parent.zendesk_group, parent.zendesk_id, item.zendesk_group)
-        else:
-            url = self.items_url.format(item.zendesk_group)
-        return self._send_request(requests.post, url, data).get(item.zendesk_name, {})
+        return self._send_json('POST', self._items_url_for(item, parent), data).get(item.zendesk_name, {})
 
     def post_attachment(self, attachment, attachment_filepath):
         full_url = self._url_for(attachment.new_item_url)
-        response = requests.post(full_url, 
-                              data={'inline': 'true'},
-                              files={'file': open(attachment_filepath, 'rb')},
-                              auth=(self.user, self.password),
-                              verify=False)
+        with open(attachment_filepath, 'rb') as fp:
+            response = self._request('POST', full_url, data={'inline': 'true'}, files={'file': fp})
         return self._parse_response(response)
 
     def get_attachment(self, relative_path, path):
+        """
+        Downloads the attachment to `path` and returns the md5 hash of its content, hashed while streaming,
+        or None if it could not be downloaded. The bytes go to a partial file renamed to `path` once complete,
+        a download interrupted midway is resumed from where it stopped with a Range request.
+        """
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        url = 'https://' + self.public_uri + relative_path
-        response = requests.get(url, stream=True, auth=(self.user, self.password))
-        if response.status_code == 200:
-            with open(path, 'wb') as file:
-                for chunk in response:
-                    file.write(chunk)
-            return True
-        else:
-            return False
+        url = self._attachment_download_url(relative_path)
+        attempt = 0
+        while True:
+            response = None
+            try:
+                with self._request('GET', url, stream=True, verify=True, headers=self._range_headers(path)) as response:
+                    status = response.status_code
+                    if status in (200, PARTIAL_CONTENT):
+                        size = self._expected_size(status, response.headers)
+                        hasher = self._save_part(response, path, status)
+            except requests.RequestException as e:
+                # _request already retried the requests that got no response, only a broken stream is resumed
+                if response is None or attempt >= self.limiter.max_retries:
+                    logging.warning('GET %s failed (%s), giving up', url, e)
+                    return None
+                delay = self.limiter.retry_delay(attempt)
+                logging.warning('GET %s stopped (%s), resuming in %.1fs', url, e, delay)
+                self.metrics.record_retry('GET', url)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if status != RANGE_NOT_SATISFIABLE:
+                break
+            # the partial file is not a prefix of the attachment anymore, start over
+            self._remove_part(path)
+        if status not in (200, PARTIAL_CONTENT) or not self._finish_part(path, size):
+            return None
+        return hasher.hexdigest()
+
+    def _save_part(self, response, path, status):
+        file, hasher = self._open_part(path, status, response.headers)
+        with file:
+            for chunk in response.iter_content(utils.BLOCKSIZE):
+                hasher.update(chunk)
+                file.write(chunk)
+        return hasher
 
     def delete(self, item):
-        if isinstance(item, model.Attachment):
-            url = self.attachment_url.format(item.zendesk_id)
-        else:
-            url = self.item_url.format(item.zendesk_group, item.zendesk_id)
-        full_url = self._url_for(url)
-        return self.raw_delete(full_url)
+        return self.raw_delete(self._delete_url_for(item))
 
     def raw_delete(self, full_url):
-        response = requests.delete(full_url, auth=(self.user, self.password), verify=False)
+        response = self._request('DELETE', full_url)
         return response.status_code == 200
 
 
 class Fetcher(object):
 
-    def __init__(self, req):
+    def __init__(self, req, jobs=1, processes=0):
         super().__init__()
         self.req = req
+        self.jobs = jobs
+        self.processes = processes
+        self.converter = None
+        self.conversions = []
         self.users = {}
-        self.user_segments = {segment['id']: utils.slugify(segment['name']) for segment in self.req.get_user_segments()}
+        self.users_lock = threading.Lock()
+        self._set_user_segments(self.req.get_user_segments())
+
+    def _set_user_segments(self, segments):
+        self.user_segments = {segment['id']: utils.slugify(segment['name']) for segment in segments}
         self.user_segments[None] = 'all'
 
     def _get_user_by_uid(self, uid):
-        if uid in self.users:
-            return self.users[uid]
-        else:
-            user = self.req.get_user(uid)
-            self.users[uid] = user
-            return user
+        with self.users_lock:
+            if uid in self.users:
+                return self.users[uid]
+        user = self.req.get_user(uid)
+        with self.users_lock:
+            return self.users.setdefault(uid, user)
 
     def _get_group_attributes_and_filename(self, group):
         attributes = {
@@ -225,60 +439,152 @@ class Fetcher(object):
         filename = utils.slugify(zendesk_article['title'])
         zendesk_body = zendesk_article.get('body', '')
         zendesk_body = '' if zendesk_body == None else zendesk_body
-        body = html2text.html2text(zendesk_body)
-        article = model.Article(section, attributes, body, filename)
+        article = model.Article(section, attributes, None, filename)
+        self._convert_body(article, zendesk_body)
         article.html = zendesk_body
-        article.meta = zendesk_article
+        article.meta = model.Article.compact_meta(dict(zendesk_article))
         article.meta.update(attributes)
         return article
 
+    def _convert_body(self, article, html):
+        if self.converter is None:
+            article.body = html2text.html2text(html)
+        else:
+            self.conversions.append((article, self.converter.submit(html2text.html2text, html)))
+
+    @contextmanager
+    def _converting_bodies(self):
+        """
+        With `processes` set, article bodies are converted to markdown on a process pool while fetching
+        continues and are only set on the articles once the block is done.
+        """
+        if not self.processes:
+            yield
+            return
+        self.converter = ProcessPoolExecutor(max_workers=self.processes)
+        try:
+            yield
+            for article, conversion in self.conversions:
+                article.body = conversion.result()
+        finally:
+            self.conversions = []
+            self.converter.shutdown(cancel_futures=True)
+            self.converter = None
+
     def _instantiate_attachment(self, article, zendesk_attachment):
         attachment = model.Attachment(article, zendesk_attachment['file_name'])
         attachment.meta = zendesk_attachment
         return attachment
 
-    def fetch(self):
+    def _add_categories(self, zendesk_categories):
         categories = []
-        zendesk_categories = self.req.get_items(model.Category)
         for zendesk_category in zendesk_categories:
             category = self._instantiate_category(zendesk_category)
             print('Category %s created' % category.name)
-            zendesk_sections = self.req.get_items(model.Section, category)
             categories.append(category)
-            for zendesk_section in zendesk_sections:
-                section = self._instantiate_section(category, zendesk_section)
-                print('Section %s created' % section.name)
-                zendesk_articles = self.req.get_items(model.Article, section)
-                category.sections.append(section)
-                for zendesk_article in zendesk_articles:
-                    article = self._instantiate_article(section, zendesk_article)
-                    print('Article %s created' % article.name)
-                    zendesk_attachments = self.req.get_items(model.Attachment, article)
-                    section.articles.append(article)
-                    for zendesk_attachment in zendesk_attachments:
-                        attachment = self._instantiate_attachment(article, zendesk_attachment)
-                        article.attachments[attachment.filename] = attachment
+        return categories
+
+    def _add_sections(self, category, zendesk_sections):
+        for zendesk_section in zendesk_sections:
+            section = self._instantiate_section(category, zendesk_section)
+            print('Section %s created' % section.name)
+            category.sections.append(section)
+        return category.sections
+
+    def _add_articles(self, section, zendesk_articles):
+        for zendesk_article in zendesk_articles:
+            article = self._instantiate_article(section, zendesk_article)
+            print('Article %s created' % article.name)
+            section.articles.append(article)
+        return section.articles
+
+    def _add_attachments(self, article, zendesk_attachments):
+        for zendesk_attachment in zendesk_attachments:
+            attachment = self._instantiate_attachment(article, zendesk_attachment)
+            article.attachments[attachment.filename] = attachment
+        return list(article.attachments.values())
+
+    def _fetch_sections(self, category):
+        return self._add_sections(category, self.req.iter_items(model.Section, category))
+
+    def _fetch_articles(self, section):
+        return self._add_articles(section, self.req.iter_items(model.Article, section))
+
+    def _fetch_attachments(self, article):
+        return self._add_attachments(article, self.req.iter_items(model.Attachment, article))
+
+    def _fan_out(self, pool, parents, fetch_children):
+        children = []
+        for parent_children in pool.map(fetch_children, parents):
+            children.extend(parent_children)
+        return children
+
+    def fetch_changed(self, start_time):
+        """
+        Fetches all categories and sections but only the articles updated since `start_time` (a unix timestamp),
+        using the incremental article export.
+        """
+        categories = self._add_categories(self.req.iter_items(model.Category))
+        with self._converting_bodies(), ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            sections = self._fan_out(pool, categories, self._fetch_sections)
+            sections_by_id = {section.zendesk_id: section for section in sections}
+            # an article updated several times in the window is listed once per update, keep the latest
+            changed = {a['id']: a for a in self.req.iter_incremental_articles(start_time)}
+            articles = []
+            for zendesk_article in changed.values():
+                section = sections_by_id.get(zendesk_article.get('section_id'))
+                if section is None:
+                    logging.info('Skipping article %s outside of the known sections' % zendesk_article['title'])
+                    continue
+                articles.extend(self._add_articles(section, [zendesk_article]))
+            self._fan_out(pool, articles, self._fetch_attachments)
+        return categories
+
+    def fetch(self):
+        """
+        Fetches the tree one level at a time, listing the children of every node of a level on a pool of
+        `jobs` workers. Each node only ever has its children appended by a single worker so the order
+        is the same as Zendesk's.
+        """
+        categories = self._add_categories(self.req.iter_items(model.Category))
+        with self._converting_bodies(), ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            sections = self._fan_out(pool, categories, self._fetch_sections)
+            articles = self._fan_out(pool, sections, self._fetch_articles)
+            self._fan_out(pool, articles, self._fetch_attachments)
         return categories
 
 
 class Pusher(object):
 
-    def __init__(self, req, fs):
+    def __init__(self, req, fs, jobs=1, manifest=None, render_cache=None, hash_cache=None, renderer=None):
         self.req = req
         self.fs = fs
+        self.jobs = jobs
+        self.manifest = manifest
+        self.render_cache = render_cache
+        self.hash_cache = hash_cache
+        self.renderer = renderer
         self.users = {}
-        self.user_segments = {utils.slugify(segment['name']): segment['id'] for segment in self.req.get_user_segments()}
+        self._set_user_segments(self.req.get_user_segments())
+        self._set_permission_groups(self.req.get_permission_groups())
+
+    def _set_user_segments(self, segments):
+        self.user_segments = {utils.slugify(segment['name']): segment['id'] for segment in segments}
         self.user_segments['all'] = None
-        self.permission_groups = {utils.slugify(segment['name']): segment['id'] for segment in self.req.get_permission_groups()}
+
+    def _set_permission_groups(self, groups):
+        self.permission_groups = {utils.slugify(group['name']): group['id'] for group in groups}
+
+    def _user_query(self, email):
+        return 'type:user email:"'+email+'"'
+
+    def _log_change(self, message):
+        logging.info(message)
 
     def _get_user_id_from_email(self, email):
-        if email in self.users:
-            return self.users[email]['id']
-        else:
-            query = 'type:user email:"'+email+'"'
-            user = self.req.search_user(query)
-            self.users[email] = user
-            return user['id']
+        if email not in self.users:
+            self.users[email] = self.req.search_user(self._user_query(email))
+        return self.users[email]['id']
 
     def _have_attributes_changed(self, attributes, item):
         for key in attributes:
@@ -289,20 +595,26 @@ class Pusher(object):
             item_body = '' if item_body == None else item_body
             item_hash = hashlib.md5(item_body.encode('utf-8'))
             if zendesk_hash.hexdigest() != item_hash.hexdigest():
-                print('key: %s meta: %s attribute: %s' %(key, zendesk_body, attributes[key]))
+                logging.debug('key: %s meta: %s attribute: %s' %(key, zendesk_body, attributes[key]))
                 return True
         return False
 
-    def _push_new_article(self, article, parent=None):
+    def _new_article_data(self, article, author_id):
         data = {article.zendesk_name: article.to_dict()}
         data['article']['user_segment_id'] = self.user_segments[article.visibility]
         data['article']['permission_group_id'] = self.permission_groups['agents-and-admins']
         data['article']['comments_disabled'] = article.comments_disabled
         data['article']['section_id'] = article.section.zendesk_id
-        data['article']['author_id'] = self._get_user_id_from_email(article.author)
-        meta = self.req.post(article, data, parent)
-        meta = self.fs.save_json(article.meta_filepath, meta)
-        article.meta = meta
+        data['article']['author_id'] = author_id
+        return data
+
+    def _push_new_article(self, article, parent=None):
+        data = self._new_article_data(article, self._get_user_id_from_email(article.author))
+        self._save_article_meta(article, self.req.post(article, data, parent))
+
+    def _save_article_meta(self, article, meta):
+        # the response and metas saved by older versions hold the whole body
+        article.meta = self.fs.save_json(article.meta_filepath, meta, model.Article.compact_meta)
 
     def _push_group_translation(self, item):
         translation = item.to_translation()
@@ -314,11 +626,16 @@ class Pusher(object):
             meta = self.fs.save_json(item.meta_filepath, meta)
             item.meta = meta
 
-    def _check_and_update_section_category(self, section):
+    def _section_category_changes(self, section):
         existing_category_id = section.meta.get('category_id', '')
         if section.category.zendesk_id != existing_category_id:
-            logging.info('Updating category ID for section %s from %s to %s' % (section.name, existing_category_id, section.category.zendesk_id))
-            data = {'category_id': section.category.zendesk_id}
+            self._log_change('Updating category ID for section %s from %s to %s' % (section.name, existing_category_id, section.category.zendesk_id))
+            return {'category_id': section.category.zendesk_id}
+        return {}
+
+    def _check_and_update_section_category(self, section):
+        data = self._section_category_changes(section)
+        if data:
             meta = self.req.put(section, data)
             meta = self.fs.save_json(section.meta_filepath, meta)
             section.meta = meta
@@ -335,81 +652,112 @@ class Pusher(object):
             self._check_and_update_section_category(item)
 
     def _has_article_body_changed(self, article, generated_body):
-        if generated_body == article.meta.get('generated_body', ''):
+        if utils.md5_text(generated_body) == article.meta.get('generated_body_hash', ''):
             return False
         return True
 
-    def _check_and_update_article_translation(self, article, attachments_changed):
+    def _article_title_changes(self, article):
         data = {}
-        translation_changed = False
 
         existing_draft_status = article.meta.get('draft', False)
         if article.draft != existing_draft_status:
-            logging.info('Updating draft status for article %s from %s to %s' % (article.name, existing_draft_status, article.draft))
+            self._log_change('Updating draft status for article %s from %s to %s' % (article.name, existing_draft_status, article.draft))
             data['draft'] = article.draft
-            translation_changed = True
 
         existing_title = article.meta.get('title', '')
         if article.title != existing_title:
-            logging.info('Updating article title for article %s from %s to %s' % (article.name, existing_title, article.title))
+            self._log_change('Updating article title for article %s from %s to %s' % (article.name, existing_title, article.title))
             data['title'] = article.title
-            translation_changed = True
-        
-        body = article.generate_body()
+
+        return data
+
+    def _article_translation_changes(self, article, attachments_changed):
+        data = self._article_title_changes(article)
+        body = article.generate_body(self.renderer or self.render_cache)
         if attachments_changed or self._has_article_body_changed(article, body):
-            logging.info('Updating article body for article %s' % (article.name))
+            self._log_change('Updating article body for article %s' % (article.name))
             data['body'] = body
-            translation_changed = True
 
-        if translation_changed:
+        return data, body
+
+    def _save_article_translation(self, article, meta, body):
+        translation = article.to_translation()
+        translation['generated_body_hash'] = utils.md5_text(body)
+        meta.update(translation)
+        self._save_article_meta(article, meta)
+
+    def _check_and_update_article_translation(self, article, attachments_changed):
+        data, body = self._article_translation_changes(article, attachments_changed)
+        if data:
             self.req.put_translation(article, {'translation': data})
-            translation = article.to_translation()
-            translation['generated_body'] = body
-            meta = self.req.get_item(article)
-            meta.update(translation)            
-            article.meta = self.fs.save_json(article.meta_filepath, meta)
-            
+            self._save_article_translation(article, self.req.get_item(article), body)
 
-    def _check_and_update_article_attributes(self, article):
+    def _article_attribute_changes(self, article):
+        """
+        Returns the article fields to update. A changed author is returned as its email under `author` and
+        a changed visibility under `visibility`, the caller resolves them to `author_id` and `user_segment_id`.
+        """
         data = {}
-        attributes_changed = False
 
         existing_section_id = article.meta.get('section_id', '')
         if article.section.zendesk_id != existing_section_id:
-            logging.info('Updating section ID for article %s from %s to %s' % (article.name, existing_section_id, article.section.zendesk_id))
+            self._log_change('Updating section ID for article %s from %s to %s' % (article.name, existing_section_id, article.section.zendesk_id))
             data['section_id'] = article.section.zendesk_id
-            attributes_changed = True
-        
+
         existing_author = article.meta.get('author', '')
         if article.author != existing_author:
-            logging.info('Updating author for article %s from %s to %s' % (article.name, existing_author, article.author))
-            data['author_id'] = self._get_user_id_from_email(article.author)
-            attributes_changed = True
+            self._log_change('Updating author for article %s from %s to %s' % (article.name, existing_author, article.author))
+            data['author'] = article.author
 
         existing_visibility = article.meta.get('visibility', '')
         if article.visibility != existing_visibility:
-            logging.info('Updating visibility for article %s from %s to %s' % (article.name, existing_visibility, article.visibility))
-            data['user_segment_id'] = self.user_segments[article.visibility]
-            attributes_changed = True
+            self._log_change('Updating visibility for article %s from %s to %s' % (article.name, existing_visibility, article.visibility))
+            data['visibility'] = article.visibility
 
         existing_comments_disabled = article.meta.get('comments_disabled', False)
         if article.comments_disabled != existing_comments_disabled:
-            logging.info('Updating comments_disabled for article %s from %s to %s' % (article.name, existing_comments_disabled, article.comments_disabled))
+            self._log_change('Updating comments_disabled for article %s from %s to %s' % (article.name, existing_comments_disabled, article.comments_disabled))
             data['comments_disabled'] = article.comments_disabled
-            attributes_changed = True
 
-        if attributes_changed:
+        return data
+
+    def _save_article_attributes(self, article, meta):
+        meta.update(article.to_attributes())
+        self._save_article_meta(article, meta)
+
+    def _resolve_visibility(self, data):
+        if 'visibility' in data:
+            data['user_segment_id'] = self.user_segments[data.pop('visibility')]
+        return data
+
+    def _check_and_update_article_attributes(self, article):
+        data = self._resolve_visibility(self._article_attribute_changes(article))
+        if 'author' in data:
+            data['author_id'] = self._get_user_id_from_email(data.pop('author'))
+        if data:
             meta = self.req.put(article, {'article':data})
-            meta.update(article.to_attributes())
-            article.meta = self.fs.save_json(article.meta_filepath, meta)
+            self._save_article_attributes(article, meta)
 
     def _push_article(self, article, section, attachments_changed):
+        logging.debug('Pushing article %s' % article.name)
         self._check_and_update_article_translation(article, attachments_changed)
         self._check_and_update_article_attributes(article)
 
+    def _push_article_after_attachments(self, article, section, attachment_tasks):
+        self._push_article(article, section, any(task.result for task in attachment_tasks))
+        if self.manifest:
+            self.manifest.update(article)
+        if self.renderer:
+            self.renderer.release(article)
+        article.release()
+
+    def _md5_hash(self, attachment):
+        if self.hash_cache:
+            return self.hash_cache.md5_hash(attachment.filepath)
+        return utils.md5_hash(self.fs.path_for(attachment.filepath))
+
     def _has_attachment_changed(self, attachment):
-        attachment_full_path = self.fs.path_for(attachment.filepath)
-        attachment_md5_hash = utils.md5_hash(attachment_full_path)
+        attachment_md5_hash = self._md5_hash(attachment)
         if attachment_md5_hash == attachment.meta.get('md5_hash', ''):
             return False
         return True
@@ -417,10 +765,10 @@ class Pusher(object):
     def _push_new_attachment(self, attachment):
         attachment_full_path = self.fs.path_for(attachment.filepath)
         meta = self.req.post_attachment(attachment, attachment_full_path)['article_attachment']
-        meta['md5_hash']  = utils.md5_hash(attachment_full_path)
+        meta['md5_hash']  = self._md5_hash(attachment)
         meta = self.fs.save_json(attachment.meta_filepath, meta)
         attachment.meta = meta
-    
+
     def _push_attachment(self, attachment):
         if not attachment.zendesk_id:
             self._push_new_attachment(attachment)
@@ -431,37 +779,230 @@ class Pusher(object):
             return True
         return False
 
+    def _push_article_if_new(self, article, section):
+        if not article.zendesk_id:
+            logging.info('Pushing new article: %s' % article.name)
+            self._push_new_article(article, section)
+
+    def _should_push(self, article):
+        if article.synced != True:
+            logging.debug('Skipping un-synced article %s' % article.name)
+            return False
+        if self.manifest and article.zendesk_id and self.manifest.is_unchanged(article):
+            logging.debug('Skipping unchanged article %s' % article.name)
+            return False
+        if self.manifest:
+            self.manifest.observe(article)
+        return True
+
+    def _articles_to_push(self, section):
+        return [article for article in section.articles if self._should_push(article)]
+
+    def _schedule_article(self, tasks, article, section, section_task):
+        article_task = tasks.add(self._push_article_if_new, article, section, depends_on=[section_task])
+        logging.debug('Pushing attachments for article %s' % article.name)
+        attachment_tasks = [tasks.add(self._push_attachment, attachment, depends_on=[article_task])
+                            for attachment in article.attachments.values()]
+        tasks.add(self._push_article_after_attachments, article, section, attachment_tasks,
+                  depends_on=[article_task] + attachment_tasks)
+
     def push(self, categories):
+        """
+        Pushes the tree on `jobs` workers. Only parent -> child ordering is enforced: a section waits for its
+        category, an article for its section and the article body for the article's attachments.
+        """
+        articles = {section: self._articles_to_push(section)
+                    for category in categories for section in category.sections}
+        if self.renderer:
+            for section_articles in articles.values():
+                for article in section_articles:
+                    self.renderer.submit(article)
+        if self.hash_cache:
+            self.hash_cache.prefetch([attachment.filepath for section_articles in articles.values()
+                                      for article in section_articles for attachment in article.attachments.values()])
+        items = []
         for category in categories:
-            logging.debug('Pushing category %s' % category.name)
-            self._push_group(category)
+            items.append(category)
             for section in category.sections:
-                logging.debug('Pushing section %s' % section.name)
-                self._push_group(section, category)
-                for article in section.articles:
-                    if article.synced == True:
-                        if not article.zendesk_id:
-                            logging.info('Pushing new article: %s' % article.name)
-                            self._push_new_article(article, section)
-                        logging.debug('Pushing attachments for article %s' % article.name)
-                        attachments_changed = False
-                        for _, attachment in article.attachments.items():
-                            if self._push_attachment(attachment):
-                                attachments_changed = True
-                        logging.debug('Pushing article %s' % article.name)
-                        self._push_article(article, section, attachments_changed)
+                items.append(section)
+                items.extend(articles[section])
+        self._push_items(scheduler.Scheduler(self.jobs), items)
+
+    def push_stream(self, items, max_pending=DEFAULT_MAX_PENDING):
+        """
+        Pushes categories, sections and articles as they come from `items`, each after its parent, as
+        `filesystem.Loader.iter_tree` yields them. At most `max_pending` tasks are queued, consuming `items`
+        waits for them so only a bounded part of the tree is in memory.
+        """
+        def articles_to_push():
+            for item in items:
+                if isinstance(item, model.Article):
+                    if not self._should_push(item):
+                        continue
+                    if self.renderer:
+                        self.renderer.submit(item)
+                    if self.hash_cache:
+                        self.hash_cache.submit([attachment.filepath for attachment in item.attachments.values()])
+                yield item
+
+        try:
+            self._push_items(scheduler.Scheduler(self.jobs, max_pending), articles_to_push())
+        finally:
+            if self.hash_cache:
+                self.hash_cache.close()
+
+    def _push_items(self, tasks, items):
+        group_tasks = {}
+        try:
+            try:
+                for item in items:
+                    if tasks.errors:
+                        break
+                    if isinstance(item, model.Category):
+                        logging.debug('Pushing category %s' % item.name)
+                        group_tasks[item] = tasks.add(self._push_group, item)
+                    elif isinstance(item, model.Section):
+                        logging.debug('Pushing section %s' % item.name)
+                        group_tasks[item] = tasks.add(self._push_group, item, item.category,
+                                                      depends_on=[group_tasks[item.category]])
                     else:
-                        logging.debug('Skipping un-synced article %s' % article.name)
+                        self._schedule_article(tasks, item, item.section, group_tasks[item.section])
+            finally:
+                # let the scheduled tasks finish before the manifest is saved, even if listing the items failed
+                tasks.wait()
+        finally:
+            self.fs.flush()
+            if self.manifest:
+                self.manifest.save()
+            if self.hash_cache:
+                self.hash_cache.save()
+
+
+class Planner(Pusher):
+
+    """
+    Works out what `Pusher.push` would do with the tree from local state only, without any request to Zendesk.
+    Every decision is an action: `create`, `update`, `replace` (an attachment deleted and uploaded again) or
+    `skip`, with the changed fields and the number of requests it would take.
+    """
+
+    def __init__(self, fs, manifest=None, render_cache=None, hash_cache=None):
+        self.req = None
+        self.fs = fs
+        self.manifest = manifest
+        self.render_cache = render_cache
+        self.hash_cache = hash_cache
+        self.renderer = None
+        self.users = {}
+        self.user_segments = {}
+        self.permission_groups = {}
+        self.timings = {'hashing': 0.0, 'rendering': 0.0}
+
+    def _log_change(self, message):
+        # a dry run reports its changes as actions, not as updates
+        pass
+
+    def _timed(self, stage, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+
+    def _action(self, item, action, changes=(), requests=0, reason=None):
+        planned = {'type': item.zendesk_name, 'path': item.path, 'action': action, 'changes': list(changes),
+                   'requests': requests}
+        if reason:
+            planned['reason'] = reason
+        return planned
+
+    def _plan_group(self, item):
+        if not item.zendesk_id:
+            return self._action(item, 'create', ['name', 'description'], 1)
+        changes = []
+        requests = 0
+        if self._have_attributes_changed(item.to_attributes(), item):
+            changes.extend(['name', 'description'])
+            requests += 2
+        if isinstance(item, model.Section) and self._section_category_changes(item):
+            changes.append('category')
+            requests += 1
+        return self._action(item, 'update' if changes else 'skip', changes, requests)
+
+    def _plan_attachment(self, attachment):
+        if not attachment.zendesk_id:
+            return self._action(attachment, 'create', ['file'], 1)
+        if self._timed('hashing', self._has_attachment_changed, attachment):
+            return self._action(attachment, 'replace', ['file'], 2)
+        return self._action(attachment, 'skip')
+
+    def _plan_article(self, article):
+        if article.synced != True:
+            return [self._action(article, 'skip', reason='not synced')]
+        if self.manifest and article.zendesk_id and self.manifest.is_unchanged(article):
+            return [self._action(article, 'skip', reason='unchanged since the last export')]
+        attachments = [self._plan_attachment(attachment) for attachment in article.attachments.values()]
+        attachments_changed = any(planned['action'] != 'skip' for planned in attachments)
+        requests = 0
+        if not article.zendesk_id:
+            requests += 1
+        changes = list(self._article_title_changes(article))
+        if attachments_changed:
+            # the body is sent again anyway, it can only be rendered once new attachments have their Zendesk path
+            changes.append('body')
+        elif self._has_article_body_changed(article, self._timed('rendering', article.generate_body, self.render_cache)):
+            changes.append('body')
+        if changes:
+            requests += 2
+        attribute_changes = list(self._article_attribute_changes(article))
+        if attribute_changes:
+            requests += 1
+        changes.extend(attribute_changes)
+        if not article.zendesk_id:
+            action = 'create'
+        else:
+            action = 'update' if changes else 'skip'
+        article.release()
+        return [self._action(article, action, changes, requests)] + attachments
+
+    def plan(self, categories):
+        """
+        Returns the planned actions in push order with the total number of requests and the time spent
+        hashing attachments and rendering bodies.
+        """
+        actions = []
+        for category in categories:
+            actions.append(self._plan_group(category))
+            for section in category.sections:
+                actions.append(self._plan_group(section))
+                for article in section.articles:
+                    actions.extend(self._plan_article(article))
+        return {
+            'actions': actions,
+            'requests': sum(planned['requests'] for planned in actions),
+            'timings': dict(self.timings)
+        }
 
 
 class RecordNotFoundError(Exception):
     pass
 
 
-def fetcher(company_uri, user, password):
-    req = ZendeskRequest(company_uri, user, password)
-    return Fetcher(req)
+class RateLimitError(Exception):
+    pass
+
+
+def client(company_uri, user, password, public_uri=None, pool_size=DEFAULT_POOL_SIZE):
+    return ZendeskRequest(company_uri, user, password, public_uri, pool_size)
+
+
+def fetcher(req, jobs=1, processes=0):
+    return Fetcher(req, jobs, processes)
+
+
+def pusher(req, fs, jobs=1, manifest=None, render_cache=None, hash_cache=None, renderer=None):
+    return Pusher(req, fs, jobs, manifest, render_cache, hash_cache, renderer)
+
 
-def pusher(company_uri, user, password, fs):
-    req = ZendeskRequest(company_uri, user, password)
-    return Pusher(req, fs)
+def planner(fs, manifest=None, render_cache=None, hash_cache=None):
+    return Planner(fs, manifest, render_cache, hash_cache)